@@ -44,3 +44,7 @@ class Controller:
         log.debug(function=self.revert)
         self.model.revertGame()
 
+    def undo(self):
+        log.debug(function=self.undo)
+        self.model.undoMove()
+
@@ -0,0 +1,192 @@
+"""
+A compact, versioned binary format for the state of a game, as an alternative to the JSON of Game.serialize.
+
+The tiles are not stored, they are the fixed tile table of Pile.getTileTable. The format stores:
+- the header: MAGIC and the format version
+- the game: maxPlayers, currentPlayerNr, gameNr, moves, seed, nextId of the pile and currentPlayer
+- the players: their names and the tile ids on their plates
+- the tile ids on the board, and on the pile. When the pile is still in the order of the deck that was shuffled
+  with the seed of the game (see Pile.shuffle), only a flag is stored, the pile then has the remaining tiles in deck order
+- the sets: their positions, the ids of their tiles, and their orders
+Numbers are stored as varints (7 bits per byte, the least significant first), a number that can be None as the 
+number + 1 (0 for None), a number that can be negative zigzag encoded, and a string as its length + 1 followed by its 
+UTF-8 bytes. A list of tile ids is stored as its length followed by one byte per tile id. A set starts with a single 
+byte with its flags and the number of its tiles.
+Decoding results in the same game as deserializing the serialized game.
+"""
+from lib import log
+from . import model
+
+MAGIC = b"YMY"
+FORMATVERSION = 2
+
+# flags of the pile and of a set
+DECK = 1
+POSITION = 1
+ORDERED = 2
+SETFLAGS = 2    #the number of bits of the flags of a set, the number of its tiles is stored in the bits above them
+
+def isBinary(data):
+    """
+    Returns True if data (bytes) is a game in the binary format
+    """
+    return isinstance(data, (bytes, bytearray)) and data[:len(MAGIC)] == MAGIC
+
+def encodeNumber(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def encodeOptional(out, n):
+    encodeNumber(out, n+1 if n != None else 0)
+
+def encodeSigned(out, n):
+    encodeNumber(out, 2*n if n >= 0 else -2*n-1)
+
+def encodeString(out, s):
+    if s == None:
+        out.append(0)
+    else:
+        b = s.encode("utf-8")
+        encodeNumber(out, len(b)+1)
+        out += b
+
+def encodeTiles(out, tiles):
+    out.append(len(tiles))
+    out += bytes(tiles)
+
+def encode(game):
+    """
+    Returns: the state of game (an instance of model.Game) in the binary format
+    """
+    attrs = game.getPersistentAttributes()
+    nextId = game.pile.getPersistentAttributes()["nextId"]
+    out = bytearray(MAGIC)
+    out.append(FORMATVERSION)
+    encodeNumber(out, attrs["maxPlayers"])
+    encodeOptional(out, attrs["currentPlayerNr"])
+    encodeOptional(out, attrs["gameNr"])
+    encodeNumber(out, attrs["moves"])
+    encodeNumber(out, attrs["seed"])
+    encodeNumber(out, nextId)
+    encodeString(out, attrs["currentPlayer"])
+    players = game.getPlayers()
+    out.append(len(players))
+    for player in players:
+        encodeString(out, player.getName())
+        encodeTiles(out, player.plate.getTiles())
+    encodeTiles(out, game.board.getTiles())
+    pile = game.pile.getTiles()
+    inPile = set(pile)
+    if pile == [tId for tId in model.Pile.getDeck(range(nextId), attrs["seed"]) if tId in inPile]:
+        out.append(DECK)
+    else:
+        out.append(0)
+        encodeTiles(out, pile)
+    sets = list(game.board.getChildren())
+    encodeNumber(out, len(sets))
+    for s in sets:
+        pos, tiles, order = s.getPos(), s.getTiles(), s.getOrder()
+        out.append((len(tiles) << SETFLAGS) | (POSITION if pos != None else 0) | (ORDERED if order == tiles else 0))
+        if pos != None:
+            encodeSigned(out, pos[0])
+            encodeSigned(out, pos[1])
+        out += bytes(tiles)
+        if order != tiles:
+            out += bytes(order)
+    return bytes(out)
+
+class Reader:
+    """
+    Reads the values of a game in the binary format, see decode
+    """
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def byte(self):
+        self.offset += 1
+        return self.data[self.offset-1]
+
+    def number(self):
+        n, shift = 0, 0
+        while True:
+            b = self.byte()
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def optional(self):
+        n = self.number()
+        return n-1 if n else None
+
+    def signed(self):
+        n = self.number()
+        return (n >> 1) ^ -(n & 1)
+
+    def string(self):
+        n = self.number()
+        if n == 0:
+            return None
+        self.offset += n-1
+        return self.data[self.offset-n+1:self.offset].decode("utf-8")
+
+    def tiles(self, n=None):
+        if n == None:
+            n = self.byte()
+        self.offset += n
+        return list(self.data[self.offset-n:self.offset])
+
+def decode(data):
+    """
+    Returns: a new instance of model.Game with the state in data (bytes in the binary format)
+    The game is built in a batch (see ModelObject.batch), the attributes are assigned to their slots directly 
+    (see PersistentObject.setPersistentAttributes) and the containers get their tiles directly, 
+    without replaying the moves of the tiles.
+    """
+    reader = Reader(data)
+    assert data[:len(MAGIC)] == MAGIC
+    reader.offset = len(MAGIC)
+    version = reader.byte()
+    if version != FORMATVERSION:
+        log.error(function=decode, args=version)
+        assert False
+    maxPlayers = reader.number()
+    currentPlayerNr, gameNr, moves, seed, nextId = reader.optional(), reader.optional(), reader.number(), reader.number(), reader.number()
+    game = model.Game(maxPlayers, seed, False)
+    with game.batch():
+        game.setPersistentAttributes({"currentPlayer": reader.string(), "currentPlayerNr": currentPlayerNr, "gameNr": gameNr, "moves": moves})
+        game.pile.setPersistentAttributes({"nextId": nextId})
+        game.getTileRegistry().createTiles(model.Pile.getTileTable()[:nextId], None)
+        located = []
+        for i in range(reader.byte()):
+            player = game.addPlayer()
+            player.setPersistentAttributes({"name": reader.string()})
+            located.append((player.plate, reader.tiles()))
+        located.append((game.board, reader.tiles()))
+        if reader.byte() & DECK:
+            pileTiles = None    #the remaining tiles, determined after all other containers are read
+        else:
+            pileTiles = reader.tiles()
+        orders = []
+        for i in range(reader.number()):
+            s = game.board.addSet()
+            flags = reader.byte()
+            if flags & POSITION:
+                s.setPersistentAttributes({"pos": (reader.signed(), reader.signed())})
+            tiles = reader.tiles(flags >> SETFLAGS)
+            located.append((s, tiles))
+            orders.append((s, tiles if flags & ORDERED else reader.tiles(len(tiles))))
+        if pileTiles == None:
+            elsewhere = set()
+            for container, tiles in located:
+                elsewhere.update(tiles)
+            pileTiles = [tId for tId in model.Pile.getDeck(range(nextId), seed) if not tId in elsewhere]
+        located.append((game.pile, pileTiles))
+        for container, tiles in located:
+            container.putTiles(tiles)
+        for s, order in orders:
+            s.setOrder(order)
+    return game
@@ -1,7 +1,11 @@
 from lib import log
-from lib.pubsub import Publisher
+from lib.pubsub import Publisher, LazyPayload, MessageQueue, SyncDelivery
 import json
+import functools
+import weakref
 from . import model
+from . import gameformat
+from .journal import Journal
 
 
 class GameServer(Publisher):
@@ -66,18 +70,20 @@ class GameServer(Publisher):
         """
         pass
 
-    def saveGame(self, gameNr, path):
+    def saveGame(self, gameNr, path, binary=True):
         """
-        Saves a game in JSON-format to the indicated path. 
+        Saves a game to the indicated path, in the binary format (see gameformat) or in JSON-format. 
         Parameters:
         - gameNr: the number of the game that must be saved
         - path: the full pathname of the file that is created (or overwritten)
+        - binary: True for the binary format, False for JSON
         """
         pass
 
     def loadGame(self, path):
         """
-        Loads a game from a JSON-formatted file. After succesful loading, the game gets the next available game number.
+        Loads a game from a file in the binary format or in JSON-format, the format is determined from the contents of the file. 
+        After succesful loading, the game gets the next available game number.
         Message "msg_game_loaded" will be dispatched so that listening subscribers can handle the update
         Parameters:
         - path: the full pathname of the file that is created (or overwritten)
@@ -90,10 +96,132 @@ class LocalGameServer(GameServer):
     This class implements a locally running GameServer instance. It can be built into 
     the UI of the game itself.
     '''
-    def __init__(self):
+    SNAPSHOTINTERVAL = 50   #the number of patches of a game in the journal after which a snapshot of the game is journaled
+
+    def __init__(self, journalPath=None):
+        """
+        Parameters:
+        - journalPath: the path of the journal (see journal.Journal) in which the changes of the games are recorded, 
+          or None to keep the games in memory only. The games in an existing journal are restored.
+        """
         GameServer.__init__(self)
         self.__games__ = {} # a dictionary of model.Game instances, keyed by a unique gameNr
+        self.__versions__ = {} # the (origin, version) of each game when its last update was dispatched, keyed by gameNr
         self.__nextGameNr__ = 1
+        self.__journal__ = None
+        self.__patchCounts__ = {} # the number of patches journaled since the last snapshot, keyed by gameNr
+        self.__serialized__ = {} # the ((origin, version), serialized game) of the last serialization of each game, keyed by gameNr
+        self.__pending__ = {} # weak references to the payloads that may still read the game (see _payload), keyed by gameNr
+        self.__external__ = set() # the numbers of the games that were passed to updateGame, which the caller may change
+        if journalPath:
+            self.__journal__ = Journal(journalPath)
+            self._replayJournal()
+
+    def _replayJournal(self):
+        """
+        Rebuilds the games from the journal: from the last snapshot of each game and the patches that follow it.
+        The journal is then compacted to a snapshot of each game.
+        """
+        log.debug(function=self._replayJournal, args=self.__journal__.getPath())
+        for record in self.__journal__.read():
+            gameNr = record["gamenr"]
+            if record["op"] == "snapshot":
+                self.__games__[gameNr] = model.Game.fromData(record["game"])
+            elif gameNr in self.__games__:
+                game = self.__games__[gameNr]
+                # the versions in the journal relate to the games before the restart, so rebase the patch on the restored game
+                patch = dict(record["patch"], origin=game.getOrigin(), base=game.getVersion(), version=game.getVersion()+1)
+                game.applyPatch(patch)
+        for gameNr, game in self.__games__.items():
+            self.__versions__[gameNr] = (game.getOrigin(), game.getVersion())
+            self.__nextGameNr__ = max(self.__nextGameNr__, gameNr+1)
+        self.__journal__.rewrite([self._snapshot(gameNr) for gameNr in self.__games__])
+
+    def _serialize(self, gameNr, version=None, game=None):
+        """
+        Returns the serialized game indicated by gameNr. A game is serialized at most once per version 
+        (see ModelObject.getVersion), the journal and the subscribers of all messages about that version share the result, 
+        which must therefore not be modified.
+        Parameters:
+        - version: the (origin, version) that the game must have, or None for the current version
+        - game: the instance of the game, when it may have been replaced since, or None for the current instance
+        Returns: None if the game is no longer at version, and it was not serialized at version
+        """
+        if game == None:
+            game = self.__games__[gameNr]
+        current = (game.getOrigin(), game.getVersion())
+        serialized = self.__serialized__.get(gameNr)
+        if serialized != None and serialized[0] == (version or current):
+            return serialized[1]
+        if version != None and version != current:
+            log.warning("game", gameNr, "has changed since version", version, function=self._serialize)
+            return None
+        serialized = (current, game.serialize())
+        self.__serialized__[gameNr] = serialized
+        return serialized[1]
+
+    def _payload(self, event, gameNr, values):
+        """
+        Returns the payload of a message of event about the game indicated by gameNr: values, and the serialized game 
+        at the time of the dispatch as "game".
+        The game is only serialized when a subscriber reads "game" (see lib.pubsub.LazyPayload). "game" is None 
+        when it is read after the game has changed nevertheless (by a subscriber, or after the dispatch).
+        With a delivery that handles the message later (not lib.pubsub.SyncDelivery), the server serializes the game 
+        for the messages that are not handled yet before it changes the game itself (see _pin). A game that was passed 
+        to updateGame can be changed by its caller without the server knowing, so it is serialized now, 
+        if the message has subscribers.
+        """
+        game = self.__games__[gameNr]
+        version = (game.getOrigin(), game.getVersion())
+        payload = LazyPayload(values, game=functools.partial(self._serialize, gameNr, version, game))
+        if not isinstance(MessageQueue.getDelivery(), SyncDelivery) and self.get_subscribers(event):
+            if gameNr in self.__external__:
+                payload["game"] = self._serialize(gameNr)
+            else:
+                pending = [ref for ref in self.__pending__.get(gameNr, []) if ref() != None]
+                pending.append(weakref.ref(payload))
+                self.__pending__[gameNr] = pending
+        return payload
+
+    def _pin(self, gameNr):
+        """
+        Serializes the game indicated by gameNr for the payloads of the messages that may not be handled yet 
+        (see _payload), before the server changes the game in place.
+        """
+        for ref in self.__pending__.pop(gameNr, []):
+            payload = ref()
+            if payload != None:
+                payload.get("game")
+
+    def _snapshot(self, gameNr):
+        self.__patchCounts__[gameNr] = 0
+        return {"op": "snapshot", "gamenr": gameNr, "game": self._serialize(gameNr)}
+
+    def _journal(self, gameNr, patch=None):
+        """
+        Records a change of the game indicated by gameNr in the journal, if the server has one: 
+        the patch with the change, or a snapshot when there is no patch or when enough patches were journaled
+        """
+        if self.__journal__ != None:
+            if patch != None and self.__patchCounts__.get(gameNr, 0) < LocalGameServer.SNAPSHOTINTERVAL:
+                self.__patchCounts__[gameNr] = self.__patchCounts__.get(gameNr, 0) + 1
+                self.__journal__.append({"op": "patch", "gamenr": gameNr, "patch": patch})
+            else:
+                self.__journal__.append(self._snapshot(gameNr))
+
+    def syncJournal(self):
+        """
+        Makes all changes in the journal durable, see journal.Journal.sync
+        """
+        if self.__journal__ != None:
+            self.__journal__.sync()
+
+    def close(self):
+        """
+        Syncs and closes the journal
+        """
+        if self.__journal__ != None:
+            self.__journal__.close()
 
     def newGame(self, players):
         """
@@ -106,7 +234,7 @@ class LocalGameServer(GameServer):
         g = model.Game(players)
         self._addGame(g)
         gameNr = g.getGameNr()
-        self.dispatch("msg_new_game", {"id": self.__games__[gameNr].getId(), "gamenr": gameNr, "game": self.__games__[gameNr].serialize()})
+        self.dispatch("msg_new_game", self._payload("msg_new_game", gameNr, {"id": g.getId(), "gamenr": gameNr}))
         return gameNr
 
     def _addGame(self, game):
@@ -118,7 +246,26 @@ class LocalGameServer(GameServer):
         gameNr = self.__nextGameNr__
         game.setGameNr(gameNr)
         self.__games__[gameNr] = game
+        self.__versions__[gameNr] = (game.getOrigin(), game.getVersion())
         self.__nextGameNr__ += 1
+        self._journal(gameNr)
+
+    def _dispatchUpdate(self, gameNr):
+        """
+        Dispatches message "msg_game_updated" for the game indicated by gameNr. 
+        The payload contains a patch with the changes since the previous update (see ModelObject.getPatch),
+        or the complete serialized game when the game is not a continuation of the previously dispatched game.
+        """
+        game = self.__games__[gameNr]
+        origin, version = self.__versions__[gameNr]
+        payload = {"id": game.getId(), "gamenr": gameNr, "moves": game.getMoves()}
+        if game.getOrigin() == origin and game.getVersion() >= version:
+            payload["patch"] = game.getPatch(version)
+        else:
+            payload = self._payload("msg_game_updated", gameNr, payload)
+        self.__versions__[gameNr] = (game.getOrigin(), game.getVersion())
+        self._journal(gameNr, payload.get("patch"))
+        self.dispatch("msg_game_updated", payload)
 
     def getGame(self, gameNr):
         """
@@ -151,7 +298,7 @@ class LocalGameServer(GameServer):
         """
         g = self.getGame(gameNr)
         g.addPlayerByName(name)
-        self.updateGame(g)
+        self._setGame(g)
         del g
 
     def updateGame(self, game):
@@ -161,10 +308,26 @@ class LocalGameServer(GameServer):
         Parameters:
         - game: an instance of model.Game
          """
+        log.debug("--------------", function=self.updateGame, args=game.getGameNr())
+        self._setGame(game, True)
+
+    def _setGame(self, game, external=False):
+        """
+        Replaces the game with the number of game by game, and dispatches the update.
+        Parameters:
+        - game: an instance of model.Game
+        - external: True when the caller keeps game, and may change it, False when only the server has game
+        """
         gameNr = game.getGameNr()
-        log.debug("--------------", function=self.updateGame, args=gameNr)
+        if self.__games__.get(gameNr) is not game:
+            # the server does not change the replaced game, so the messages about it can serialize it when they are handled
+            self.__pending__.pop(gameNr, None)
+        if external:
+            self.__external__.add(gameNr)
+        else:
+            self.__external__.discard(gameNr)
         self.__games__[gameNr] = game
-        self.dispatch("msg_game_updated", {"id": game.getId(), "gamenr": gameNr, "game": game.serialize(), "moves": game.getMoves()})
+        self._dispatchUpdate(gameNr)
 
     def startGame(self, gameNr):
         """
@@ -175,42 +338,49 @@ class LocalGameServer(GameServer):
         """
         assert gameNr in self.__games__
         log.debug(function=self.startGame, args=gameNr)
+        self._pin(gameNr)
         self.__games__[gameNr].start()
-        self.dispatch("msg_game_updated", {"id": self.__games__[gameNr].getId(), "gamenr": gameNr, "game": self.__games__[gameNr].serialize(), "moves": self.__games__[gameNr].getMoves()})
+        self._dispatchUpdate(gameNr)
 
-    def saveGame(self, gameNr, path):
+    def saveGame(self, gameNr, path, binary=True):
         """
-        Saves a game in JSON-format to the indicated path. 
+        Saves a game to the indicated path, in the binary format (see gameformat) or in JSON-format. 
         Parameters:
         - gameNr: the number of the game that must be saved
         - path: the full pathname of the file that is created (or overwritten)
+        - binary: True for the binary format, False for JSON
         """
         assert gameNr in self.__games__
-        log.debug(function=self.saveGame, args=gameNr)
+        log.debug(function=self.saveGame, args=(gameNr, binary))
         g = self.__games__[gameNr]
-        saved = json.dumps(g.serialize())
-        f=open(path,"w")
+        if binary:
+            saved = gameformat.encode(g)
+        else:
+            saved = json.dumps(g.serialize()).encode("utf-8")
+        f=open(path,"wb")
         f.write(saved)
         f.close()
         log.trace("game saved to:", path)
 
     def loadGame(self, path):
         """
-        Loads a game from a JSON-formatted file. After succesful loading, the game gets the next available game number.
+        Loads a game from a file in the binary format or in JSON-format, the format is determined from the contents of the file. 
+        After succesful loading, the game gets the next available game number.
         Message "msg_game_loaded" will be dispatched so that listening subscribers can handle the update
         Parameters:
         - path: the full pathname of the file that is created (or overwritten)
         """
         log.debug(function=self.loadGame, args=path)
-        f=open(path,"r")
-        saved = f.readline()
+        f=open(path,"rb")
+        saved = f.read()
         f.close()
         if saved:
-            g = model.Game()
-            data = json.loads(saved)
-            g.deserialize(data)
+            if gameformat.isBinary(saved):
+                g = gameformat.decode(saved)
+            else:
+                g = model.Game.fromData(json.loads(saved.decode("utf-8").splitlines()[0]))
             self._addGame(g)
-            self.dispatch("msg_game_loaded", {"id": g.getId(), "gamenr": g.getGameNr(), "game": data})
+            self.dispatch("msg_game_loaded", self._payload("msg_game_loaded", g.getGameNr(), {"id": g.getId(), "gamenr": g.getGameNr()}))
             #g.print()
             return g.getGameNr()
 
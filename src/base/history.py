@@ -0,0 +1,130 @@
+import sys
+from collections import deque
+from lib import log
+
+class StateHistory:
+    """
+    The last states of a game, as serialized by Game.serialize, each with the origin and version of the game
+    at which it was taken (see ModelObject.getVersion).
+    Consecutive states share structure: a value or element (the serialized data of an object) that equals
+    the corresponding one of the previous state is not stored again, the one of the previous state is referenced instead.
+    The states must therefore not be modified.
+    At most maxStates states are kept. When maxBytes is set, the oldest states are also dropped to keep
+    the (approximate) memory usage of the history below maxBytes, the last state is always kept.
+    """
+    def __init__(self, maxStates=16, maxBytes=None):
+        self.__maxStates = maxStates
+        self.__maxBytes = maxBytes
+        self.__states = deque()     #tuples (data, origin, version), the last state at the right
+        self.__sizes = deque()      #the bytes of each state that are not shared with the previous state
+        self.__bytes = 0
+
+    def push(self, data, origin=None, version=None):
+        """
+        Adds a state.
+        Parameters:
+        - data: the serialized game
+        - origin, version: the origin and version of the game that data was serialized from
+        """
+        previous = self.__states[-1][0] if self.__states else None
+        data, size = StateHistory.share(data, previous)
+        self.__states.append((data, origin, version))
+        self.__sizes.append(size)
+        self.__bytes += size
+        while len(self.__states) > self.__maxStates or (self.__maxBytes != None and self.__bytes > self.__maxBytes and len(self.__states) > 1):
+            self.__dropOldest()
+        log.debug(function=self.push, args=(version, len(self.__states), self.__bytes))
+
+    def __dropOldest(self):
+        self.__states.popleft()
+        self.__bytes -= self.__sizes.popleft()
+        if self.__states:
+            # the values that the new oldest state shared with the dropped state are now only referenced by the remaining states
+            self.__bytes -= self.__sizes[0]
+            self.__sizes[0] = StateHistory.share(self.__states[0][0], None)[1]
+            self.__bytes += self.__sizes[0]
+
+    def getLast(self):
+        """
+        Returns: the last state, a tuple (data, origin, version), or None if the history is empty
+        """
+        return self.__states[-1] if self.__states else None
+
+    def get(self, steps=0):
+        """
+        Returns: the state steps states before the last state, a tuple (data, origin, version),
+        or None if the history does not go back that far
+        """
+        if steps < len(self.__states):
+            return self.__states[-1-steps]
+        return None
+
+    def undo(self, steps=1):
+        """
+        Drops the last steps states, but never the oldest state.
+        Returns: the state that is then the last state, see getLast
+        """
+        for i in range(min(steps, len(self.__states)-1)):
+            self.__states.pop()
+            self.__bytes -= self.__sizes.pop()
+        return self.getLast()
+
+    def rebase(self, origin, version):
+        """
+        Relates the last state to another game, with origin, at version. For example, to the game that was created from it.
+        """
+        if self.__states:
+            self.__states[-1] = (self.__states[-1][0], origin, version)
+
+    def getSize(self):
+        return len(self.__states)
+
+    def getMemoryUsage(self):
+        """
+        Returns: the approximate number of bytes used by the states, counting the shared values once
+        """
+        return self.__bytes
+
+    def share(data, previous):
+        """
+        Returns: a tuple (shared, size), where shared equals data, but refers to the values and elements of previous
+        (a serialized object) where they are equal, and size is the number of bytes of the values that are not shared
+        """
+        if previous == None or not isinstance(previous, dict) or data.get("type") != previous.get("type"):
+            return (data, StateHistory.sizeOf(data))
+        shared = {}
+        size = sys.getsizeof(shared)
+        for key, value in data.items():
+            old = previous.get(key)
+            if key == "elements" and old != None:
+                elements = []
+                for i, e in enumerate(value):
+                    e, s = StateHistory.share(e, old[i] if i < len(old) else None)
+                    elements.append(e)
+                    size += s
+                if len(elements) == len(old) and all(e is o for e, o in zip(elements, old)):
+                    elements = old
+                else:
+                    size += sys.getsizeof(elements)
+                shared[key] = elements
+            elif old is value or (key in previous and old == value):
+                shared[key] = old
+            else:
+                shared[key] = value
+                size += StateHistory.sizeOf(value)
+        if len(shared) == len(previous) and all(key in previous and shared[key] is previous[key] for key in shared):
+            return (previous, 0)
+        return (shared, size)
+
+    def sizeOf(value):
+        """
+        Returns: the approximate number of bytes of value, including the values it contains
+        """
+        size = sys.getsizeof(value)
+        if isinstance(value, dict):
+            for k, v in value.items():
+                size += StateHistory.sizeOf(v)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                size += StateHistory.sizeOf(v)
+        return size
@@ -0,0 +1,106 @@
+"""
+An append-only journal of the changes of the games of a LocalGameServer, so that the games survive a restart of the server.
+
+The journal is a file with a JSON record per line. There are two kinds of records:
+- {"op": "snapshot", "gamenr": gameNr, "game": data}: the complete state of a game, as serialized by Game.serialize
+- {"op": "patch", "gamenr": gameNr, "patch": patch}: the changes of a game since its previous record (see ModelObject.getPatch)
+A game is rebuilt by loading its last snapshot and applying the patches that follow it, in order (see replay).
+
+Records are written to the file immediately (a reader of the file sees them), but synced to disk in groups: 
+after SYNCCOUNT records, or SYNCINTERVAL seconds after the first record that is not synced yet (by a timer, 
+so also when no record follows), or on an explicit sync.
+So a crash loses at most the records of the last SYNCINTERVAL seconds, instead of costing an fsync per record.
+"""
+import os
+import json
+import threading
+from lib import log
+
+SYNCCOUNT = 32
+SYNCINTERVAL = 0.05
+
+class Journal:
+    def __init__(self, path, syncCount=SYNCCOUNT, syncInterval=SYNCINTERVAL):
+        self.__path = path
+        self.__file = None
+        self.__syncCount = syncCount
+        self.__syncInterval = syncInterval
+        self.__pending = 0      #the number of records written since the last sync
+        self.__timer = None     #the timer that syncs the pending records when the interval has passed
+        self.__lock = threading.RLock()
+        self.syncs = 0          #the number of syncs, for instrumentation
+
+    def getPath(self):
+        return self.__path
+
+    def read(self):
+        """
+        Returns: a list of the records in the journal, an empty list if the journal does not exist yet.
+        An incomplete last record, which is what a crash while writing leaves behind, is ignored.
+        """
+        records = []
+        if os.path.exists(self.__path):
+            with open(self.__path, "rb") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        log.warning("incomplete record in journal", self.__path)
+                        break
+        return records
+
+    def open(self):
+        if self.__file == None:
+            self.__file = open(self.__path, "ab")
+
+    def append(self, record):
+        """
+        Writes record (a dict) to the journal, and syncs the journal if a group of records is complete. 
+        Otherwise the record is synced when the interval has passed, if no sync happens before that.
+        """
+        with self.__lock:
+            self.open()
+            self.__file.write(json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n")
+            self.__file.flush()
+            self.__pending += 1
+            if self.__pending >= self.__syncCount:
+                self.sync()
+            elif self.__timer == None:
+                self.__timer = threading.Timer(self.__syncInterval, self.sync)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+    def sync(self):
+        """
+        Makes the records written so far durable, with a single fsync
+        """
+        with self.__lock:
+            if self.__timer != None:
+                self.__timer.cancel()
+                self.__timer = None
+            if self.__file != None and self.__pending:
+                os.fsync(self.__file.fileno())
+                self.syncs += 1
+            self.__pending = 0
+
+    def rewrite(self, records):
+        """
+        Replaces the contents of the journal by records, for example by a snapshot of every game (see LocalGameServer).
+        The new journal is written next to the old one and then replaces it, so a crash leaves either of them intact.
+        """
+        log.debug(function=self.rewrite, args=(self.__path, len(records)))
+        self.close()
+        tmpPath = self.__path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.__path)
+
+    def close(self):
+        with self.__lock:
+            if self.__file != None:
+                self.sync()
+                self.__file.close()
+                self.__file = None
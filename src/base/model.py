@@ -4,8 +4,10 @@ from lib import log, util
 from lib.pubsub import Publisher
 from .modelobject import ModelObject
 from .gameserver import GameServer
+from .history import StateHistory
+from .undo import UndoStack
 from .gameconstants import GameConstants
-from .tile import TileFactory, Tile, Joker
+from .tile import TileRegistry, Tile, Joker
 from .tilecontainer import TileContainer, Set, Pile, Board, Plate
 
 class Player(ModelObject):
@@ -41,25 +43,30 @@ class Player(ModelObject):
         log.trace(self.toString())
 
 class Game(ModelObject):
-    def __init__(self, maxPlayers=4):
+    TILESPERPLAYER = 14
+    def __init__(self, maxPlayers=4, seed=None, createTiles=True):
         super().__init__()
-        TileFactory.init() 
+        self.setTileRegistry(TileRegistry())
+        self.setUndoStack(UndoStack())
         self._players = []
         self.board = Board(self)
-        self.pile = Pile(self)
+        self.pile = Pile(self, createTiles)
         self.__maxPlayers = maxPlayers
         self.__currentPlayer = None
         self.__currentPlayerNr = None
         self.__gameNr = None
         self.__moves = 0
+        self.__seed = seed if seed!=None else random.randrange(1 << 32)  #the seed for shuffling the pile
         self.persist("maxPlayers")
         self.persist("currentPlayer")
         self.persist("currentPlayerNr")
         self.persist("gameNr")
         self.persist("moves")
+        self.persist("seed")
         
     def reset(self):
-        TileFactory.init() 
+        self.setTileRegistry(TileRegistry())
+        self.setUndoStack(UndoStack())
         self._players = []
         self.board = Board(self)
         self.pile = Pile(self)
@@ -85,6 +92,13 @@ class Game(ModelObject):
         self.__moves = moves
         self.setModified()
 
+    def setSeed(self, seed):
+        self.__seed = seed
+        self.setModified()
+
+    def getSeed(self):
+        return self.__seed
+
     def getGameNr(self):
         return self.__gameNr
 
@@ -118,13 +132,19 @@ class Game(ModelObject):
                 self._players.append(Player(self, name))
                 self.setModified()
 
+    def removeChild(self, childObject):
+        super().removeChild(childObject)
+        if childObject in self._players:
+            self._players.remove(childObject)
+
     def start(self):
         log.trace(function=self.start)
-        for p in self._players:
-            for i in range(14):
-                p.pickTile()
-        self.__currentPlayerNr = 0
-        self.__moves = 0
+        with self.batch():
+            self.pile.shuffle(self.__seed)
+            self.pile.deal(self._players, Game.TILESPERPLAYER)
+            self.setCurrentPlayerNr(0)
+            self.setMoves(0)
+            self.resetUndoStack()
 
     def getPlayerByName(self, name):
         log.debug(function=self.getPlayerByName, args=(self.getFullId(), name, len(self._players)))
@@ -153,6 +173,8 @@ class Game(ModelObject):
         if p>=len(self._players): p = 0
         self.setCurrentPlayerNr(p)
         self.incMoves()
+        # a new turn, the moves of the previous turn can no longer be undone
+        self.resetUndoStack()
     
     def validate(self):
         return self.board.validateSets()==0
@@ -173,15 +195,59 @@ class Game(ModelObject):
             self.nextTurn()
 
     def deserialize(self, data):
-        self._players = []
-        super().deserialize(data)
+        with self.batch():
+            self._players = []
+            super().deserialize(data)
+            self.resetUndoStack()
+
+    def fromData(data):
+        """
+        Returns: a new Game with the state in data (a serialized game, see serialize).
+        This replaces creating a Game and deserializing data into it: the tiles are created without a container, 
+        and are then put directly in the containers that data puts them in (see TileContainer.setTiles), 
+        instead of first being added to the pile and then moved to their containers one by one.
+        """
+        log.debug(function=Game.fromData)
+        game = Game(data.get("maxPlayers", 4), data.get("seed"), False)
+        table = Pile.getTileTable()
+        pileData = [e for e in game.getDataElements(data) or [] if e["type"] == "Pile"]
+        nextId = pileData[0].get("nextId", len(table)) if pileData else len(table)
+        game.getTileRegistry().createTiles(table[:nextId], None)
+        game.deserialize(data)
+        return game
 
     def clone(self):
+        """
+        Returns: a copy of this game. 
+        The copy is made structurally: the containers of the copy are created without tiles, and then get a copy of 
+        the tile ids of the corresponding container in this game. The faces of the tiles are shared with this game. 
+        This avoids replaying every tile move, which is what deserializing the game would do.
+        """
         log.debug(function=self.clone, args=self.getFullId())
-        clonedGame = Game()
-        data = self.serialize()
-        clonedGame.deserialize(data)
-        #log.debug("\n\noriginal = " + str(data) + "\n\nclone = " + str(clonedGame.serialize()))
+        clonedGame = Game(self.__maxPlayers, self.__seed, False)
+        clonedGame.__currentPlayer = self.__currentPlayer
+        clonedGame.__currentPlayerNr = self.__currentPlayerNr
+        clonedGame.__gameNr = self.__gameNr
+        clonedGame.__moves = self.__moves
+        containers = {self.board: clonedGame.board, self.pile: clonedGame.pile}
+        objects = {self: clonedGame}
+        for player in self._players:
+            clonedPlayer = Player(clonedGame, player.getName())
+            clonedGame._players.append(clonedPlayer)
+            containers[player.plate] = clonedPlayer.plate
+            objects[player] = clonedPlayer
+        # all children of the board, including the sets that were removed from it, so that the children correspond
+        for set in self.board.getChildren():
+            containers[set] = clonedGame.board.addSet()
+        clonedGame.getTileRegistry().copyFrom(self.getTileRegistry(), containers)
+        for container, clonedContainer in containers.items():
+            clonedContainer.copyTilesFrom(container)
+        # the clone continues the versions of this game (see ModelObject.getPatch)
+        objects.update(containers)
+        for obj, clonedObj in objects.items():
+            clonedObj.copyVersionFrom(obj)
+        # the moves of this game can not be undone in the clone
+        clonedGame.resetUndoStack()
         return clonedGame
 
     def toString(self):
@@ -217,6 +283,9 @@ class AbstractModel():
     def revertGame(self):
         pass
 
+    def undoMove(self):
+        pass
+
     def loadGame(self, data):
         pass
 
@@ -237,16 +306,33 @@ class AbstractModel():
 
 class Model(AbstractModel, Publisher):
     EVENTS = ["msg_new_game", "msg_new_player", "msg_game_loaded", "msg_game_reverted", "msg_game_committed"]
-    def __init__(self, game=None):
+    def __init__(self, game=None, history=None):
+        """
+        Parameters:
+        - game: the current game, an instance of Game
+        - history: the instance of StateHistory that keeps the valid states of the game, see rememberState
+        """
         self.currentGame = game
-        self.lastValidState = None
+        self.history = history if history != None else StateHistory()
         Publisher.__init__(self, Model.EVENTS)
 
     def rememberState(self, data=None):
+        """
+        Adds the state of the current game to the history of valid states, data is the serialized current game, if provided
+        """
         if not data: 
             data = self.currentGame.serialize()
-        self.lastValidState = data
-        #log.debug("lastValidState =", self.lastValidState, function=self.rememberState)
+        self.history.push(data, self.currentGame.getOrigin(), self.currentGame.getVersion())
+
+    def getHistory(self):
+        return self.history
+
+    def getLastValidState(self):
+        """
+        Returns: the serialized game of the last valid state, or None if there is none
+        """
+        state = self.history.getLast()
+        return state[0] if state else None
 
     def newGame(self, n):
         log.trace(function=self.newGame, args=n)
@@ -278,30 +364,69 @@ class Model(AbstractModel, Publisher):
         log.trace(function=self.commitGame, args=serializedGame)
         if self.currentGame:
             del self.currentGame
-        self.currentGame = Game()
-        self.currentGame.deserialize(serializedGame)
+        self.currentGame = Game.fromData(serializedGame)
         self.rememberState(serializedGame)
         self.dispatch("msg_game_committed", {"game": self.currentGame})
 
-    def revertGame(self):
-        if self.lastValidState:
-            log.trace(function=self.revertGame)
-            if self.currentGame:
-                del self.currentGame
-            self.currentGame = Game()
-            self.currentGame.deserialize(self.lastValidState)
-            self.dispatch("msg_game_reverted", {"game": self.currentGame})
+    def revertGame(self, steps=0):
+        """
+        Reverts the current game to the last valid state, or to the state steps states before that 
+        (the states after it are dropped from the history). 
+        When the moves since the last valid state were all recorded (see undo.UndoStack), they are undone in place.
+        Otherwise, the current game is restored in place when it is a continuation of the state (see ModelObject.restore), 
+        or else it is replaced by a new game.
+        Message "msg_game_reverted" is dispatched, its payload has "inplace": True when the current game was reverted in place.
+        """
+        state = self.history.undo(steps) if steps else self.history.getLast()
+        if state:
+            log.trace(function=self.revertGame, args=steps)
+            data, origin, version = state
+            game = self.currentGame
+            stack = game.getUndoStack() if game else None
+            inplace = True
+            if stack != None and stack.getBase() == (origin, version):
+                with game.batch():
+                    stack.undoAll()
+            elif not (game and game.restore(data, origin, version)):
+                if self.currentGame:
+                    del self.currentGame
+                self.currentGame = Game.fromData(data)
+                inplace = False
+            # the state now relates to the current version of the current game
+            self.currentGame.resetUndoStack()
+            self.history.rebase(self.currentGame.getOrigin(), self.currentGame.getVersion())
+            self.dispatch("msg_game_reverted", {"game": self.currentGame, "inplace": inplace})
+
+    def undoMove(self):
+        """
+        Undoes the last move of the current turn (see undo.UndoStack)
+        Returns: False if there is no move to undo
+        """
+        log.trace(function=self.undoMove)
+        stack = self.currentGame.getUndoStack() if self.currentGame else None
+        return stack != None and stack.undo()
 
     def loadGame(self, data):
         log.trace(function=self.loadGame)
         log.debug(function=self.loadGame, args=data)
         if self.currentGame:
             del self.currentGame
-        self.currentGame = Game()
-        self.currentGame.deserialize(data)
+        self.currentGame = Game.fromData(data)
         self.rememberState(data)
         self.dispatch("msg_game_loaded", {"game": self.currentGame})
 
+    def patchGame(self, patch):
+        """
+        Applies patch (see ModelObject.getPatch) to the current game in place.
+        Returns: True if the patch was applied, False if the current game is not at the version the patch is based on
+        """
+        log.trace(function=self.patchGame)
+        if self.currentGame and self.currentGame.applyPatch(patch):
+            self.rememberState()
+            self.dispatch("msg_game_loaded", {"game": self.currentGame})
+            return True
+        return False
+
     def addPlayer(self, name):
         log.trace(function=self.addPlayer, args=name)
         if self.currentGame:
@@ -361,6 +486,20 @@ class SynchronizingModel(Model):
         gameId = cg.getId()
         log.debug(function=self.onMsgGameUpdated, args=(gameId, payload["id"], cpName, cg.getMoves(), payload["moves"]))
         if gameId != payload["id"] and cg.getGameNr() == payload["gamenr"]:
-            self.loadGame(payload["game"])
+            # a complete game, or a patch that the current game is out of sync with: get the game from the server
+            if "game" in payload or not self.patchGame(payload["patch"]):
+                self.resyncGame(payload["gamenr"])
+
+    def resyncGame(self, gameNr):
+        """
+        Replaces the current game by a clone of the game indicated by gameNr on the server. The clone keeps the origin 
+        and version of the game on the server (see Game.clone), so the updates that follow are applied as patches again.
+        """
+        log.trace(function=self.resyncGame, args=gameNr)
+        if self.currentGame:
+            del self.currentGame
+        self.currentGame = self.gs.getGame(gameNr)
+        self.rememberState()
+        self.dispatch("msg_game_loaded", {"game": self.currentGame})
 
 
@@ -1,14 +1,16 @@
 from lib import log
-from lib.pubsub import Publisher
+from lib.pubsub import TopicRouter
 from .persistentobject import PersistentObject
 
-class ModelObject(PersistentObject, Publisher):
+class ModelObject(PersistentObject):
     EVENTS = ["msg_object_modified", "msg_new_child"]
     """
     This is the base class for all the other model classes. It implements the object 
     hierarchy and the model modification status. 
     extends PersistentObject to enable instance of ModelObject to serialize/deserialize their internal state
-    extends Publisher to allow Subscriber instances to be notified about the modification state.  
+    Subscribers are notified about the modification state through the TopicRouter of the tree (see getRouter),
+    in which the topic of an object is its path from the root (see getTopic). An object publishes its events 
+    on its own topic only, a subscriber to an object and its descendants subscribes to the tree of the object (see subscribeTree).
     """
     __lastId__ = 0
     def nextId():
@@ -18,29 +20,169 @@ class ModelObject(PersistentObject, Publisher):
 
     def __init__(self, parent=None):
         PersistentObject.__init__(self)
-        Publisher.__init__(self, ModelObject.EVENTS)
         self.__modified__ = False
         self.__children__ = {}
         self.__parent__ = None
+        self.__tileRegistry__ = None
+        self.__undoStack__ = None
+        self.__batch__ = None   #the objects modified in the current batch of the tree, only maintained by the root (see batch)
+        self.__batchDepth__ = 0
         self.__objectId__ = ModelObject.nextId()
+        self.__version__ = 0    #the number of modifications of the tree, only maintained by the root (see setModified)
+        self.__origin__ = self.__objectId__ #identifies the tree that the versions of the root relate to
+        self.__stamp__ = 0      #the version of the tree at which this object was last modified
+        self.__router__ = None  #the router of the events of the tree, only maintained by the root (see getRouter)
+        self.__topic__ = (self.getType() + str(self.__objectId__),)   #the path of ids from the root, the last one is the id of this object
         if parent:
             assert isinstance(parent, ModelObject)
             self.__parent__ = parent
+            self.__topic__ = parent.__topic__ + self.__topic__
+            self.__stampVersion()
             parent.addChild(self)
 
-    def __del__(self):
-        #log.trace(function=self.__del__, args=self.getFullId())
-        self._reset()
-
     def _reset(self):
         for c in self.getChildren():
             del c
         self.__modified__ = False
         self.__children__ = {}
 
+    def __stampVersion(self):
+        root = self.getRoot()
+        root.__version__ += 1
+        self.__stamp__ = root.__version__
+        return root
+
     def setModified(self):
         self.__modified__ = True
-        self.dispatch("msg_object_modified", {"object": self} )
+        root = self.__stampVersion()
+        if self.__parent__:
+            self.__parent__.childModified(self)
+        if root.__batch__ != None:
+            root.__batch__[self] = True
+        elif root.__router__ != None:
+            root.__router__.publish(self.__topic__, "msg_object_modified", {"object": self})
+
+    def getTopic(self):
+        """
+        Returns: the topic of the events of this object, its path from the root, such as "Game1/Board3/Set7"
+        """
+        return "/".join(self.__topic__)
+
+    def getRouter(self):
+        """
+        Returns: the TopicRouter of the tree of this object, which is created when it is first needed
+        """
+        root = self.getRoot()
+        if root.__router__ == None:
+            root.__router__ = TopicRouter()
+        return root.__router__
+
+    def subscribe(self, sub, event, handler=None):
+        """
+        Subscribes sub to event of this object
+        """
+        assert event in ModelObject.EVENTS
+        self.getRouter().subscribe(sub, self.__topic__, event, handler)
+
+    def subscribeTree(self, sub, event, handler=None):
+        """
+        Subscribes sub to event of this object and of its descendants
+        """
+        assert event in ModelObject.EVENTS
+        self.getRouter().subscribe(sub, self.__topic__ + (TopicRouter.REST,), event, handler)
+
+    def unsubscribe(self, event, sub):
+        self.getRouter().unsubscribe(self.__topic__, event, sub)
+
+    def unsubscribeTree(self, event, sub):
+        self.getRouter().unsubscribe(self.__topic__ + (TopicRouter.REST,), event, sub)
+
+    def get_subscribers(self, event):
+        """
+        Returns: a dict with the handler of each live subscriber of event of this object (not of its tree)
+        """
+        return self.getRouter().getSubscribers(self.__topic__, event)
+
+    def dispatch(self, event, payload):
+        """
+        Dispatches event of this object, with payload, see TopicRouter.publish
+        """
+        router = self.getRoot().__router__
+        if router != None:
+            router.publish(self.__topic__, event, payload)
+
+    class Batch:
+        """
+        The context manager returned by ModelObject.batch
+        """
+        def __init__(self, root):
+            self.root = root
+
+        def __enter__(self):
+            if self.root.__batchDepth__ == 0:
+                self.root.__batch__ = {}
+            self.root.__batchDepth__ += 1
+            return self.root
+
+        def __exit__(self, excType, excValue, traceback):
+            self.root.__batchDepth__ -= 1
+            if self.root.__batchDepth__ == 0:
+                batch = self.root.__batch__
+                self.root.__batch__ = None
+                # without a router nothing is subscribed to the tree, not even since the batch started
+                if self.root.__router__ != None:
+                    ModelObject.dispatchBatch(batch)
+            return False
+
+    def batch(self):
+        """
+        Returns a context manager that batches the modification messages of the tree of this object:
+            with game.batch():
+                ...
+        Within the batch, setModified does not dispatch "msg_object_modified". When the (outermost) batch ends, 
+        the message is dispatched once for every object that was modified, or that has modified descendants, 
+        with the payload {"object": object, "children": [the modified children of object]}.
+        When only descendants of the object were modified, the payload also has "modified": True.
+        A subscriber to the tree of an object (see subscribeTree) gets the message of every object in that tree.
+        The versions (see getVersion) and childModified are maintained within a batch as usual.
+        The batch only records the modified objects, the messages of their ancestors are collected when it ends.
+        """
+        return ModelObject.Batch(self.getRoot())
+
+    def __addToBatch(self, batch):
+        entry = batch.get(self)
+        if entry == None:
+            entry = batch[self] = [False, {}]
+        entry[0] = True
+        child, parent = self, self.__parent__
+        while parent:
+            entry = batch.get(parent)
+            if entry == None:
+                entry = batch[parent] = [False, {}]
+            if child in entry[1]:
+                break   #the ancestors of parent already have the modification
+            entry[1][child] = True
+            child, parent = parent, parent.__parent__
+
+    def dispatchBatch(batch):
+        """
+        Dispatches "msg_object_modified" for the objects in batch (a dict of the modified objects), see batch
+        """
+        entries = {}
+        for obj in batch:
+            obj.__addToBatch(entries)
+        for obj, (modified, children) in entries.items():
+            payload = {"object": obj, "children": list(children)}
+            if not modified:
+                payload["modified"] = True
+            obj.dispatch("msg_object_modified", payload)
+
+    def childModified(self, child):
+        """
+        Invoked (synchronously) on the parent when child is marked as modified. 
+        Does nothing by default, extending classes can override this to keep track of modified children.
+        """
+        pass
 
     def clearModified(self, recursive=False):
         self.__modified__ = False
@@ -51,22 +193,82 @@ class ModelObject(PersistentObject, Publisher):
 
     def getParent(self):
         return self.__parent__
+
+    def getRoot(self):
+        root = self
+        while root.__parent__:
+            root = root.__parent__
+        return root
+
+    def getTileRegistry(self):
+        """
+        Returns the registry of the tiles in the object tree that this object belongs to (see tile.TileRegistry),
+        or None if the tree does not have a registry yet. The registry is held by the root of the tree, normally a Game.
+        """
+        return self.getRoot().__tileRegistry__
+
+    def setTileRegistry(self, registry):
+        assert self.__parent__ == None
+        self.__tileRegistry__ = registry
     
+    def getUndoStack(self):
+        """
+        Returns the stack of the moves that can be undone (see undo.UndoStack) of the object tree that this object belongs to,
+        or None if the tree does not record its moves. Like the tile registry, the stack is held by the root of the tree.
+        """
+        return self.getRoot().__undoStack__
+
+    def setUndoStack(self, stack):
+        assert self.__parent__ == None
+        self.__undoStack__ = stack
+
+    def resetUndoStack(self):
+        """
+        Clears the stack of moves of the tree of this object, which then relates to the current version of the tree
+        """
+        stack = self.getUndoStack()
+        if stack != None:
+            stack.clear((self.getOrigin(), self.getVersion()))
+
+    def getVersion(self):
+        """
+        Returns: the version of the tree that this object belongs to, which is incremented whenever an object in the tree is modified
+        """
+        return self.getRoot().__version__
+
+    def getOrigin(self):
+        """
+        Returns: the origin of the versions of the tree that this object belongs to. 
+        Versions of trees with a different origin are unrelated (see Game.clone, which keeps the origin).
+        """
+        return self.getRoot().__origin__
+
+    def getStamp(self):
+        """
+        Returns: the version at which this object was last modified
+        """
+        return self.__stamp__
+
+    def copyVersionFrom(self, source):
+        """
+        Gives this object the stamp of source, and if this object is a root, also the version and origin of the tree of source
+        """
+        self.__stamp__ = source.__stamp__
+        if self.__parent__ == None:
+            self.__version__ = source.getVersion()
+            self.__origin__ = source.getOrigin()
+
     def isValidChild(self, child):
         valid = False
         if child and isinstance(child, ModelObject):
-            valid = child in self.__children__.values() and child.getParent() == self
+            valid = self.__children__.get(child.__topic__[-1]) is child and child.__parent__ is self
         return valid
 
     def getFullId(self):
-        result = self.getId()
-        p = self.getParent()
-        if p!=None and isinstance(p, ModelObject):
-            result = p.getFullId() + "/" + result
-        return result
+        return self.getTopic()
 
     def getId(self):
-        return self.getType() + str(self.__objectId__)
+        return self.__topic__[-1]
 
     def getChildren(self):
         if not self.__children__: self.__children = []
@@ -78,11 +280,17 @@ class ModelObject(PersistentObject, Publisher):
         self.__children__[childObject.getId()] = childObject
         assert self.isValidChild(childObject) == True
         self.dispatch("msg_new_child", {"object": self, "child": childObject})
-        childObject.subscribe(self, "msg_object_modified", self.onMsgChildObjectModified)
         self.setModified()
 
-    def onMsgChildObjectModified(self, payload):
-        self.dispatch("msg_object_modified", {"object": self, "modified": payload})
+    def removeChild(self, childObject):
+        """
+        Removes childObject, which must be the last child of this object, so that the indexes of the other children 
+        (see getPatch) do not change. Used by restore, for the children that were created since the restored version.
+        """
+        log.debug(function=self.removeChild, args=childObject.getFullId())
+        assert list(self.__children__)[-1] == childObject.getId()
+        del self.__children__[childObject.getId()]
+        self.setModified()
 
     def isModified(self, recursive=False):
         if not self.__modified__ and recursive:
@@ -103,9 +311,177 @@ class ModelObject(PersistentObject, Publisher):
             modified = modified + c.getModifiedObjects()
         return modified
 
-    def serialize(self):
-        data = PersistentObject.serialize(self)
+    def serialize(self, borrowed=False):
+        """
+        Serializes this object and its children in a single pass, see PersistentObject.serialize
+        """
+        data = PersistentObject.serialize(self, borrowed)
+        if self.__children__:
+            data["elements"] = [c.serialize(borrowed) for c in self.__children__.values()]
+        return data
+
+    def getChild(self, index, elementType=None):
+        """
+        Returns: the child at index (in the order in which the children were added).
+        When index equals the number of children and elementType is provided, a new child is created
+        by the adder method for elementType (for example, addSet for "Set"), as in PersistentObject.deserialize
+        """
+        children = list(self.getChildren())
+        if index < len(children):
+            return children[index]
+        assert index == len(children) and elementType != None
+        return getattr(type(self), "add"+elementType)(self)
+
+    def getPatchData(self, since):
+        """
+        Returns: the data of this object in a patch (see getPatch), by default its serialized persistent attributes.
+        """
+        return self.getData()
+
+    def setPatchData(self, data):
+        self.setDataAttributes(data)
+
+    def getPatch(self, since):
+        """
+        Returns a patch with the objects in the tree of this (root) object that were modified since version since, 
+        and the moves of the tiles since that version. The format of a patch is:
+        {"type": "Patch", "origin": origin, "base": since, "version": version, 
+         "elements": [{"path": path, "data": data}, ...], "tiles": [[tile id, path of container, path of plate], ...]}
+        A path is the list of the indexes of the children that lead from the root to an object. 
+        The moves of the tiles are in the order in which they were made.
+        """
+        assert self.__parent__ == None
+        elements = []
+        paths = {}
+        self.__addPatchElements(elements, paths, since, [])
+        patch = {"type": "Patch", "origin": self.__origin__, "base": since, "version": self.__version__, "elements": elements, "tiles": []}
+        registry = self.getTileRegistry()
+        if registry:
+            for tId, container, plate in registry.getMoves(since):
+                patch["tiles"].append([tId, paths[container], paths.get(plate)])
+        return patch
+
+    def __addPatchElements(self, elements, paths, since, path):
+        paths[self] = path
+        if self.__stamp__ > since:
+            elements.append({"path": path, "data": self.getPatchData(since)})
+        for i, c in enumerate(self.getChildren()):
+            c.__addPatchElements(elements, paths, since, path+[i])
+
+    def applyPatch(self, patch):
+        """
+        Applies a patch (see getPatch) in place to the tree of this (root) object.
+        Returns: True if the patch was applied, False if this tree is not at the version the patch is based on, 
+        in which case nothing is changed
+        """
+        assert self.__parent__ == None
+        log.debug(function=self.applyPatch, args=(patch["base"], patch["version"]))
+        if patch["origin"] != self.__origin__ or patch["base"] != self.__version__:
+            return False
+        with self.batch():
+            # first get (or create) the patched objects, so that the data of an object can refer to its new children
+            objects = []
+            for e in patch["elements"]:
+                objects.append(self.getByPath(e["path"], self.getDataType(e["data"])))
+            for obj, e in zip(objects, patch["elements"]):
+                obj.setPatchData(e["data"])
+            registry = self.getTileRegistry()
+            for tId, containerPath, platePath in patch["tiles"]:
+                tile = registry.getById(tId)
+                self.getByPath(containerPath).placeTile(tile)
+                registry.plates[tId] = self.getByPath(platePath) if platePath != None else None
+            # the tree is now at the version of the patch
+            version = patch["version"]
+            self.__restamp(patch["base"], version)
+            self.__version__ = version
+            if registry:
+                registry.restamp(patch["base"], version)
+            self.resetUndoStack()
+        return True
+
+    def __restamp(self, since, version):
+        if self.__stamp__ > since:
+            self.__stamp__ = version
         for c in self.getChildren():
-            childdata = c.serialize()
-            data = self.addNestedElement(data, childdata)
+            c.__restamp(since, version)
+
+    def restore(self, data, origin, version):
+        """
+        Restores the tree of this (root) object in place to data, its serialized state at version (see getVersion).
+        Only the objects that were modified since version are restored, and only the tiles that were moved since version
+        are put back in their containers, so the cost depends on the changes since version, not on the size of the tree.
+        Objects that were created since version are removed, once their tiles are put back.
+        Returns: True if the tree was restored, False if this tree is not a continuation of the state at version 
+        (another origin, or an earlier version), in which case nothing is changed
+        """
+        assert self.__parent__ == None
+        if origin != self.__origin__ or version == None or version > self.__version__:
+            return False
+        log.debug(function=self.restore, args=(version, self.__version__))
+        with self.batch():
+            registry = self.getTileRegistry()
+            moves = registry.getMoves(version) if registry else []
+            if moves:
+                located = {}    #the path of the container of each tile in data
+                ModelObject.locateTiles(data, [], located)
+                targets = {}
+                for tId, container, plate in moves:
+                    target = self.getByPath(located[tId])
+                    if target != container:
+                        target.placeTile(registry.getById(tId))
+                    targets[target] = located[tId]
+                    registry.plates[tId] = None
+                for target, path in targets.items():
+                    target.setTileOrder(ModelObject.getElementData(data, path)["tiles"])
+            modified = []
+            self.__addModified(modified, version, [])
+            restored, created = [], []
+            for obj, path in modified:
+                saved = ModelObject.getElementData(data, path)
+                if saved != None and saved["type"] == obj.getType():
+                    restored.append((obj, saved))
+                elif path:
+                    created.append(obj)
+            # the objects that were created since version hold no tiles anymore, they are the last children of their parents
+            for obj in reversed(created):
+                obj.__parent__.removeChild(obj)
+            for obj, saved in restored:
+                obj.setPatchData({k: v for k, v in saved.items() if k != "tiles" and k != "elements"})
+            self.resetUndoStack()
+        return True
+
+    def __addModified(self, modified, since, path):
+        if self.__stamp__ > since:
+            modified.append((self, path))
+        for i, c in enumerate(self.getChildren()):
+            c.__addModified(modified, since, path+[i])
+
+    def locateTiles(data, path, located):
+        """
+        Adds the path (see getPatch) of the serialized container that holds each tile in data (a serialized object) to located
+        """
+        for tId in data.get("tiles", ()):
+            located[tId] = path
+        for i, e in enumerate(data.get("elements") or ()):
+            ModelObject.locateTiles(e, path+[i], located)
+
+    def getElementData(data, path):
+        """
+        Returns: the serialized object at path in data (a serialized object), or None if data does not contain path
+        """
+        for index in path:
+            elements = data.get("elements") or ()
+            if index >= len(elements):
+                return None
+            data = elements[index]
         return data
+
+    def getByPath(self, path, elementType=None):
+        """
+        Returns: the object at path (see getPatch) in the tree of this object, the last object in the path is 
+        created when it does not exist yet (see getChild)
+        """
+        obj = self
+        for i, index in enumerate(path):
+            obj = obj.getChild(index, elementType if i == len(path)-1 else None)
+        return obj
@@ -1,4 +1,87 @@
 from lib import log, util
+
+class PersistencePlan:
+    """
+    The persistence plan of a class that extends PersistentObject, which is shared by all its instances. 
+    It holds the persistent attributes that are declared by PersistentObject.persist, and what is resolved for them 
+    (by name mangling and reflection) the first time it is needed:
+    - the slots: the names under which the persistent attributes are stored in the __dict__ of an instance
+    - the setters: for each serialized attribute, the setter method, or else the slot to set directly
+    - the element accessors: for each type of child element, the getter or adder method of the class
+    """
+    __plans__ = {}
+
+    def get(cls):
+        plan = PersistencePlan.__plans__.get(cls)
+        if plan == None:
+            plan = PersistencePlan(cls)
+            PersistencePlan.__plans__[cls] = plan
+        return plan
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.attributes = {}    #the initial values of the persistent attributes, by name, in the order in which they were declared
+        self.slots = None
+        self.setters = {}
+        self.accessors = {}
+
+    def declare(self, attrName, initValue):
+        if not attrName in self.attributes:
+            self.attributes[attrName] = initValue
+            self.slots = None
+
+    def getNames(self, className, attrName):
+        """
+        Returns: the possible qualified names (class.attribute) of an attribute, for the class itself and its bases
+        """
+        names = ["_"+className+"__"+attrName]
+        for base in self.cls.__bases__:
+            names.append("_"+base.__name__+"__"+attrName)
+        return names
+
+    def getSlots(self, obj):
+        """
+        Returns: a list of tuples (attribute name, slot) of the persistent attributes of obj (an instance of the class)
+        """
+        if self.slots != None:
+            return self.slots
+        slots = []
+        resolved = True
+        for attrName in self.attributes:
+            found = [nm for nm in self.getNames(self.cls.__name__, attrName) if nm in obj.__dict__]
+            if found:
+                slots.append((attrName, found[-1]))
+            else:
+                resolved = False
+        if resolved:
+            self.slots = slots
+        return slots
+
+    def getSetter(self, obj, className, attrName):
+        """
+        Returns: a tuple (setter, slot) for setting the serialized attribute attrName of obj: either the setter method, 
+        or else the name of the slot, or None if obj does not have the attribute
+        """
+        key = (className, attrName)
+        if not key in self.setters:
+            setter = getattr(self.cls, "set"+util.upperFirst(attrName), None)
+            if setter != None:
+                self.setters[key] = (setter, None)
+            else:
+                found = [nm for nm in self.getNames(className, attrName) if hasattr(obj, nm)]
+                self.setters[key] = (None, found[0]) if found else None
+        return self.setters[key]
+
+    def getAccessor(self, elementType):
+        """
+        Returns: a tuple (getter, adder) with the method to access (or else to create) a child element of type elementType,
+        or None if the class has neither
+        """
+        if not elementType in self.accessors:
+            getter = getattr(self.cls, "get"+elementType, None)
+            adder = getattr(self.cls, "add"+elementType, None)
+            self.accessors[elementType] = (getter, None) if getter != None else ((None, adder) if adder != None else None)
+        return self.accessors[elementType]
    
 class PersistentObject:
     """
@@ -8,56 +91,58 @@ class PersistentObject:
     def __init__(self):
         """
         Constructs an instance of PersistentObject. 
-        __persistent__ contains all attributes marked as persistent. 
-        It containts tuples of the format (classname, attribute name, initial value)
+        __persistent__ is the persistence plan of the class of this instance (see PersistencePlan), 
+        which contains all attributes marked as persistent. 
         """
-        self.__persistent__ = [] 
+        self.__persistent__ = PersistencePlan.get(type(self))
 
     def persist(self, persistentAttrName, initValue=None):
         """
         marks the instance attribute indicated by persistentAttrName (str) as persistent
         initValue is None by default, but can be set to a specific value. 
+        The attribute is declared once for the class of this instance, every next instance finds it declared already.
         """
-        self.__persistent__.append((type(self).__name__, persistentAttrName, initValue))
+        self.__persistent__.declare(persistentAttrName, initValue)
         
     def initPersistentAttributes(self):
         """
         initializes the persistent instance attributes 
         """
-        for pa in self.__persistent__:
-            className, attrName, initValue = pa
-            names = ["_"+className+"__"+attrName]
-            for base in self.__class__.__bases__:
-                names.append("_"+base.__name__+"__"+attrName)
-            for nm in names:
-                if nm in self.__dict__:
-                    setattr(self, nm, initValue)     
+        attributes = self.__persistent__.attributes
+        for attrName, slot in self.__persistent__.getSlots(self):
+            setattr(self, slot, attributes[attrName])
     
-    def getPersistentAttributes(self):
+    def getPersistentAttributes(self, borrowed=False, result=None):
         """
         returns a dictionary of the persistent attributes with their current values, 
         very much like the builtin method __dict__. 
         The format of the resulting dictionary is:
         {class.attr1: value1, class.attr2: value2, ...}
+        Parameters:
+        - borrowed: when False, values such as lists are copied. When True, the result refers to the values of this instance, 
+          which is meant for callers that use the result immediately (for example, to json.dumps it), and do not keep it.
+        - result: the dict to which the attributes are added, a new dict by default
         """
-        result = {} 
-        for pa in self.__persistent__:
-            className, attrName, initValue = pa
-            names = ["_"+className+"__"+attrName]
-            # construct a list of possible qualified names (class.attribute) for the attributes
-            for base in self.__class__.__bases__:
-                names.append("_"+base.__name__+"__"+attrName)
-            # try each of these names
-            for nm in names:
-                # by looking it up in self.__dict__
-                if nm in self.__dict__:
-                    v = self.__dict__[nm]
-                    # put (a copy of) the found value in result
-                    result[attrName] = v.copy() if hasattr(type(v), "copy") else v
-                    # if the value is a list, dict, etc, than store a copy of it
-        #log.trace("\n\n", type(self), ".getPersistentAttributes() -->", result, "\n\n")
+        if result == None:
+            result = {} 
+        d = self.__dict__
+        for attrName, slot in self.__persistent__.getSlots(self):
+            v = d[slot]
+            # put (a copy of) the value in result, if the value is a list, dict, etc, than store a copy of it
+            result[attrName] = v if borrowed or not hasattr(type(v), "copy") else v.copy()
         return result
         
+    def setPersistentAttributes(self, values):
+        """
+        sets the persistent attributes in values (a dict: attribute name -> value) directly in their slots, 
+        without the setter methods, so this instance is not marked as modified. For example, for a decoder that builds 
+        a new instance from its data.
+        """
+        d = self.__dict__
+        for attrName, slot in self.__persistent__.getSlots(self):
+            if attrName in values:
+                d[slot] = values[attrName]
+
     def getType(self):
         """
         returns the type name for this instance
@@ -69,9 +154,7 @@ class PersistentObject:
         Returns a dict with the following structure:
         {"type": "<type of the object>", "attr1": "<value of attr1>, ...}
         """
-        data = {"type":self.getType()}
-        data.update(self.getPersistentAttributes())
-        return data
+        return self.getPersistentAttributes(False, {"type":self.getType()})
 
     def isValidData(self, data):
         """
@@ -118,35 +201,19 @@ class PersistentObject:
         """
         log.debug(function=self.setDataAttributes, args=self.getType())
         className = self.getDataType(data)
+        plan = self.__persistent__
         # iterate through the items in data
-        for item in data:
+        for item, attrValue in data.items():
             # skip the value of "type" and "elements" (which contains serialized data for child objects)
-            if not item in ["type", "elements"]:
-                attrValue = data[item]
-                names = ["_"+className+"__"+item]
-                # construct a list of possible qualified names (class.attribute)
-                for base in self.__class__.__bases__:
-                    names.append("_"+base.__name__+"__"+item)
-                # try each of these names
-                for nm in names:
-                    # see if the class has a setter method for this attribute
-                    setterName = "set"+util.upperFirst(item)
-                    if hasattr(type(self), setterName):
-                        # apparently, the setter method exists, so use it:
-                        setter = getattr(type(self), setterName)
-                        log.debug(function=setter, args=attrValue)
-                        setter(self, attrValue)
-                        break
-                    else:
-                        #nope, no setter method, so now we attempt to access the attribute directly
-                        if hasattr(self, nm):
-                            #apperently, the attr exists, so set its value directly by using setattr
-                            log.debug("set: ", nm, " = ", attrValue)
-                            setattr(self, nm, attrValue)
-                            break
-                        else:
-                            log.warning(className, "does not have an attribute named:", item, "(", nm, ")")  
-                            log.debug("\n\n", type(self), ".__dict__", self.__dict__, "\n\n")
+            if item != "type" and item != "elements":
+                # use the setter method for this attribute if the class has one, otherwise set the attribute directly
+                access = plan.getSetter(self, className, item)
+                if access == None:
+                    log.warning(className, "does not have an attribute named:", item)  
+                elif access[0] != None:
+                    access[0](self, attrValue)
+                else:
+                    setattr(self, access[1], attrValue)
 
     def addNestedElement(self, data, elementData):
         """
@@ -161,14 +228,13 @@ class PersistentObject:
         #log.trace(type(self),".addNestedElement", (data, elementData), " --> ", d)
         return d
 
-    def serialize(self):
+    def serialize(self, borrowed=False):
         """
         serializes this instance to a dict of the following format:
         {type: qualified classname, class.attr1: value1, class.attr2: value2, ...}
+        See getPersistentAttributes for borrowed.
         """
-        data = {"type":self.getType()}
-        data.update(self.getPersistentAttributes())
-        return data
+        return self.getPersistentAttributes(borrowed, {"type":self.getType()})
 
     def deserialize(self, data):
         """
@@ -192,28 +258,25 @@ class PersistentObject:
                     className = self.getDataType(data) 
                     elementName = self.getDataType(e)
                     log.debug("deserialize " + className + "." + elementName)
-                    elementGetterName = "get"+self.getDataType(e)
-                    elementAdderName = "add"+self.getDataType(e)
-                    # try accessing the getter method for the collection of child objects
-                    if hasattr(type(self), elementGetterName):
+                    # the getter method for the child object, or else the adder method that creates it (see PersistencePlan.getAccessor)
+                    accessor = self.__persistent__.getAccessor(elementName)
+                    if accessor != None and accessor[0] != None:
                         # apparently, the getter method exists, so use it to access the child object
-                        getElement = getattr(type(self), elementGetterName)
-                        element = getElement(self)
+                        element = accessor[0](self)
                         # verify that the found element is an instance of PersistentObject
                         assert isinstance(element, PersistentObject)
                         # now, recursively deserialize the child 
                         element.deserialize(e)
-                    elif hasattr(type(self), elementAdderName):
+                    elif accessor != None:
                         # apparently, a getter does not exist, but an adder does, so use that to access the child
-                        addElement = getattr(type(self), elementAdderName)
-                        element = addElement(self)
+                        element = accessor[1](self)
                         # verify that the found element is an instance of PersistentObject
                         #assert isinstance(element, PersistentObject)
                         if isinstance(element, PersistentObject):
                             # now, recursively deserialize the child 
                             element.deserialize(e)
                         else:
-                            log.error(className + "." + elementAdderName + " returned an object of type: " + str(element) + " where PersistentObject is expected")
+                            log.error(className + ".add" + elementName + " returned an object of type: " + str(element) + " where PersistentObject is expected")
                     else:
                         log.error("no getter or creator method found for element", 
                                   className + "." + elementName, 
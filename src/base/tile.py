@@ -1,185 +1,238 @@
 from lib import log
-from .modelobject import ModelObject
 from . import model
+from . import tilecode
+from .undo import UndoStack
 from .gameconstants import GameConstants
 
-class TileFactory:
-    __instance__ = None
-    
-    def getInstance():
-        if TileFactory.__instance__ == None: 
-            TileFactory.init()
-        return TileFactory.__instance__
+class TileFace:
+    """
+    The immutable part of a tile: its color, value and code (see tilecode).
+    Faces are flyweights: there is a single instance for every distinct tile, which is shared
+    by all the tiles of all games.
+    """
+    __slots__ = ("color", "value", "code")
+    __faces__ = {}
+
+    def get(color, value, joker=False):
+        key = (color, value, joker)
+        face = TileFace.__faces__.get(key)
+        if face == None:
+            face = TileFace(color, value, tilecode.JOKER if joker else tilecode.encode(color, value))
+            TileFace.__faces__[key] = face
+        return face
+
+    def __init__(self, color, value, code):
+        self.color = color
+        self.value = value
+        self.code = code
+
+class TileRegistry:
+    """
+    Holds the tiles of a single game. Every Game has its own registry (see ModelObject.getTileRegistry),
+    so that several games can live in the same process without sharing tiles.
+    All per-game state of the tiles is kept in lists that are indexed by tile id:
+    - faces: the TileFace of each tile
+    - containers: the TileContainer that currently holds each tile
+    - plates: the Plate each tile was last moved from (see Tile.rememberPlate)
+    The Tile instances themselves only refer to their registry and id.
+    The registry also records at which version of the game each tile was last moved (see ModelObject.getPatch).
+    """
+
+    def __init__(self):
+        self.__tiles = []
+        self.faces = []
+        self.containers = []
+        self.plates = []
+        self.__moves = {}   #the version of the last move of each tile, by tile id, in the order of the moves
+
+    def createTile(self, tId, color, value, container):
+        if not self.contains(tId):
+            return self.add(Tile(self, tId), TileFace.get(color, value), container)
+        return None
+
+    def createJoker(self, tId, color, container):
+        if not self.contains(tId):
+            return self.add(Joker(self, tId), TileFace.get(color, 0, True), container)
+        return None
+
+    def add(self, tile, face, container):
+        assert isinstance(tile, Tile)
+        tId = tile.id()
+        if tId >= len(self.__tiles):
+            n = tId + 1 - len(self.__tiles)
+            for l in (self.__tiles, self.faces, self.containers, self.plates):
+                l.extend([None] * n)
+        if self.__tiles[tId] == None:
+            self.__tiles[tId] = tile
+            self.faces[tId] = face
+            self.containers[tId] = container
+        return tile
+
+    def createTiles(self, table, container):
+        """
+        Creates all tiles of a game at once, in this (empty) registry. 
+        Parameters:
+        - table: a list of tuples (color, value), the tile with id i is created from table[i]. A value of 0 creates a joker.
+        - container: the container of the created tiles
+        """
+        assert not self.__tiles
+        self.__tiles = [Joker(self, tId) if value == 0 else Tile(self, tId) for tId, (color, value) in enumerate(table)]
+        self.faces = [TileFace.get(color, value, value == 0) for color, value in table]
+        self.containers = [container] * len(table)
+        self.plates = [None] * len(table)
+
+    def copyFrom(self, source, containers):
+        """
+        Makes this registry a copy of source (the registry of another game), see Game.clone.
+        The faces are shared, the tiles are new handles of the same class and id.
+        Parameters:
+        - source: an instance of TileRegistry
+        - containers: a dict that maps the containers of the source game to the corresponding containers in this game
+        """
+        self.__tiles = [type(t)(self, t.id()) if t != None else None for t in source.__tiles]
+        self.faces = list(source.faces)
+        self.containers = [containers.get(c) for c in source.containers]
+        self.plates = [containers.get(p) for p in source.plates]
+        self.__moves = source.__moves.copy()
 
-    def init():
-        if TileFactory.__instance__:
-            del TileFactory.__instance__
-        TileFactory.__instance__ = TileFactory.__TileFactory__()
+    def stampMove(self, tId, version):
+        """
+        Records that the tile with id tId was moved at version
+        """
+        self.__moves.pop(tId, None)
+        self.__moves[tId] = version
 
-    class __TileFactory__:
+    def stampMoves(self, tIds, version):
+        """
+        Records that the tiles with the ids in tIds were moved at version, in that order
+        """
+        moves = self.__moves
+        for tId in tIds:
+            moves.pop(tId, None)
+            moves[tId] = version
 
-        def __init__(self):
-            self.__tiles__ = {}
+    def getMoves(self, since):
+        """
+        Returns: a list of tuples (tile id, container, plate) of the tiles that were moved since version since, in the order of the moves
+        """
+        return [(tId, self.containers[tId], self.plates[tId]) for tId, version in self.__moves.items() if version > since]
 
-        def createTile(self, tId, color, value, container):
-            if not tId in self.__tiles__:
-                tile = Tile(tId, color, value, container, self)
-                self.__tiles__[tId] = tile
-                return tile
-            return None
+    def restamp(self, since, version):
+        for tId in self.__moves:
+            if self.__moves[tId] > since:
+                self.__moves[tId] = version
 
-        def createJoker(self, tId, color, container):
-            if not tId in self.__tiles__:
-                tile = Joker(tId, color, container, self)
-                self.__tiles__[tId] = tile
-                return tile
-            return None
+    def contains(self, tId):
+        return tId < len(self.__tiles) and self.__tiles[tId] != None
 
-        def add(self, tile):
-            assert isinstance(tile, Tile)
-            if not tile.id() in self.__tiles__: 
-                self.__tiles__[tile.id()] = tile
+    def getById(self, tId):
+        return self.__tiles[tId]
 
-        def getById(self, tId):
-            return self.__tiles__[tId]
+    def getTiles(self):
+        return [t for t in self.__tiles if t != None]
 
-class Tile(ModelObject):
+class Tile:
+    """
+    A tile of a game. Instances are small handles (a registry and an id); the immutable properties of the tile
+    are held by a shared TileFace, and its location by the TileRegistry of the game.
+    Modifications are not notified by the tile itself, but by the containers it is moved between.
+    """
+    __slots__ = ("_registry", "_id")
 
     def create(tId, color, value, container):
-        return TileFactory.getInstance().createTile(tId, color, value, container)
-
-    def getById(tId):
-        return TileFactory.getInstance().getById(tId)
-
-    def __init__(self, tId, color, value, container, factory):
-        assert isinstance(factory, TileFactory.__TileFactory__)
-        assert TileFactory.getInstance() == factory
-        super().__init__(None) # Tile instances have no parent for now
-        self.__id = tId
-        self.__value = value
-        self.__color = color
-        self.persist("value")
-        self.persist("color")
-        self._container = container
-        self.plate = None
-        
+        return container.getTileRegistry().createTile(tId, color, value, container)
+
+    def __init__(self, registry, tId):
+        assert isinstance(registry, TileRegistry)
+        self._registry = registry
+        self._id = tId
+
+    def getTileRegistry(self):
+        return self._registry
+
     def getContainer(self):
-        return self._container
-    
+        return self._registry.containers[self._id]
+
     def setContainer(self, container):
-        self._container = container
+        self._registry.containers[self._id] = container
+
+    @property
+    def plate(self):
+        return self._registry.plates[self._id]
 
     def id(self):
-        return self.__id
+        return self._id
+
+    def code(self):
+        """
+        Returns the integer code of this tile, as used by the set classification kernel (see tilecode)
+        """
+        return self._registry.faces[self._id].code
 
     def move(self, targetContainer, pos=None):
-        if self._container.moveTile(self, targetContainer, pos):
-            self.setModified()
+        source = self.getContainer()
+        # record how to undo the move, if the game records its moves (see undo.UndoStack)
+        stack = source.getUndoStack()
+        if stack != None:
+            slot = stack.reserve()
+            undo = (UndoStack.MOVE, self, source, source.getTilePosition(self), self.plate)
+        if source.moveTile(self, targetContainer, pos):
+            # the target container marks itself as modified when the tile is added, the source container is marked here
+            source.setModified()
+            if stack != None:
+                stack.fill(slot, undo)
             return True
+        if stack != None:
+            stack.release(slot)
         return False
-        
+
 
     def rememberPlate(self, plate):
         if isinstance(plate, model.Plate):
-            self.plate = plate
-    
+            self._registry.plates[self._id] = plate
+
     def forgetPlate(self):
-        self.plate = None
+        self._registry.plates[self._id] = None
 
     def toString(self):
-        s = "Tile" + str(self.__id) + "("
-        s = s + str(self.__value) + ","
-        s = s + GameConstants.TILECOLORNAMES[self.__color]
+        s = "Tile" + str(self._id) + "("
+        s = s + str(self.getValue()) + ","
+        s = s + GameConstants.TILECOLORNAMES[self.getColor()]
         s = s + ")"
         return s
 
     def getValue(self, *args, **kwargs):
-        return self.__value
+        return self._registry.faces[self._id].value
 
     def getColor(self, *args, **kwargs):
-        return self.__color
+        return self._registry.faces[self._id].color
+
+    def resolve(self):
+        """
+        Returns: a tuple (value, color) with the value and color this tile represents, see Joker.resolve
+        """
+        face = self._registry.faces[self._id]
+        return (face.value, face.color)
 
     def print(self):
         log.trace(self.toString())
 
 class Joker(Tile):
-    def create(tId, color, container):
-        return TileFactory.getInstance().createJoker(tId, color, container)
-
-    def __init__(self, id, color, container, factory):
-        super().__init__(id, color, 0, container, factory)
-
-    def getNeighbours(self, *args, **kwargs):
-        context = []
-        try:
-            context = kwargs["context"]
-        except KeyError:
-            if isinstance(self._container, model.Set): 
-                context = self._container.getTilesAsDict()
-        left,right = (None,None)
-        if self in context:
-            i = context.index(self)
-            if i>0:
-                left = context[i-1]
-            if i<len(context)-1:
-                right = context[i+1]
-        """        
-        log.debug(
-            type(self), 
-            ".getNeighbours(", 
-            util.collectionToString(context, lambda item: item.toString() if item and isinstance(item, Tile) else str(item)), 
-            ") --> ", 
-            (left.toString() if left else None, right.toString() if right else None))
-        """
-        return (left,right)
+    __slots__ = ()
 
-    def getColor(self, *args, **kwargs):
-        try:
-            settype = kwargs["settype"]
-        except KeyError:
-            settype = None
-        left,right = self.getNeighbours(*args, **kwargs)
-        if left and right:
-            if settype == model.Set.SETTYPE_RUN:
-                return left.getColor()
-            elif settype == model.Set.SETTYPE_GROUP:
-                return GameConstants.NOCOLOR
-        elif left:
-            if settype == model.Set.SETTYPE_RUN:
-                return left.getColor()
-            elif settype == model.Set.SETTYPE_GROUP:
-                return GameConstants.NOCOLOR
-        elif right:
-            if settype == model.Set.SETTYPE_RUN:
-                return right.getColor()
-            elif settype == model.Set.SETTYPE_GROUP:
-                return GameConstants.NOCOLOR
-        return super().getColor()
+    def create(tId, color, container):
+        return container.getTileRegistry().createJoker(tId, color, container)
 
-    def getValue(self, *args, **kwargs):
-        try:
-            settype = kwargs["settype"]
-        except KeyError:
-            settype = None
-        left,right = self.getNeighbours(*args, **kwargs)
-        if left and right:
-            if settype == model.Set.SETTYPE_RUN:
-                return left.getValue()+1
-            elif settype == model.Set.SETTYPE_GROUP:
-                return left.getValue()
-        elif left:
-            if settype == model.Set.SETTYPE_RUN:
-                return left.getValue()+1
-            elif settype == model.Set.SETTYPE_GROUP:
-                return left.getValue()
-        elif right:
-            if settype == model.Set.SETTYPE_RUN:
-                return right.getValue()-1
-            elif settype == model.Set.SETTYPE_GROUP:
-                return right.getValue()
-        return super().getValue()
+    def resolve(self):
+        """
+        Returns: a tuple (value, color) with the value and color this joker represents in the set that contains it,
+        or None if that cannot be decided, or if the joker is not in a set
+        """
+        container = self.getContainer()
+        if isinstance(container, model.Set):
+            return container.resolveTile(self)
+        return None
 
     def toString(self):
         s = "Joker(" + GameConstants.TILECOLORNAMES[self.getColor()] + ")"
         return s
-
@@ -0,0 +1,239 @@
+"""
+Integer encoding of tiles, and the kernel that classifies sets of encoded tiles.
+
+A regular tile is encoded as color*13 + (value-1), which results in the codes 0..51.
+All jokers are encoded as JOKER, regardless of their color.
+The kernel only works with these codes and with bitmasks that are precomputed per code,
+so classifying a set does not involve any Tile instances.
+"""
+from .gameconstants import GameConstants
+
+SETTYPE_INVALID = -1
+SETTYPE_UNDECIDED = 0
+SETTYPE_GROUP = 1
+SETTYPE_RUN = 2
+
+MAXVALUE = GameConstants.MAXTILEVALUE
+MAXGROUPSIZE = len(GameConstants.TILECOLORS)
+JOKER = 64
+
+# offset added to the start value of a run before it is turned into a bit,
+# so that the start value (value-position) of any tile in a set of at most 13 tiles is positive
+STARTOFFSET = MAXVALUE
+
+def encode(color, value):
+    return color*MAXVALUE + value - 1
+
+def colorOf(code):
+    return code // MAXVALUE
+
+def valueOf(code):
+    return code % MAXVALUE + 1
+
+def isJoker(code):
+    return code >= JOKER
+
+# bitmasks per tile code (index 0..51)
+COLORBITS = [1 << colorOf(code) for code in range(JOKER)]
+VALUEBITS = [1 << valueOf(code) for code in range(JOKER)]
+# bit for the start value of a run in which the tile is in the first position;
+# shift it to the right by the position of the tile to get the start value for that position
+STARTBITS = [1 << (valueOf(code) + STARTOFFSET) for code in range(JOKER)]
+# for each set size, the bits of all start values that result in a run within 1..13
+RUNSTARTS = [sum(1 << (start + STARTOFFSET) for start in range(1, MAXVALUE - n + 2)) for n in range(MAXVALUE + 1)]
+# set type by (isRun, isGroup)
+SETTYPES = [SETTYPE_INVALID, SETTYPE_GROUP, SETTYPE_RUN, SETTYPE_UNDECIDED]
+
+def classify(codes):
+    """
+    Parameters:
+    - codes: a list of tile codes, in the order of the tiles in the set
+    Returns: SETTYPE_INVALID, SETTYPE_UNDECIDED, SETTYPE_GROUP or SETTYPE_RUN
+
+    A set is a possible run when all regular tiles have the same color and all of them
+    agree on the start value of the run, and that start value keeps the run within 1..13.
+    A set is a possible group when it contains at most 4 tiles and all regular tiles have the same value.
+    When both are still possible (a set with at most 1 regular tile), the type is undecided.
+    The same tile (color and value) can never appear twice in a set.
+    """
+    n = len(codes)
+    if n > MAXVALUE:
+        return SETTYPE_INVALID
+    tiles = colors = values = starts = 0
+    i = 0
+    for code in codes:
+        if code < JOKER:
+            bit = 1 << code
+            if tiles & bit:
+                return SETTYPE_INVALID
+            tiles |= bit
+            colors |= COLORBITS[code]
+            values |= VALUEBITS[code]
+            starts |= STARTBITS[code] >> i
+        i += 1
+    return setType(n, colors, values, starts)
+
+def isRun(codes):
+    """
+    Returns True if codes contains at least 2 tiles that can form a run
+    """
+    return len(codes) >= 2 and classify(codes) in (SETTYPE_RUN, SETTYPE_UNDECIDED)
+
+def setType(n, colors, values, starts):
+    """
+    Returns the set type of a set of n tiles, given the bitmasks of the colors, values and run starts of its regular tiles
+    """
+    if n > MAXVALUE:
+        return SETTYPE_INVALID
+    run = not (colors & (colors-1) or starts & (starts-1) or starts & ~RUNSTARTS[n])
+    group = n <= MAXGROUPSIZE and not values & (values-1)
+    return SETTYPES[2*run + group]
+
+class SetState:
+    """
+    The classification of an ordered set of tile codes, maintained incrementally.
+    Checking whether a tile fits at some position, and inserting it, take constant time as long as
+    the set is a possible run or group. Removing a tile, or inserting a tile into an invalid set,
+    recomputes the state from the codes.
+    """
+    def __init__(self, codes=None):
+        self.rebuild(codes if codes != None else [])
+
+    def rebuild(self, codes):
+        self.codes = list(codes)
+        self.tiles = self.colors = self.values = self.starts = 0
+        self.first = self.last = -1     #positions of the first and last regular tile
+        self.jokers = []                #positions of the jokers
+        duplicates = False
+        for i, code in enumerate(self.codes):
+            if code < JOKER:
+                bit = 1 << code
+                duplicates = duplicates or bool(self.tiles & bit)
+                self.tiles |= bit
+                self.colors |= COLORBITS[code]
+                self.values |= VALUEBITS[code]
+                self.starts |= STARTBITS[code] >> i
+                if self.first == -1: self.first = i
+                self.last = i
+            else:
+                self.jokers.append(i)
+        if duplicates:
+            self.settype = SETTYPE_INVALID
+        else:
+            self.settype = setType(len(self.codes), self.colors, self.values, self.starts)
+
+    def copy(self):
+        state = SetState.__new__(SetState)
+        state.__dict__.update(self.__dict__)
+        state.codes = list(self.codes)
+        state.jokers = list(self.jokers)
+        return state
+
+    def getType(self):
+        return self.settype
+
+    def getCodes(self):
+        return self.codes
+
+    def getJokerSlots(self):
+        return self.jokers
+
+    def getColors(self):
+        return [c for c in range(MAXGROUPSIZE) if self.colors & (1 << c)]
+
+    def getRunRange(self):
+        """
+        Returns: a tuple (min, max) with the values of the first and last tile of the run,
+        or None if this set is not a run
+        """
+        if self.settype != SETTYPE_RUN:
+            return None
+        start = self.starts.bit_length() - 1 - STARTOFFSET
+        return (start, start + len(self.codes) - 1)
+
+    def combine(self, code, index):
+        """
+        Returns: the bitmasks (tiles, colors, values, starts) of this set with code inserted at index,
+        or None if the tile is already in the set
+        """
+        starts = self.starts
+        if self.last >= index:
+            # the regular tiles after index shift one position, which lowers their run start by one
+            starts = (starts | starts >> 1) if -1 < self.first < index else starts >> 1
+        if code < JOKER:
+            bit = 1 << code
+            if self.tiles & bit:
+                return None
+            return (self.tiles | bit, self.colors | COLORBITS[code], self.values | VALUEBITS[code], starts | STARTBITS[code] >> index)
+        return (self.tiles, self.colors, self.values, starts)
+
+    def isIncremental(self):
+        return self.settype != SETTYPE_INVALID
+
+    def fit(self, code, index):
+        """
+        Returns: the set type of this set with code inserted at index (0-based)
+        """
+        index = min(index, len(self.codes))
+        if not self.isIncremental():
+            codes = list(self.codes)
+            codes.insert(index, code)
+            return classify(codes)
+        masks = self.combine(code, index)
+        if masks == None:
+            return SETTYPE_INVALID
+        tiles, colors, values, starts = masks
+        return setType(len(self.codes)+1, colors, values, starts)
+
+    def insert(self, code, index):
+        index = min(index, len(self.codes))
+        masks = self.combine(code, index) if self.isIncremental() else None
+        self.codes.insert(index, code)
+        if masks == None:
+            self.rebuild(self.codes)
+            return
+        self.tiles, self.colors, self.values, self.starts = masks
+        if self.first >= index: self.first += 1
+        if self.last >= index: self.last += 1
+        self.jokers = [j+1 if j >= index else j for j in self.jokers]
+        if code < JOKER:
+            if self.first == -1 or index < self.first: self.first = index
+            if index > self.last: self.last = index
+        else:
+            self.jokers.append(index)
+            self.jokers.sort()
+        self.settype = setType(len(self.codes), self.colors, self.values, self.starts)
+
+    def remove(self, index):
+        self.codes.pop(index)
+        self.rebuild(self.codes)
+
+    def resolve(self):
+        """
+        Resolves the jokers in a single sweep over the set.
+        Returns: a list with a tuple (value, color) for every position in the set. For a joker, this is the value and
+        color it represents: its place in the run, or the value of the group with one of the colors not yet used.
+        When that cannot be decided (an invalid set, or a set without regular tiles), the entry for a joker is None.
+        """
+        n = len(self.codes)
+        if self.settype == SETTYPE_RUN or (self.settype == SETTYPE_UNDECIDED and self.starts):
+            start = self.starts.bit_length() - 1 - STARTOFFSET
+            color = self.colors.bit_length() - 1
+            return [(start+i, color) for i in range(n)]
+        if self.settype == SETTYPE_GROUP:
+            value = self.values.bit_length() - 1
+            free = [c for c in range(MAXGROUPSIZE) if not self.colors & (1 << c)]
+            resolved = []
+            for code in self.codes:
+                if code < JOKER:
+                    resolved.append((valueOf(code), colorOf(code)))
+                else:
+                    resolved.append((value, free.pop(0)))
+            return resolved
+        return [(valueOf(code), colorOf(code)) if code < JOKER else None for code in self.codes]
+
+def resolve(codes):
+    """
+    Returns: a tuple (value, color) for every tile in codes, see SetState.resolve
+    """
+    return SetState(codes).resolve()
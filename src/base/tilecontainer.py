@@ -1,10 +1,13 @@
+import bisect
 import random
 from lib import log, util
 from lib.pubsub import Publisher
 from .modelobject import ModelObject
 from .gameserver import GameServer
 from .gameconstants import GameConstants
-from .tile import TileFactory, Tile, Joker
+from . import tilecode
+from .tile import TileRegistry, Tile, Joker
+from .undo import UndoStack
 
 class TileContainer(ModelObject):
     """
@@ -14,28 +17,89 @@ class TileContainer(ModelObject):
 
     def __init__(self, parent):
         super().__init__(parent)
-        self.__tiles = []
-        self.persist("tiles", [])
+        self.__registry = super().getTileRegistry()
+        if self.__registry == None:
+            # a container outside of a Game, the registry is held by the root of its tree
+            self.__registry = TileRegistry()
+            self.getRoot().setTileRegistry(self.__registry)
+        self.__tiles = {}   #the ids of the tiles in this container, as keys of a dict, which keeps them in insertion order
+        self.__sequence = 0 #the next insertion number, the values of __tiles are the (increasing) insertion numbers of the tiles
+        #the tiles are persistent too, see getPersistentAttributes
         self.lastTilePosition = 0
 
     def setTiles(self, tiles):
         log.debug(function=self.setTiles, args=(self.getFullId(), tiles))
         if tiles:
+            # tiles that are not in a container yet (see Game.fromData) are put in this container directly
+            containers = self.__registry.containers
+            unplaced = [tId for tId in tiles if containers[tId] == None]
+            if unplaced:
+                self.putTiles(unplaced)
             for tId in tiles:
                 if not tId in self.__tiles:
-                    tile = Tile.getById(tId)
+                    tile = self.__registry.getById(tId)
                     if tile.getContainer() != self:
                         tile.move(self)
    
     def getTiles(self):
-        return self.__tiles
+        """
+        Returns: a list of the ids of the tiles in this container
+        """
+        return list(self.__tiles)
+
+    def getLastTile(self):
+        """
+        Returns: the tile that was added last to this container, or None if this container is empty
+        """
+        if self.__tiles:
+            return self.__registry.getById(next(reversed(self.__tiles)))
+        return None
+
+    def getPersistentAttributes(self, borrowed=False, result=None):
+        """
+        Overrides PersistentObject.getPersistentAttributes to add the tiles, as a list of tile ids. 
+        The tiles precede the other persistent attributes, so that they are deserialized first (see Set.setOrder).
+        """
+        if result == None:
+            result = {}
+        result["tiles"] = list(self.__tiles)
+        return super().getPersistentAttributes(borrowed, result)
+
+    def getPatchData(self, since):
+        data = super().getPatchData(since)
+        # the tiles are patched by the moves of the tiles (see ModelObject.getPatch)
+        del data["tiles"]
+        return data
+
+    def setTileOrder(self, tiles):
+        """
+        Puts the tiles of this container in the order of tiles (a list of tile ids).
+        Tiles of this container that are not in tiles keep their relative order, and are placed before the others.
+        """
+        ordered = dict.fromkeys(tId for tId in tiles if tId in self.__tiles)
+        self.__renumber([tId for tId in self.__tiles if not tId in ordered] + list(ordered))
+
+    def __renumber(self, tiles):
+        """
+        Makes tiles (a list of tile ids) the tiles of this container, with new insertion numbers
+        """
+        self.__tiles = {tId: i for i, tId in enumerate(tiles)}
+        self.__sequence = len(tiles)
+
+    def getTileRegistry(self):
+        return self.__registry
+
+    def copyTilesFrom(self, source):
+        """
+        Copies the tiles (the ids, in their order) of source, which is the corresponding container of another game.
+        Used by Game.clone, after the registry of this container was made a copy of the registry of source.
+        """
+        self.__tiles = source.__tiles.copy()
+        self.__sequence = source.__sequence
 
     def getTilesAsDict(self):
         log.debug(function=self.getTilesAsDict, args=self.getFullId())
-        tiles = {}
-        for tId in self.__tiles:
-            tiles[tId] = Tile.getById(tId)
-        return tiles
+        return {tId: self.__registry.getById(tId) for tId in self.__tiles}
 
     """
     Obsolete, but kept for compatibility
@@ -49,16 +113,85 @@ class TileContainer(ModelObject):
     def getTile(self, tileId):
         tile = None
         if tileId in self.__tiles: 
-            tile = Tile.getById(tileId)
+            tile = self.__registry.getById(tileId)
         return tile
 
     def setTile(self, tile):
         tileId = tile.id()
-        if not tileId in self.__tiles:
-            self.__tiles.append(tileId)
+        self.__tiles.setdefault(tileId, self.__sequence)
+        self.__sequence += 1
         assert self.containsTile(tile)
         tile.setContainer(self)
         self.setModified()
+        self.__registry.stampMove(tileId, self.getStamp())
+
+    def placeTile(self, tile):
+        """
+        Moves tile to the end of this container, without determining its fit position and without 
+        notifying the container it is moved from. Used to apply the tile moves of a patch (see ModelObject.applyPatch), 
+        the order of a Set is patched separately.
+        """
+        source = tile.getContainer()
+        if source != None:
+            source.releaseTile(tile)
+        self.setTile(tile)
+
+    def releaseTile(self, tile):
+        """
+        Removes tile from this container, without notifying anyone, see placeTile
+        """
+        self.__tiles.pop(tile.id(), None)
+
+    def getTilePosition(self, tile):
+        """
+        Returns: the position of tile in this container, as used by restoreTile: its insertion number, 
+        which orders it among the other tiles of this container
+        """
+        return self.__tiles[tile.id()]
+
+    def restoreTile(self, tile, position):
+        """
+        Moves tile back into this container, at position (see getTilePosition), without determining its fit position.
+        Used to undo a move (see undo.UndoStack). Both this container and the container of tile are marked as modified.
+        A tile that was the last tile of this container is appended, the others are inserted among the tiles.
+        """
+        source = tile.getContainer()
+        if source != None:
+            source.releaseTile(tile)
+            source.setModified()
+        if self.__tiles and position < self.__tiles[next(reversed(self.__tiles))]:
+            items = list(self.__tiles.items())
+            items.insert(bisect.bisect(items, position, key=lambda item: item[1]), (tile.id(), position))
+            self.__tiles = dict(items)
+        else:
+            self.__tiles[tile.id()] = position
+            self.__sequence = max(self.__sequence, position+1)
+        self.setTile(tile)
+
+    def putTiles(self, tileIds):
+        """
+        Adds the tiles with the provided ids to this container in a single operation, 
+        without determining their fit positions. This container is marked as modified once.
+        """
+        containers = self.__registry.containers
+        for tId in tileIds:
+            self.__tiles.setdefault(tId, self.__sequence)
+            self.__sequence += 1
+            containers[tId] = self
+        self.setModified()
+        self.__registry.stampMoves(tileIds, self.getStamp())
+
+    def dealTiles(self, targetContainer, count):
+        """
+        Moves the last count tiles of this container to targetContainer in a single operation.
+        This bypasses targetContainer.addTile (and its fit checks), so it is only meant for target containers 
+        that accept any tile, such as a Plate. Both containers are marked as modified once.
+        Returns: the list of the ids of the dealt tiles
+        """
+        dealt = [self.__tiles.popitem()[0] for i in range(min(count, len(self.__tiles)))]
+        targetContainer.putTiles(dealt)
+        self.setModified()
+        return dealt
 
     def containsTile(self, tile):
         """
@@ -74,8 +207,7 @@ class TileContainer(ModelObject):
         #log.debug(function=self.__removeTile, args=tile.toString())
         tileId = tile.id()
         assert self.containsTile(tile)
-        i = self.__tiles.index(tileId)
-        self.__tiles.pop(i)
+        del self.__tiles[tileId]
         assert self.containsTile(tile)==False
         
 
@@ -164,10 +296,10 @@ class Set(TileContainer):
     and the functionality for determining whether a tile that a player drags into a set, fits or not. 
     """
 
-    SETTYPE_UNDECIDED = 0   
-    SETTYPE_GROUP = 1       #consists of tiles with different colors, but identical value
-    SETTYPE_RUN = 2         #consists of tiles with different subsequent values of a single color
-    SETTYPE_INVALID = -1
+    SETTYPE_UNDECIDED = tilecode.SETTYPE_UNDECIDED   
+    SETTYPE_GROUP = tilecode.SETTYPE_GROUP      #consists of tiles with different colors, but identical value
+    SETTYPE_RUN = tilecode.SETTYPE_RUN          #consists of tiles with different subsequent values of a single color
+    SETTYPE_INVALID = tilecode.SETTYPE_INVALID
     SETTYPES = {
         SETTYPE_UNDECIDED: "Undecided",
         SETTYPE_GROUP: "Group",
@@ -177,6 +309,8 @@ class Set(TileContainer):
     def __init__(self, parent, pos=None):
         super().__init__(parent)
         self.__order = []
+        self.__state = tilecode.SetState() #the classification of the set, maintained along with __order
+        self.__resolved = None  #the (value, color) of each tile in the set, by tile id, see resolveTile
         self.__pos = pos  #this is a tuple (x,y) and is the relative position of the set on the board
         self.persist("order", [])
         self.persist("pos")
@@ -186,13 +320,71 @@ class Set(TileContainer):
     
     def getOrder(self):
         return self.__order
+
+    def setOrder(self, order):
+        self.__order = list(order)
+        registry = self.getTileRegistry()
+        self.__state.rebuild([registry.getById(tId).code() for tId in self.__order])
+        self.__resolved = None
+
+    def getState(self):
+        """
+        Returns: the incrementally maintained classification of this set (an instance of tilecode.SetState)
+        """
+        return self.__state
+
+    def copyTilesFrom(self, source):
+        """
+        Overrides TileContainer.copyTilesFrom(self, source) to also copy the order, classification and position of source
+        """
+        super().copyTilesFrom(source)
+        self.__order = list(source.__order)
+        self.__state = source.__state.copy()
+        self.__pos = source.__pos
     
+    def getTilePosition(self, tile):
+        """
+        Overrides TileContainer.getTilePosition(self, tile) to add the position of tile in the order of this set
+        Returns: a tuple (position in the container, position in the order)
+        """
+        return (super().getTilePosition(tile), self.__order.index(tile.id()))
+
+    def restoreTile(self, tile, position):
+        """
+        Overrides TileContainer.restoreTile(self, tile, position) to also restore the position of tile in the order of this set
+        """
+        self.__order.insert(position[1], tile.id())
+        self.__state.insert(tile.code(), position[1])
+        self.__resolved = None
+        super().restoreTile(tile, position[0])
+
+    def releaseTile(self, tile):
+        """
+        Overrides TileContainer.releaseTile(self, tile) to also remove tile from the order of this set
+        """
+        super().releaseTile(tile)
+        if tile.id() in self.__order:
+            i = self.__order.index(tile.id())
+            self.__order.pop(i)
+            self.__state.remove(i)
+            self.__resolved = None
+
     def setPos(self, pos):
         if (self.__pos == None) or pos[0] != self.__pos[0] or pos[1] != self.__pos[1]:
+            stack = self.getUndoStack()
+            if stack != None:
+                stack.record((UndoStack.POS, self, self.__pos))
             self.__pos = pos
             self.setModified()
             log.debug(function=self.setPos, args=pos)
 
+    def restorePos(self, pos):
+        """
+        Sets the position of this set back to pos, used to undo a change of the position (see undo.UndoStack)
+        """
+        self.__pos = pos
+        self.setModified()
+
     def addTile(self, tile, pos=None):
         """
         Adds a tile to this Set instance. A set maintains the order in which tiles are added.
@@ -204,8 +396,12 @@ class Set(TileContainer):
                 self.__order.append(tile.id())
             else:
                 self.__order.insert(fitPos-1, tile.id())
+            self.__state.insert(tile.code(), fitPos-1)
+            self.__resolved = None
         elif pos == fitPos:
             self.__order.insert(pos-1, tile.id())
+            self.__state.insert(tile.code(), pos-1)
+            self.__resolved = None
             
         return fitPos
 
@@ -219,14 +415,17 @@ class Set(TileContainer):
             #tile.forgetPlate()
             i = self.__order.index(tile.id())
             self.__order.pop(i)
+            self.__state.remove(i)
+            self.__resolved = None
             return True
         return False
 
     def getOrderedTiles(self):
         orderedTiles = []
         for tId in self.__order:
-            if tId in self.getTiles():
-                orderedTiles.append(self.getTile(tId))
+            tile = self.getTile(tId)
+            if tile:
+                orderedTiles.append(tile)
             else:
                 log.error("__tiles__ and order inconsistent", function=self.getOrderedTiles)
                 log.error("__tiles__:", self.toString())
@@ -235,30 +434,32 @@ class Set(TileContainer):
         log.debug(function=self.getOrderedTiles, returns=orderedTiles)
         return orderedTiles
 
+    def resolveTile(self, tile):
+        """
+        Returns: a tuple (value, color) with the value and color that tile represents in this Set, 
+        or None if that cannot be decided (see tilecode.SetState.resolve).
+        All tiles are resolved in a single sweep, which is repeated only after the set has changed.
+        """
+        if self.__resolved == None:
+            self.__resolved = dict(zip(self.__order, self.__state.resolve()))
+        return self.__resolved.get(tile.id())
+
+    def getOrderedCodes(self):
+        """
+        Returns: the codes (see tilecode) of the tiles in this Set, in the order of the set
+        """
+        return list(self.__state.getCodes())
+
     def isValidRun(self, tiles):
         """
-        checks whether tiles is a valid run, by determining the largest and smallest difference between the tiles
-        for a valid run, both the largest difference and smallest difference is exactly 1 
-        """
-        N = len(tiles)
-        largestDiff = 0
-        smallestDiff = GameConstants.MAXTILEVALUE
-        for i in range(N):
-            if i>0:
-                prevValue = tiles[i-1].getValue(context = tiles, settype = Set.SETTYPE_RUN)
-                thisValue = tiles[i].getValue(context = tiles, settype = Set.SETTYPE_RUN)
-                diff = thisValue - prevValue
-                if diff>largestDiff:
-                    largestDiff = diff
-                if diff<smallestDiff:
-                    smallestDiff = diff
-        log.debug(function=self.isValidRun, args=util.collectionToString(tiles, lambda item: str(item.getValue(context=tiles, settype = Set.SETTYPE_RUN))), returns=(largestDiff,smallestDiff))
-        return (largestDiff==1 and smallestDiff==1)
-
-    def getSetType(self, tiles):
+        checks whether tiles (a flat list of Tile instances) can form a valid run
+        """
+        return tilecode.isRun([t.code() for t in tiles])
+
+    def getSetType(self, tiles=None):
         """
         Parameters:
-        - tiles: a flat list of Tile instances (not a Dict)
+        - tiles: a flat list of Tile instances (not a Dict), or None for the tiles in this Set
         Returns: an int value representing the type of this set. Possible return values are:
         Set.SETTYPE_INVALID (-1) for an invalid set
         Set.SETTYPE_UNDECIDED (0) if the set type cannot be decided yet
@@ -268,57 +469,12 @@ class Set(TileContainer):
         Determines the type of the set, based on the current contents.
         A GROUP contains tiles of the same value, with different colors
         A RUN contains a number range (for example, 2,3,4) with the same color    
+        The classification itself is done by tilecode.classify, on the codes of the tiles.
+        The type of the tiles in this Set is maintained incrementally, so that is simply returned.
         """
-        distinctcolors = {} 
-        distinctvalues = {} 
-        jokers=0
-        for t in tiles:
-            #get the value of the tile 
-            #if t is an instance of Joker, than that value depends of its neighbours
-            if isinstance(t,Joker):
-                jokers+=1
-            else:
-                #count the distinct colors and values of the tiles (excluding jokers) in the set
-                c = t.getColor(context = tiles)
-                if c in distinctcolors: distinctcolors[c]+=1 
-                else: distinctcolors[c]=1
-                v = t.getValue(context = tiles)
-                if v in distinctvalues: distinctvalues[v]+=1 
-                else: distinctvalues[v]=1
-        doublecolors = util.filteredCount(lambda x: x>1, distinctcolors.values())
-        doublevalues = util.filteredCount(lambda x: x>1, distinctvalues.values())
-        N = len(tiles)              #total number of tiles in the set
-        DV = len(distinctvalues)    #number of distinct values in the set
-        DC = len(distinctcolors)    #number of distinct colors in the set
-        log.debug("N=",N,"DV=",DV,"DC=",DC,"jokers=",jokers)
-
-        #the initial assumption is that the set is invalid
-        settype = Set.SETTYPE_INVALID
-        if (DC==1 and DV==1) or (N-jokers<=1):
-            #the set contains a single tile or one or two jokers and one other tile, 
-            #so the type cannot be determined yet
-            settype = Set.SETTYPE_UNDECIDED
-        elif DC==1 and DV>1:
-            #multiple values of the same color, looks like a run 
-            if doublevalues==0 and N<=13 and self.isValidRun(tiles):
-                #now we are certain this is a valid run:
-                settype = Set.SETTYPE_RUN
-        elif DC>1 and DV==1:
-            #multiple tiles with the same value but multiple colors, could be a group
-            if doublecolors==0 and N<=4:
-                #now we are certain this is a valid group
-                settype = Set.SETTYPE_GROUP
-            
-        log.debug(
-            type(self), 
-            ".getSetType(", 
-            util.collectionToString(
-                tiles, 
-                lambda item: str(item.getValue(context=tiles, settype=settype))), 
-            ") --> ", 
-            Set.SETTYPES[settype]
-        )
-        return settype
+        if tiles == None:
+            return self.__state.getType()
+        return tilecode.classify([t.code() for t in tiles])
 
     def tileFitPosition(self, tile, pos=None):
         """
@@ -327,53 +483,108 @@ class Set(TileContainer):
         the order of tiles.
         """
         if self.containsTile(tile): return 0
-        orderedTiles = self.getOrderedTiles()
-        N = len(orderedTiles)
+        code = tile.code()
+        N = len(self.__order)
         if pos==None:
             #try adding the new tile at the end of the set
-            if self.getSetType(orderedTiles+[tile]) != Set.SETTYPE_INVALID:
+            if self.__state.fit(code, N) != Set.SETTYPE_INVALID:
                 return N+1
             #try adding the new tile at the beginning of the set
-            elif self.getSetType([tile]+orderedTiles) != Set.SETTYPE_INVALID:
+            elif self.__state.fit(code, 0) != Set.SETTYPE_INVALID:
                 return 1
             else:
                 return 0
         elif pos>0:
-            orderedTiles.insert(pos-1, tile)
-            if self.getSetType(orderedTiles) != Set.SETTYPE_INVALID:
+            if self.__state.fit(code, pos-1) != Set.SETTYPE_INVALID:
                 return pos
             else:
                 return 0
 
     def isValid(self):
-        return self.getSize()>=3 and self.getSetType(self.getOrderedTiles()) != Set.SETTYPE_INVALID
+        """
+        Returns True if this Set is a complete, legal set. The classification is maintained while tiles are added and removed,
+        so this does not need to inspect the tiles.
+        """
+        return len(self.__order)>=3 and self.__state.getType() != Set.SETTYPE_INVALID
 
 class Pile(TileContainer):
-    def __init__(self, parent):
+    def __init__(self, parent, createTiles=True):
         super().__init__(parent)
         self.__nextId = 0
         self.persist("nextId", 0)
-        for color in GameConstants.TILECOLORS:
-            for value in GameConstants.TILEVALUES:
-                for i in range(2):
-                    t = Tile.create(self.getNextId(), color, value, self)
-                    TileContainer.addTile(self, t)
-        TileContainer.addTile(self, Joker.create(self.getNextId(), GameConstants.BLACK, self))
-        TileContainer.addTile(self, Joker.create(self.getNextId(), GameConstants.RED, self))
+        if createTiles:
+            self.createTiles()
+
+    __tileTable__ = [(color, value) for color in GameConstants.TILECOLORS for value in GameConstants.TILEVALUES for i in range(2)] + \
+        [(GameConstants.BLACK, 0), (GameConstants.RED, 0)]
+
+    def getTileTable():
+        """
+        Returns: a list of tuples (color, value) of all the tiles of a game, in the order of their ids. 
+        The value of a joker is 0. The list is shared, it must not be modified.
+        """
+        return Pile.__tileTable__
+
+    def getDeck(tiles, seed):
+        """
+        Returns: the list of tile ids in tiles, shuffled by a random generator initialized with seed (see shuffle)
+        """
+        deck = list(tiles)
+        random.Random(seed).shuffle(deck)
+        return deck
+
+    def createTiles(self):
+        table = Pile.getTileTable()
+        self.getTileRegistry().createTiles(table, self)
+        self.__nextId = len(table)
+        self.putTiles(range(len(table)))
+
+    def copyTilesFrom(self, source):
+        super().copyTilesFrom(source)
+        self.__nextId = source.__nextId
+
+    def setNextId(self, nextId):
+        self.__nextId = nextId
 
     def getNextId(self):
         nextId = self.__nextId
         self.__nextId = self.__nextId+1
         return nextId
 
+    def setTiles(self, tiles):
+        """
+        Overrides TileContainer.setTiles(self, tiles) to also restore the order of the tiles, which is the order of the deck
+        """
+        super().setTiles(tiles)
+        if tiles:
+            self.setTileOrder(tiles)
+
+    def shuffle(self, seed):
+        """
+        Shuffles the pile into a deck, using a random generator initialized with seed, 
+        so that the same seed always results in the same deck.
+        The tiles are recorded as moved in the order of the deck, so that a patch (see ModelObject.getPatch) reproduces the deck.
+        """
+        deck = Pile.getDeck(self.getTiles(), seed)
+        self.setTileOrder(deck)
+        self.setModified()
+        self.getTileRegistry().stampMoves(deck, self.getStamp())
+
+    def deal(self, players, count):
+        """
+        Deals count tiles from the top of the deck to each of the players
+        """
+        with self.batch():
+            for player in players:
+                self.dealTiles(player.getPlate(), count)
+
     def pickTile(self, player):
-        tiles = self.getTiles()
-        n = len(tiles)
-        pickedTile = None
-        if n>0:
-            pick = random.sample(list(tiles), 1)[0]
-            #log.debug("pick: ", pick)
-            pickedTile = self.getTile(pick)
+        """
+        Moves the tile at the top of the deck to the plate of player
+        Returns: the picked tile, or None if the pile is empty
+        """
+        pickedTile = self.getLastTile()
+        if pickedTile:
             log.debug(function=self.pickTile, args=(player, pickedTile))
             pickedTile.move(player.plate)
         return pickedTile
@@ -382,6 +593,7 @@ class Board(TileContainer):
     def __init__(self, parent):
         super().__init__(parent)
         self.__sets = []
+        self.__modifiedSets = {}    #the sets that were modified since the last commit (a dict, to keep them in order)
         
     def getSets(self):
         return self.__sets
@@ -389,11 +601,70 @@ class Board(TileContainer):
     def addSet(self):
         set = Set(self)
         self.__sets.append(set)
+        self.__modifiedSets[set] = True
+        stack = self.getUndoStack()
+        if stack != None:
+            stack.record((UndoStack.ADD, self, set))
         return set
 
+    def removeChild(self, childObject):
+        super().removeChild(childObject)
+        if childObject in self.__sets:
+            self.__sets.remove(childObject)
+        self.__modifiedSets.pop(childObject, None)
+
+    def childModified(self, child):
+        if isinstance(child, Set):
+            self.__modifiedSets[child] = True
+
+    def copyTilesFrom(self, source):
+        """
+        Overrides TileContainer.copyTilesFrom(self, source) to also copy which of the sets of source are on the board, 
+        and which are modified. The children of this board must correspond to the children of source.
+        """
+        super().copyTilesFrom(source)
+        sets = dict(zip(source.getChildren(), self.getChildren()))
+        self.__sets = [sets[s] for s in source.__sets]
+        self.__modifiedSets = {sets[s]: True for s in source.__modifiedSets}
+
+    def getPatchData(self, since):
+        """
+        Overrides TileContainer.getPatchData(self, since) to add the indexes of the children that are on the board.
+        Sets that are removed from the board remain children of the board.
+        """
+        data = super().getPatchData(since)
+        children = {c: i for i, c in enumerate(self.getChildren())}
+        data["sets"] = [children[s] for s in self.__sets]
+        return data
+
+    def setPatchData(self, data):
+        """
+        Overrides TileContainer.setPatchData(self, data) to put the children with the indexes in data["sets"] on the board.
+        Without "sets" (the data of a serialized game, see ModelObject.restore), the sets with tiles are put on the board.
+        """
+        data = dict(data)
+        children = list(self.getChildren())
+        sets = data.pop("sets", None)
+        if sets != None:
+            self.__sets = [children[i] for i in sets]
+        else:
+            self.__sets = [c for c in children if isinstance(c, Set) and not c.isEmpty()]
+        super().setPatchData(data)
+
+    def getModifiedSets(self):
+        """
+        Returns: a list of the sets that were modified since the last commit. 
+        Sets that were not modified are valid, so only these sets need to be validated or cleaned up.
+        """
+        return list(self.__modifiedSets)
+
+    def clearModified(self, recursive=False):
+        super().clearModified(recursive)
+        self.__modifiedSets = {}
+
     def validateSets(self):
         invalid = 0
-        for s in self.__sets:
+        for s in self.getModifiedSets():
             if not s.isEmpty():
                 if not s.isValid():
                     invalid += 1
@@ -403,28 +674,33 @@ class Board(TileContainer):
         
     def cleanUp(self, validateSets=True):
         log.debug(function=self.cleanUp, args=validateSets)
-        #cleanup unfinished and invalid sets
-        for s in self.__sets:
-            if not s.isEmpty():
-                if validateSets and s.isValid():
-                    # make the valid moves permanent
-                    for tId in s.copyTiles():
-                        t = s.getTile(tId)
-                        t.forgetPlate()
-                else:
-                    # undo the invalid moves (move back to the player's plate)
-                    for tId in s.copyTiles():
-                        t = s.getTile(tId)
-                        if t.plate:
-                            #move tile back to the current player's plate
-                            t.move(t.plate)
-        #remove all empty sets
-        i = 0
-        for s in self.__sets:
-            if s.isEmpty():
-                self.__sets.pop(i)
-            else:
-                i+=1
+        with self.batch():
+            #cleanup unfinished and invalid sets, only the modified sets can contain tiles that were moved from a plate
+            modifiedSets = self.getModifiedSets()
+            for s in modifiedSets:
+                if not s.isEmpty():
+                    if validateSets and s.isValid():
+                        # make the valid moves permanent
+                        for tId in s.copyTiles():
+                            t = s.getTile(tId)
+                            t.forgetPlate()
+                    else:
+                        # undo the invalid moves (move back to the player's plate)
+                        for tId in s.copyTiles():
+                            t = s.getTile(tId)
+                            if t.plate:
+                                #move tile back to the current player's plate
+                                t.move(t.plate)
+            #remove the sets that became empty
+            removed = False
+            for s in modifiedSets:
+                if s.isEmpty() and s in self.__sets:
+                    self.__sets.remove(s)
+                    removed = True
+            #without validation, the sets that keep tiles (moved on the board) are not known to be valid, so they remain modified
+            self.__modifiedSets = {} if validateSets else {s: True for s in modifiedSets if not s.isEmpty()}
+            if removed:
+                self.setModified()
 
     def addTile(self, tile, pos=None):
         TileContainer.addTile(self, tile, pos)
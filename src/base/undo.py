@@ -0,0 +1,109 @@
+from lib import log
+
+class UndoStack:
+    """
+    The moves of the current turn of a game, recorded as the operations that undo them.
+    Every move (see Tile.move) is a group of operations: the tile move itself, and the changes it causes,
+    such as the set that Board.addTile creates for the tile. Undoing a move undoes its group in reverse order,
+    so reverting a turn costs as many moves as were made in the turn.
+    The operations are tuples:
+    - (MOVE, tile, source, position, plate): tile was moved from source, where it was at position (see TileContainer.getTilePosition),
+      and tile.plate was plate before the move
+    - (ADD, parent, child): child was added to parent
+    - (POS, set, pos): the position of set was pos
+    The stack relates to a state of the game, its base: the (origin, version) of the game when the stack was last cleared
+    (see ModelObject.getOrigin and getVersion).
+    """
+    MOVE = 0
+    ADD = 1
+    POS = 2
+
+    def __init__(self):
+        self.__groups = []
+        self.__depth = 0    #the number of moves in progress, a move can cause other moves
+        self.__base = None
+
+    def clear(self, base=None):
+        self.__groups = []
+        self.__depth = 0
+        self.__base = base
+
+    def getBase(self):
+        return self.__base
+
+    def getSize(self):
+        """
+        Returns: the number of moves that can be undone
+        """
+        return len(self.__groups)
+
+    def reserve(self):
+        """
+        Starts recording a move. The operation that undoes the move is added later (see fill), but precedes the operations
+        of the changes that the move causes.
+        Returns: the slot of the operation
+        """
+        if self.__depth == 0:
+            self.__groups.append([])
+        self.__depth += 1
+        group = self.__groups[-1]
+        group.append(None)
+        return len(group)-1
+
+    def fill(self, slot, operation):
+        """
+        Completes the recording of the move that reserved slot, with operation
+        """
+        self.__groups[-1][slot] = operation
+        self.__depth -= 1
+
+    def release(self, slot):
+        """
+        Ends the recording of a move that reserved slot, but did not take place
+        """
+        group = self.__groups[-1]
+        del group[slot:]
+        self.__depth -= 1
+        if self.__depth == 0 and not group:
+            self.__groups.pop()
+
+    def record(self, operation):
+        """
+        Records operation, as part of the move in progress, or else as a group of its own
+        """
+        if self.__depth == 0:
+            self.__groups.append([operation])
+        else:
+            self.__groups[-1].append(operation)
+
+    def undo(self):
+        """
+        Undoes the last move.
+        Returns: False if there is no move to undo
+        """
+        if not self.__groups or self.__depth:
+            return False
+        group = self.__groups.pop()
+        log.debug(function=self.undo, args=len(group))
+        for operation in reversed(group):
+            if operation[0] == UndoStack.MOVE:
+                kind, tile, source, position, plate = operation
+                source.restoreTile(tile, position)
+                if plate != None:
+                    tile.rememberPlate(plate)
+                else:
+                    tile.forgetPlate()
+            elif operation[0] == UndoStack.ADD:
+                kind, parent, child = operation
+                parent.removeChild(child)
+            elif operation[0] == UndoStack.POS:
+                kind, set, pos = operation
+                set.restorePos(pos)
+        return True
+
+    def undoAll(self):
+        """
+        Undoes all moves, most recent first
+        """
+        while self.undo():
+            pass
@@ -0,0 +1,334 @@
+import gc
+import os
+import sys
+import json
+import random
+import timeit
+import asyncio
+import tracemalloc
+import tempfile
+from base.model import *
+from base import tilecode
+from base import gameformat
+from base.journal import Journal
+from base.history import StateHistory
+from lib.pubsub import MessageQueue, Publisher, Subscriber, SyncDelivery, AsyncioDelivery, ThreadDelivery, WxDelivery, TopicRouter
+
+"""
+Micro benchmarks for the model. Run all benchmarks with:
+    python benchmark.py
+or a selection of them by name:
+    python benchmark.py classify
+"""
+
+def report(name, seconds, count):
+    print("{:<40} {:>12.2f} us".format(name, 1e6*seconds/count))
+
+def randomSets(count, seed=1):
+    """
+    Returns a list of count random sets (lists of tile codes) of 3..6 tiles,
+    about half of which are legal runs or groups
+    """
+    rnd = random.Random(seed)
+    codes = [tilecode.encode(c, v) for c in GameConstants.TILECOLORS for v in GameConstants.TILEVALUES]
+    sets = []
+    for i in range(count):
+        n = rnd.randint(3, 6)
+        color, value = rnd.choice(GameConstants.TILECOLORS), rnd.randint(1, 14-n)
+        if i % 2:
+            s = [rnd.choice(codes) for j in range(n)]
+        elif rnd.random() < 0.5:
+            s = [tilecode.encode(color, value+j) for j in range(n)]
+        else:
+            s = [tilecode.encode(c, value) for c in GameConstants.TILECOLORS[:min(n, 4)]]
+        if rnd.random() < 0.3:
+            s[rnd.randrange(len(s))] = tilecode.JOKER
+        sets.append(s)
+    return sets
+
+def bench_classify(count=5000, repeat=5):
+    sets = randomSets(count)
+    probe = Set(ModelObject())
+    tileSets = []
+    for codes in sets:
+        registry = TileRegistry()
+        s = []
+        for i,code in enumerate(codes):
+            if tilecode.isJoker(code):
+                s.append(registry.createJoker(i, GameConstants.BLACK, None))
+            else:
+                s.append(registry.createTile(i, tilecode.colorOf(code), tilecode.valueOf(code), None))
+        tileSets.append(s)
+    print("set validation,", count, "random sets:")
+    report("Set.getSetType (Tile instances)", min(timeit.repeat(lambda: [probe.getSetType(s) for s in tileSets], number=1, repeat=repeat)), count)
+    report("tilecode.classify", min(timeit.repeat(lambda: [tilecode.classify(s) for s in sets], number=1, repeat=repeat)), count)
+
+def bench_fit(count=10000):
+    s = Set(ModelObject())
+    for v in range(1, 13):
+        s.addTile(Tile.create(v, GameConstants.BLUE, v, s))
+    fits = Tile.create(13, GameConstants.BLUE, 13, s)
+    misfit = Tile.create(14, GameConstants.RED, 13, s)
+    print("fit checks on a run of 12 tiles:")
+    report("Set.tileFitPosition (fits)", timeit.timeit(lambda: s.tileFitPosition(fits), number=count), count)
+    report("Set.tileFitPosition (does not fit)", timeit.timeit(lambda: s.tileFitPosition(misfit), number=count), count)
+    report("Set.isValid", timeit.timeit(s.isValid, number=count), count)
+
+def startedGame(players=2, seed=1):
+    game = Game(players, seed)
+    for i in range(players):
+        game.addPlayerByName("player" + str(i+1))
+    game.start()
+    return game
+
+def midGame(players=4, seed=1):
+    """
+    Returns a started game with a run of 4 tiles of each color on the board
+    """
+    game = startedGame(players, seed)
+    for color in GameConstants.TILECOLORS:
+        set = game.board.addSet()
+        for value in range(1, 5):
+            tile = game.pile.findTile(value, color)
+            if tile:
+                tile.move(set)
+    game.commit()
+    return game
+
+def bench_clone(count=200):
+    game = midGame()
+    def roundTrip():
+        clonedGame = Game()
+        clonedGame.deserialize(game.serialize())
+        return clonedGame
+    print("cloning a game with 4 players and 4 sets on the board:")
+    report("serialize/deserialize round-trip", timeit.timeit(roundTrip, number=count), count)
+    report("Game.clone", timeit.timeit(game.clone, number=count), count)
+
+def bench_format(count=200, repeat=5):
+    game = midGame()
+    text = json.dumps(game.serialize())
+    data = gameformat.encode(game)
+    def loadJSON():
+        loadedGame = Game()
+        loadedGame.deserialize(json.loads(text))
+        return loadedGame
+    print("saved game with 4 players and 4 sets on the board:")
+    print("{:<40} {:>12d} bytes".format("JSON", len(text)))
+    print("{:<40} {:>12d} bytes".format("binary", len(data)))
+    for name, f in (("JSON encode", lambda: json.dumps(game.serialize())), ("binary encode", lambda: gameformat.encode(game)),
+                    ("JSON decode", loadJSON), ("binary decode", lambda: gameformat.decode(data))):
+        report(name, min(timeit.repeat(f, number=count, repeat=repeat)), count)
+
+def bench_load(count=200):
+    game = midGame()
+    data = game.serialize()
+    def deserialize():
+        loadedGame = Game()
+        loadedGame.deserialize(data)
+        return loadedGame
+    print("loading a serialized game with 4 players and 4 sets on the board:")
+    report("Game() + deserialize", timeit.timeit(deserialize, number=count), count)
+    report("Game.fromData", timeit.timeit(lambda: Game.fromData(data), number=count), count)
+
+def bench_persistence(count=300):
+    game = midGame()
+    data = game.serialize()
+    set = game.board.getSets()[0]
+    def deserialize():
+        loadedGame = Game()
+        loadedGame.deserialize(data)
+    print("persistence of a game with 4 players and 4 sets on the board:")
+    report("Set.getPersistentAttributes", timeit.timeit(set.getPersistentAttributes, number=count*10), count*10)
+    report("Game.serialize", timeit.timeit(game.serialize, number=count), count)
+    report("Game.serialize (borrowed)", timeit.timeit(lambda: game.serialize(True), number=count), count)
+    for name, borrowed in (("Game.serialize", False), ("Game.serialize (borrowed)", True)):
+        game.serialize(borrowed)
+        tracemalloc.start()
+        data = game.serialize(borrowed)
+        print("{:<40} {:>12d} bytes allocated".format(name, tracemalloc.get_traced_memory()[0]))
+        tracemalloc.stop()
+    report("Game.deserialize", timeit.timeit(deserialize, number=count), count)
+
+def bench_journal(count=500):
+    game = midGame()
+    version = game.getVersion()
+    game.pick()
+    record = {"op": "patch", "gamenr": 1, "patch": game.getPatch(version)}
+    print("journaling", count, "patches of a pick:")
+    with tempfile.TemporaryDirectory() as d:
+        for name, syncCount in (("fsync per record", 1), ("group fsync", 32)):
+            journal = Journal(os.path.join(d, str(syncCount)), syncCount, 1)
+            def append():
+                for i in range(count):
+                    journal.append(record)
+                journal.sync()
+            report("Journal.append, " + name, timeit.timeit(append, number=1), count)
+            journal.close()
+            print("{:<40} {:>12d}".format("fsyncs", journal.syncs))
+
+def bench_history(count=16):
+    game = midGame()
+    history = StateHistory(count)
+    full = 0
+    for i in range(count):
+        game.pick()
+        data = game.serialize()
+        history.push(data)
+        full += StateHistory.sizeOf(data)
+    print("history of", count, "states of a game with 4 players, with a pick between states:")
+    print("{:<40} {:>12d} bytes".format("unshared states", full))
+    print("{:<40} {:>12d} bytes".format("StateHistory", history.getMemoryUsage()))
+    model = Model(game)
+    model.rememberState()
+    def turn():
+        player = model.getCurrentGame().getCurrentPlayer()
+        for i in range(3):
+            player.plate.getLastTile().move(model.getCurrentGame().board)
+    def undo():
+        turn()
+        model.revertGame()
+    def restore():
+        turn()
+        model.getCurrentGame().getUndoStack().clear()
+        model.revertGame()
+    def rebuild():
+        turn()
+        model.currentGame = Game.fromData(model.getLastValidState())
+    report("3 moves + undo", timeit.timeit(undo, number=100), 100)
+    report("3 moves + ModelObject.restore", timeit.timeit(restore, number=100), 100)
+    report("3 moves + Game.fromData", timeit.timeit(rebuild, number=100), 100)
+
+def bench_queue(count=20000):
+    mq = MessageQueue.getInstance()
+    handled = []
+    messages = [(handled.append, {"event": "msg_object_modified", "object": i}) for i in range(count)]
+    def drainList():
+        queue = list(messages)
+        while queue:
+            handler, payload = queue.pop(0)
+            handler(payload)
+    def drainQueue():
+        MessageQueue.addMessages(messages)
+        MessageQueue.handleMessages()
+    MessageQueue.configure(count)
+    print("queueing and handling", count, "messages:")
+    report("list with pop(0)", timeit.timeit(drainList, number=1), count)
+    report("MessageQueue", timeit.timeit(drainQueue, number=1), count)
+    print("{:<40} {:>12d}".format("high-water mark", MessageQueue.getStats()["highWaterMark"]))
+    MessageQueue.configure(MessageQueue.MAXQUEUESIZE)
+
+def bench_delivery(count=20000):
+    publisher = Publisher(["msg_object_modified"])
+    handled = []
+    subscriber = Subscriber()
+    publisher.subscribe(subscriber, "msg_object_modified", handled.append)
+    def dispatch():
+        for i in range(count):
+            publisher.dispatch("msg_object_modified", {"object": i})
+    def deliverSync():
+        dispatch()
+    async def dispatchAsync():
+        dispatch()
+        await asyncio.sleep(0)
+    def deliverAsyncio():
+        asyncio.run(dispatchAsync())
+    def deliverThread():
+        dispatch()
+        MessageQueue.getDelivery().flush()
+    def deliverWx():
+        dispatch()
+        wx.CallAfter(app.ExitMainLoop)
+        app.MainLoop()
+    backends = [("sync", SyncDelivery, deliverSync), ("asyncio", AsyncioDelivery, deliverAsyncio), ("dispatcher thread", ThreadDelivery, deliverThread)]
+    try:
+        import wx
+        app = wx.App()
+        backends.append(("wx", WxDelivery, deliverWx))
+    except ImportError:
+        print("wx is not available")
+    print("dispatching", count, "events to a subscriber, queue of", MessageQueue.MAXQUEUESIZE, "messages:")
+    for name, backend, deliver in backends:
+        delivery = backend()
+        MessageQueue.setDelivery(delivery)
+        handled.clear()
+        seconds = timeit.timeit(deliver, number=1)
+        assert len(handled) == count
+        report(name, seconds, count)
+        print("{:<40} {:>12d}".format("drains", delivery.drains))
+    MessageQueue.setDelivery(SyncDelivery())
+
+def bench_instrumentation(count=20000):
+    publisher = Publisher(["msg_object_modified"])
+    handled = []
+    subscriber = Subscriber()
+    publisher.subscribe(subscriber, "msg_object_modified", handled.append)
+    def dispatch():
+        for i in range(count):
+            publisher.dispatch("msg_object_modified", {"object": i})
+    print("dispatching", count, "events to a subscriber:")
+    report("not instrumented", min(timeit.repeat(dispatch, number=1, repeat=3)), count)
+    instrumentation = MessageQueue.instrument()
+    report("instrumented", min(timeit.repeat(dispatch, number=1, repeat=3)), count)
+    MessageQueue.instrument(False)
+    print(instrumentation.report())
+
+def bench_router(count=20000):
+    handled = []
+    subscribers = []
+    print("publishing", count, "events on a topic of depth 3, with a subscription to the topic and to the tree above it:")
+    for others in (0, 1000):
+        router = TopicRouter()
+        for i in range(others + 2):
+            subscriber = Subscriber()
+            subscribers.append(subscriber)
+            pattern = ("Game1", "Board2", "Set" + str(i+10)) if i < others else (("Game1", "Board2", "Set3"), ("Game1", "**"))[i-others]
+            router.subscribe(subscriber, pattern, "msg_object_modified", handled.append)
+        topic = ("Game1", "Board2", "Set3")
+        def publish():
+            for i in range(count):
+                router.publish(topic, "msg_object_modified", {"object": i})
+        report("publish, " + str(others) + " other subscriptions", timeit.timeit(publish, number=1), count)
+
+def bench_memory(count=50):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    games = [startedGame() for i in range(count)]
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("memory footprint of", count, "started games with 2 players:")
+    print("{:<40} {:>12.1f} KiB".format("per game", (after-before)/count/1024))
+
+def bench_start(count=200):
+    games = []
+    for i in range(count):
+        game = Game(4, i)
+        for p in range(4):
+            game.addPlayerByName("player" + str(p+1))
+        games.append(game)
+    print("starting a game with 4 players:")
+    report("Game.start", timeit.timeit(lambda: games.pop().start(), number=count), count)
+
+BENCHMARKS = {
+    "classify": bench_classify,
+    "fit": bench_fit,
+    "memory": bench_memory,
+    "start": bench_start,
+    "clone": bench_clone,
+    "format": bench_format,
+    "persistence": bench_persistence,
+    "load": bench_load,
+    "journal": bench_journal,
+    "history": bench_history,
+    "queue": bench_queue,
+    "delivery": bench_delivery,
+    "instrumentation": bench_instrumentation,
+    "router": bench_router,
+}
+
+if __name__ == "__main__":
+    MessageQueue.getInstance(True)
+    for name in (sys.argv[1:] or BENCHMARKS.keys()):
+        BENCHMARKS[name]()
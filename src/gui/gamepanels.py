@@ -139,7 +139,8 @@ class PlatePanel(TileWidgetView):
         if not player: return
         assert isinstance(player, model.Player)
         self.player = player
-        self.player.subscribe(self, "msg_object_modified", self.onMsgPlayerModified)
+        # the plate of the player is shown, so also subscribe to the modifications of the plate
+        self.player.subscribeTree(self, "msg_object_modified", self.onMsgPlayerModified)
         
     def getPlayer(self):
         if hasattr(self, "player"):
@@ -237,10 +238,6 @@ class GamePanel(wx.Panel):
 
         self.reset()
 
-    def __del__(self):
-        self.controller.model.unsubscribe(self, self.onMsgGameLoaded, "msg_game_loaded")
-        self.controller.model.unsubscribe(self, self.onMsgGameReverted, "msg_game_reverted")
-
     def getGame(self):
         assert controller!=None
         return self.controller.getCurrentGame()
@@ -283,7 +280,9 @@ class GamePanel(wx.Panel):
         log.debug(function=self.onMsgGameLoaded, args=payload)
         game = payload["game"]
         if game:
-            self.reset()
+            # a game that was reverted in place keeps its objects, so the widgets only need to be refreshed
+            if not payload.get("inplace"):
+                self.reset()
             self.refresh()
 
     def onMsgGameModified(self, payload):
@@ -21,15 +21,17 @@ class PlayerWidget(wx.Panel):
         self.reset(player)
 
     def Destroy(self):
-        self.set.unsubscribe("msg_object_modified", self)
+        if self.player:
+            self.player.unsubscribeTree("msg_object_modified", self)
         super().Destroy()
 
     def reset(self, player=None):
         if self.player:
-            self.player.unsubscribe("msg_object_modified", self)
+            self.player.unsubscribeTree("msg_object_modified", self)
         self.player = player
         if self.player != None:
-            self.player.subscribe(self, "msg_object_modified", self.onMsgPlayerModified)
+            # the size of the plate is shown, so also subscribe to the modifications of the plate
+            self.player.subscribeTree(self, "msg_object_modified", self.onMsgPlayerModified)
     
     def playerInfo(self):
         return self.player.getName() + "(" + str(self.player.getPlate().getSize()) + ")"
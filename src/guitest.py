@@ -8,7 +8,7 @@ from lib import log
 
 from gui import styles, draggable, tilewidget
 
-from base.tile import TileFactory
+from base.tile import TileRegistry
 
 RESOURCES="src/resource"
 ID_EXIT=200
@@ -107,7 +107,7 @@ class MainWindow(wx.Frame):
         target2.bindToDraggableEvents(draggable2)
         target3.bindToDraggableEvents(draggable2)
 
-        tw = tilewidget.TileWidget(target1, TileFactory.getInstance().createJoker(1,0,None))
+        tw = tilewidget.TileWidget(target1, TileRegistry().createJoker(1,0,None))
         target1.bindToDraggableEvents(tw)
         target2.bindToDraggableEvents(tw)
         target3.bindToDraggableEvents(tw)
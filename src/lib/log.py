@@ -1,5 +1,5 @@
+import sys
 import logging
-import inspect
 from lib import util
 
 loggers = {}
@@ -48,8 +48,9 @@ def log(logger_method, msg, *args, **kwargs):
     logger_method(msg)
 
 def getLogger():
-    frm = inspect.stack()[2]
-    modName = inspect.getmodule(frm[0]).__name__
+    # the module of the caller of debug, warning, error or trace
+    # (looking up the frame directly, inspect.stack() reads the source of every frame on the stack)
+    modName = sys._getframe(2).f_globals["__name__"]
     if modName in loggers:
         logger = loggers[modName]
     else:
@@ -67,16 +68,26 @@ def setLoggerLevel(modName, level):
     logger.setLevel(level)
 
 
+# the message is only composed when the logger is enabled for the level
+
 def debug(*args, **kwargs):
-    log(getLogger().debug, "", *args, **kwargs)
+    logger = getLogger()
+    if logger.isEnabledFor(logging.DEBUG):
+        log(logger.debug, "", *args, **kwargs)
 
 def warning(*args, **kwargs):
-    log(getLogger().warning, "", *args, **kwargs)
+    logger = getLogger()
+    if logger.isEnabledFor(logging.WARNING):
+        log(logger.warning, "", *args, **kwargs)
 
 def error(*args, **kwargs):
-    log(getLogger().error, "", *args, **kwargs)
+    logger = getLogger()
+    if logger.isEnabledFor(logging.ERROR):
+        log(logger.error, "", *args, **kwargs)
 
 def trace(*args, **kwargs):
-    log(getLogger().info, "", *args, **kwargs)
+    logger = getLogger()
+    if logger.isEnabledFor(logging.INFO):
+        log(logger.info, "", *args, **kwargs)
 
 
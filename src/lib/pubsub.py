@@ -1,29 +1,107 @@
 import asyncio
-import functools
+import threading
+import time
+import weakref
+from collections import deque
 import lib.log
 
 class MessageQueue:
+    """
+    The queue of the messages (tuples (handler, payload)) dispatched by all Publisher instances.
+    The queue is bounded by MAXQUEUESIZE, see configure for what happens when a message is pushed onto a full queue.
+    The messages are handled by a delivery backend (see Delivery and setDelivery), which decides when, and in which thread,
+    the queued messages are handled.
+    The dispatching and handling of messages can be measured, see instrument.
+    """
     MAXQUEUESIZE = 20
+    # overflow policies:
+    BLOCK = "block"             #the publisher waits for the delivery to handle the oldest messages, or handles them itself in the thread of the delivery (see Delivery.makeRoom), until the queue has room again
+    DROPOLDEST = "dropoldest"   #the oldest message is dropped
+    COALESCE = "coalesce"       #a message of an idempotent event replaces the payload of a queued message with the same handler and identity (see IDEMPOTENT), otherwise the oldest message is dropped
+    POLICIES = [BLOCK, DROPOLDEST, COALESCE]
+    # the events whose messages are idempotent, with the payload fields that identify what a message is about: 
+    # handling the newest message of a handler about the same thing is enough. Only these messages are coalesced.
+    IDEMPOTENT = {"msg_object_modified": ("object",)}
     instance = None
     asyncOff = False
+    instrumentation = None  #the Instrumentation that measures the messages, None when they are not measured
     
     def getInstance(asyncOff=False):
+        """
+        Returns: the queue, which is created on the first call. It then gets a SyncDelivery when asyncOff is True, 
+        and an AsyncioDelivery otherwise.
+        """
         if MessageQueue.instance == None: 
             MessageQueue.instance = MessageQueue.__MessageQueue__(MessageQueue.MAXQUEUESIZE)
             MessageQueue.asyncOff = asyncOff
+            MessageQueue.instance.setDelivery(SyncDelivery() if asyncOff else AsyncioDelivery())
         return MessageQueue.instance
+
+    def setDelivery(delivery):
+        """
+        Makes delivery (an instance of Delivery) handle the queued messages, the previous delivery is closed
+        """
+        mq = MessageQueue.getInstance()
+        if mq.delivery != delivery:
+            mq.delivery.close()
+            mq.setDelivery(delivery)
+            MessageQueue.asyncOff = isinstance(delivery, SyncDelivery)
+            if mq.hasMessages():
+                delivery.wakeup()
+
+    def getDelivery():
+        return MessageQueue.getInstance().delivery
+
+    def instrument(enabled=True):
+        """
+        Starts (with a new Instrumentation) or stops measuring the dispatched and handled messages.
+        Returns: the Instrumentation, or None when stopped
+        """
+        MessageQueue.instrumentation = Instrumentation() if enabled else None
+        return MessageQueue.instrumentation
     
     def reset(asyncOff=False):
         mq = MessageQueue.getInstance(asyncOff)
         if mq:
             mq.reset()
-        
+
+    def configure(maxQueueSize=None, policy=None):
+        """
+        Sets the bound of the queue, and the policy (one of MessageQueue.POLICIES) for a message that is pushed onto a full queue.
+        """
+        mq = MessageQueue.getInstance()
+        if maxQueueSize != None:
+            assert maxQueueSize > 0
+            mq.maxQueueSize = maxQueueSize
+        if policy != None:
+            assert policy in MessageQueue.POLICIES
+            mq.setPolicy(policy)
+
+    def setIdempotent(event, fields):
+        """
+        Declares that the messages of event are idempotent (see IDEMPOTENT), fields are the payload fields 
+        (with hashable values) that identify what a message is about. None declares the messages not idempotent.
+        """
+        mq = MessageQueue.getInstance()
+        if fields == None:
+            MessageQueue.IDEMPOTENT.pop(event, None)
+        else:
+            MessageQueue.IDEMPOTENT[event] = tuple(fields)
+        mq.setPolicy(mq.policy)
+
+    def getStats():
+        """
+        Returns: a dict with the counters of the queue, see __MessageQueue__.getStats
+        """
+        return MessageQueue.getInstance().getStats()
 
     def handleMessages():
+        """
+        Handles the queued messages, including the messages that are queued while handling them
+        """
         mq = MessageQueue.getInstance()
-        while mq and True:
-            mq.handleNextMessage()
-            if not mq.hasMessages(): break
+        while mq.handleNextMessage():
+            pass
 
     def addMessages(messages):
         mq = MessageQueue.getInstance()
@@ -32,44 +110,171 @@ class MessageQueue:
                 mq.pushMsg(msg)
                 
     def processMessages(messages):
-        if MessageQueue.asyncOff:
-            MessageQueue.addMessages(messages)
-            MessageQueue.handleMessages()
-        else:
-            loop = asyncio.get_running_loop()
-
-            try:
-                callback = functools.partial(MessageQueue.addMessages, messages)
-                loop.call_soon_threadsafe(callback)
-            finally:
-                pass
-
-            try:
-                callback = MessageQueue.handleMessages
-                loop.call_soon_threadsafe(callback)
-            finally:
-                pass
+        """
+        Queues messages, and wakes up the delivery to handle them
+        """
+        MessageQueue.addMessages(messages)
+        MessageQueue.getInstance().delivery.wakeup()
             
     class __MessageQueue__:
-        def __init__(self, maxQueueSize):
-            self.queue = []
+        def __init__(self, maxQueueSize, policy=None):
+            self.queue = deque()
+            self.maxQueueSize = maxQueueSize
+            self.policy = policy if policy != None else MessageQueue.BLOCK
+            self.keys = {}      #the newest queued message per key (see key), only maintained for the coalesce policy
+            self.delivery = None
+            self.concurrent = False         #True if the delivery handles messages in another thread than the publishers
+            self.lock = threading.RLock()   #guards the queue when the delivery is concurrent
+            self.roomAvailable = threading.Condition(self.lock)
+            self.waiting = 0    #the number of publishers that wait for room in the queue, see waitForRoom
+            self.resetCounters()
             
+        def setDelivery(self, delivery):
+            with self.lock:
+                self.delivery = delivery
+                self.concurrent = delivery.concurrent
+
         def reset(self):
-            self.queue = []
-            
+            with self.lock:
+                self.queue = deque()
+                self.keys = {}
+                self.resetCounters()
+                self.roomAvailable.notify_all()
+
+        def resetCounters(self):
+            self.highWaterMark = 0  #the largest number of queued messages
+            self.dropped = 0        #the number of dropped messages
+            self.coalesced = 0      #the number of messages that were dropped because an equal message was queued
+            self.blocked = 0        #the number of times a publisher had to handle messages, because the queue was full
+
+        def setPolicy(self, policy):
+            self.policy = policy
+            self.keys = {}
+            if policy == MessageQueue.COALESCE:
+                queue = self.queue
+                self.queue = deque()
+                for msg in queue:
+                    self.queue.append(self.track(msg))
+
+        def key(self, msg):
+            """
+            Returns: the handler, event and identity of msg, or None if msg is not idempotent (see MessageQueue.IDEMPOTENT)
+            """
+            handler, payload = msg[0], msg[1]
+            event = payload.get("event")
+            fields = MessageQueue.IDEMPOTENT.get(event)
+            if fields == None or any(f not in payload for f in fields):
+                return None
+            return (handler, event) + tuple(payload[f] for f in fields)
+
+        def track(self, msg):
+            """
+            Returns: msg, as a list when it can be coalesced, so that a newer payload can replace its payload in the queue
+            """
+            k = self.key(msg)
+            if k != None:
+                msg = list(msg)
+                self.keys[k] = msg
+            return msg
+
+        def getStats(self):
+            """
+            Returns: a dict with the current number of queued messages ("depth"), and the counters
+            "highWaterMark", "dropped", "coalesced" and "blocked"
+            """
+            return {"depth": len(self.queue), "highWaterMark": self.highWaterMark, "dropped": self.dropped, 
+                    "coalesced": self.coalesced, "blocked": self.blocked}
+
         def pushMsg(self, msg):
+            """
+            Queues msg. When the queue is full and the policy is MessageQueue.BLOCK, the delivery makes room 
+            (see Delivery.makeRoom) outside the lock of the queue, since it may handle messages to make room.
+            """
+            blocked = False
+            while True:
+                if self.concurrent:
+                    with self.lock:
+                        queued = self.appendMsg(msg, blocked)
+                else:
+                    queued = self.appendMsg(msg, blocked)
+                if queued:
+                    return
+                blocked = True
+                self.delivery.makeRoom(self)
+
+        def appendMsg(self, msg, blocked=False):
+            """
+            Queues msg, unless the queue is full and the policy is MessageQueue.BLOCK.
+            Parameters:
+            - blocked: True if the publisher of msg was blocked before, so that it is counted once
+            Returns: False if msg was not queued, because there is no room for it
+            """
+            if len(self.queue) >= self.maxQueueSize:
+                if self.policy == MessageQueue.BLOCK:
+                    if not blocked:
+                        self.blocked += 1
+                    return False
+                queued = self.keys.get(self.key(msg)) if self.policy == MessageQueue.COALESCE else None
+                if queued != None:
+                    # the newer payload supersedes the payload of the queued message
+                    queued[1] = msg[1]
+                    self.coalesced += 1
+                    return True
+                self.popMsg()
+                self.dropped += 1
+            if self.policy == MessageQueue.COALESCE:
+                msg = self.track(msg)
             self.queue.append(msg)
+            if len(self.queue) > self.highWaterMark:
+                self.highWaterMark = len(self.queue)
+            return True
+
+        def waitForRoom(self):
+            """
+            Waits until the queue has room for a message, while another thread handles the queued messages.
+            """
+            with self.lock:
+                self.waiting += 1
+                try:
+                    while len(self.queue) >= self.maxQueueSize:
+                        self.roomAvailable.wait()
+                finally:
+                    self.waiting -= 1
+
+        def popMsg(self):
+            msg = self.queue.popleft()
+            if self.policy == MessageQueue.COALESCE:
+                k = self.key(msg)
+                if k != None and self.keys.get(k) is msg:
+                    del self.keys[k]
+            return msg
             
         def hasMessages(self):
             return (len(self.queue)>0)
         
         def handleNextMessage(self):
-            if self.hasMessages():
-                msg = self.queue.pop(0)
-                if msg:
-                    handler = msg[0]
-                    payload = msg[1]
-                    handler(payload)
+            """
+            Handles the oldest queued message, outside the lock of the queue
+            Returns: False if there was no message to handle
+            """
+            if self.concurrent:
+                with self.lock:
+                    if not self.queue:
+                        return False
+                    msg = self.popMsg()
+                    if self.waiting:
+                        self.roomAvailable.notify()
+            elif self.queue:
+                msg = self.popMsg()
+            else:
+                return False
+            if MessageQueue.instrumentation == None:
+                handler = msg[0]
+                payload = msg[1]
+                handler(payload)
+            else:
+                MessageQueue.instrumentation.handle(msg)
+            return True
                         
     def __init__(self):
         pass
@@ -78,37 +283,545 @@ class MessageQueue:
         MessageQueue.processMessages(messages)
                    
         
+class Delivery:
+    """
+    The base class of the delivery backends of the MessageQueue, which handle the queued messages.
+    A publisher queues its messages and then calls wakeup. A single wakeup handles all the messages 
+    that are queued by then (see drain), so a backend that handles the messages later schedules at most one drain at a time.
+    """
+    concurrent = True   #whether the messages may be handled in another thread than the thread that dispatched them
+
+    def __init__(self):
+        self.scheduled = False  #True while a drain is scheduled that has not started yet
+        self.drains = 0         #the number of drains, for instrumentation
+
+    def wakeup(self):
+        """
+        Makes the queued messages get handled
+        """
+        pass
+
+    def drain(self):
+        self.scheduled = False
+        self.drains += 1
+        MessageQueue.handleMessages()
+
+    def isDeliveryThread(self):
+        """
+        Returns: True if the current thread is the thread in which the delivery handles the messages
+        """
+        return True
+
+    def makeRoom(self, mq):
+        """
+        Makes room in mq, which is full, for a message of a publisher (see policy MessageQueue.BLOCK). 
+        Called without the lock of mq, so that other publishers are not blocked while the messages are handled.
+        A publisher in the thread of the delivery handles the oldest messages itself, since it can not wait for itself. 
+        A publisher in another thread wakes up the delivery and waits until it has made room, so that the messages 
+        are only handled in the thread of the delivery.
+        """
+        if self.isDeliveryThread():
+            while len(mq.queue) >= mq.maxQueueSize and mq.handleNextMessage():
+                pass
+        else:
+            self.wakeup()
+            mq.waitForRoom()
+
+    def close(self):
+        pass
+
+class SyncDelivery(Delivery):
+    """
+    Handles the messages immediately, in the thread of the publisher
+    """
+    concurrent = False
+
+    def wakeup(self):
+        self.drain()
+
+class AsyncioDelivery(Delivery):
+    """
+    Handles the messages in an asyncio event loop: loop, or else the loop that runs when the first message is dispatched.
+    Messages can be dispatched from any thread once the loop is known.
+    """
+    def __init__(self, loop=None):
+        Delivery.__init__(self)
+        self.loop = loop
+
+    def wakeup(self):
+        if not self.scheduled:
+            if self.loop == None:
+                self.loop = asyncio.get_running_loop()
+            self.scheduled = True
+            self.loop.call_soon_threadsafe(self.drain)
+
+    def isDeliveryThread(self):
+        if self.loop == None:
+            # the loop is only known after the first wakeup, which can only come from the thread of the loop
+            return True
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+class ThreadDelivery(Delivery):
+    """
+    Handles the messages in a dedicated dispatcher thread, so it does not need an event loop.
+    """
+    def __init__(self):
+        Delivery.__init__(self)
+        self.running = True
+        self.woken = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="MessageQueue", daemon=True)
+        self.thread.start()
+
+    def wakeup(self):
+        if not self.scheduled:
+            self.scheduled = True
+            self.woken.set()
+
+    def run(self):
+        while True:
+            self.woken.wait()
+            self.woken.clear()
+            if not self.running:
+                break
+            try:
+                self.drain()
+            except Exception as e:
+                # the dispatcher thread must survive a failing handler, or no message would be handled anymore
+                lib.log.error("handler failed:", repr(e), function=self.run)
+
+    def isDeliveryThread(self):
+        return threading.current_thread() is self.thread
+
+    def flush(self, timeout=None):
+        """
+        Waits until the messages that are queued by now are handled.
+        Returns: False if they were not handled within timeout seconds
+        """
+        handled = threading.Event()
+        MessageQueue.processMessages([(lambda payload: handled.set(), {"event": None})])
+        return handled.wait(timeout)
+
+    def close(self):
+        self.running = False
+        self.woken.set()
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+
+class WxDelivery(Delivery):
+    """
+    Handles the messages in the main loop of wxPython, with a single wx.CallAfter for all the messages that are queued 
+    until the main loop gets to it. Messages can be dispatched from any thread.
+    """
+    def __init__(self):
+        Delivery.__init__(self)
+        import wx
+        self.callAfter = wx.CallAfter
+        self.isMainThread = wx.IsMainThread
+
+    def wakeup(self):
+        if not self.scheduled:
+            self.scheduled = True
+            self.callAfter(self.drain)
+
+    def isDeliveryThread(self):
+        return self.isMainThread()
+
 class Subscriber:
     def update(self, message):
         print('{} got message "{}"'.format(self.name, message))
 
+class Histogram:
+    """
+    The distribution of measured values (such as durations in seconds, or counts), in buckets that double in size:
+    bucket i counts the values v with 2**(i-1) <= v/unit < 2**i, bucket 0 the values below unit.
+    """
+    def __init__(self, unit=1):
+        self.unit = unit
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = []
+
+    def add(self, value):
+        i = int(value/self.unit).bit_length()
+        if i >= len(self.buckets):
+            self.buckets.extend([0] * (i+1-len(self.buckets)))
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Returns: an upper bound of the value below which p percent of the values are, the upper bound of its bucket
+        """
+        if self.count == 0:
+            return 0
+        n = 0
+        for i, c in enumerate(self.buckets):
+            n += c
+            if n >= self.count * p / 100:
+                return min((2**i) * self.unit, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        Returns: a dict with the "count", "total", "mean", "p50", "p99" and "max" of the values, and the counts of the "buckets"
+        """
+        return {"count": self.count, "total": self.total, "mean": self.total/self.count if self.count else 0,
+                "p50": self.percentile(50), "p99": self.percentile(99), "max": self.max, "buckets": list(self.buckets)}
+
+class Instrumentation:
+    """
+    Measures, per event, the dispatched messages and how they are handled (see MessageQueue.instrument):
+    - the number of dispatches, and the fan-out: the number of messages per dispatch, one per subscriber
+    - the queue wait: the seconds between the dispatch of a message and the start of its handling
+    - the seconds that each handler takes, keyed by the qualified name of the handler
+    While the messages are measured, they carry the time of their dispatch: (handler, payload, time).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()    #the messages can be dispatched and handled in different threads
+        self.events = {}                #per event: a dict with "dispatches", "fanout", "wait" and "handlers"
+
+    def getEvent(self, event):
+        stats = self.events.get(event)
+        if stats == None:
+            stats = {"dispatches": 0, "fanout": Histogram(), "wait": Histogram(1e-6), "handlers": {}}
+            self.events[event] = stats
+        return stats
+
+    def dispatched(self, event, messages):
+        """
+        Records the dispatch of messages for event.
+        Returns: the messages, with the time of the dispatch
+        """
+        with self.lock:
+            stats = self.getEvent(event)
+            stats["dispatches"] += 1
+            stats["fanout"].add(len(messages))
+        now = time.perf_counter()
+        return [(handler, payload, now) for handler, payload in messages]
+
+    def handle(self, msg):
+        """
+        Handles msg, and records its queue wait and the duration of its handler
+        """
+        handler, payload = msg[0], msg[1]
+        start = time.perf_counter()
+        handler(payload)
+        end = time.perf_counter()
+        name = getattr(handler, "__qualname__", None) or type(handler).__qualname__
+        with self.lock:
+            stats = self.getEvent(payload.get("event"))
+            if len(msg) > 2:
+                stats["wait"].add(start - msg[2])
+            histogram = stats["handlers"].get(name)
+            if histogram == None:
+                histogram = Histogram(1e-6)
+                stats["handlers"][name] = histogram
+            histogram.add(end - start)
+
+    def snapshot(self):
+        """
+        Returns: a dict with, per event, a dict with the number of "dispatches", and the snapshots of the histograms 
+        (see Histogram.snapshot) of the "fanout", the queue "wait" and, in a dict keyed by qualified name, of the "handlers"
+        """
+        with self.lock:
+            return {event: {"dispatches": stats["dispatches"], "fanout": stats["fanout"].snapshot(), "wait": stats["wait"].snapshot(),
+                            "handlers": {name: h.snapshot() for name, h in stats["handlers"].items()}}
+                    for event, stats in self.events.items()}
+
+    def report(self):
+        """
+        Returns: the measurements as text, in microseconds: a line per event, with the percentiles of the queue wait, 
+        followed by a line per handler of the event, with the percentiles of its duration
+        """
+        lines = ["{:<48} {:>10} {:>8} {:>10} {:>10} {:>10}".format("event / handler", "count", "fan-out", "p50 us", "p99 us", "max us")]
+        for event, stats in sorted(self.snapshot().items(), key=lambda item: str(item[0])):
+            wait = stats["wait"]
+            lines.append("{:<48} {:>10d} {:>8.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(str(event), stats["dispatches"], stats["fanout"]["mean"], 
+                                                                                     1e6*wait["p50"], 1e6*wait["p99"], 1e6*wait["max"]))
+            for name, h in sorted(stats["handlers"].items(), key=lambda item: -item[1]["total"]):
+                lines.append("  {:<46} {:>10d} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}".format(name, h["count"], "", 1e6*h["p50"], 1e6*h["p99"], 1e6*h["max"]))
+        return "\n".join(lines)
+
+class LazyPayload(dict):
+    """
+    A payload (see Publisher.dispatch) with values that are computed when a subscriber first reads them,
+    for values that are expensive to compute and that not every subscriber needs. A computed value is kept,
+    so the subscribers that read it share it.
+    The values that are not computed yet are left out of keys, items and values.
+    Parameters:
+    - values: a dict with the values that are known when the payload is created
+    - factories: keyword arguments with the functions that compute the other values, without arguments
+    """
+    def __init__(self, values=None, **factories):
+        dict.__init__(self, values or {})
+        self.factories = factories
+
+    def __missing__(self, key):
+        factory = self.factories.get(key)
+        if factory == None:
+            raise KeyError(key)
+        value = factory()
+        self[key] = value
+        self.factories.pop(key, None)
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.factories
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
 class Publisher:
+    """
+    Dispatches the events of an object to the subscribers of each event.
+    The subscribers are referenced weakly, so subscribing to a publisher does not keep a subscriber alive.
+    A handler that is a method of its subscriber is referenced weakly as well, other handlers are referenced strongly.
+    Subscribers that no longer exist are pruned from the subscribers of an event when the event is dispatched 
+    or subscribed to. An object that can not be referenced weakly is referenced strongly.
+    The subscribers of an event are kept in a dict: reference to subscriber -> (reference to) handler, 
+    the static methods that maintain such a dict are shared with TopicRouter.
+    """
     def __init__(self, events):
         self.mq = MessageQueue()
-        self.events = { event : dict() for event in events }
+        self.events = { event : dict() for event in events }    #per event: reference to subscriber -> (reference to) handler
+
+    def ref(sub):
+        """
+        Returns: a weak reference to sub, or sub itself when it can not be referenced weakly
+        """
+        try:
+            return weakref.ref(sub)
+        except TypeError:
+            return sub
+
+    def addSubscriber(subscribers, sub, handler):
+        """
+        Adds sub with handler to subscribers, unless sub is already in it
+        """
+        key = Publisher.ref(sub)
+        if not key in subscribers:
+            Publisher.pruneSubscribers(subscribers)
+            if key is not sub and getattr(handler, "__self__", None) is sub and hasattr(handler, "__func__"):
+                handler = weakref.WeakMethod(handler)
+            subscribers[key] = handler
+
+    def pruneSubscribers(subscribers):
+        """
+        Removes the subscribers that no longer exist from subscribers
+        """
+        dead = [key for key, handler in subscribers.items() if isinstance(key, weakref.ref) and key() == None]
+        for key in dead:
+            del subscribers[key]
+
+    def liveSubscribers(subscribers):
+        """
+        Returns: a dict with the handler of each live subscriber in subscribers
+        """
+        live = dict()
+        for key, handler in subscribers.items():
+            sub = key() if isinstance(key, weakref.ref) else key
+            if isinstance(handler, weakref.ref):
+                handler = handler()
+            if sub != None and handler != None:
+                live[sub] = handler
+        return live
+
+    def collectMessages(subscribers, payload, messages):
+        """
+        Appends a message (handler, payload) to messages for each live subscriber in subscribers, 
+        and prunes the subscribers that no longer exist
+        """
+        dead = None
+        for key, handler in subscribers.items():
+            if isinstance(handler, weakref.ref):
+                handler = handler()
+            elif isinstance(key, weakref.ref) and key() == None:
+                handler = None
+            if handler == None:
+                dead = dead or []
+                dead.append(key)
+            else:
+                messages.append((handler, payload))
+        if dead:
+            for key in dead:
+                del subscribers[key]
+
+    def deliver(event, messages):
+        """
+        Queues the messages of a dispatch of event, see MessageQueue.processMessages
+        """
+        if MessageQueue.instrumentation != None:
+            messages = MessageQueue.instrumentation.dispatched(event, messages)
+        if len(messages)>0:
+            MessageQueue.processMessages(messages)
 
     def get_subscribers(self, event):
-        return self.events[event]
+        """
+        Returns: a dict with the handler of each live subscriber of event
+        """
+        return Publisher.liveSubscribers(self.events[event])
 
     def subscribe(self, sub, event, handler=None):
         if handler == None:
             handler = getattr(sub, 'update')
-        if not sub in self.get_subscribers(event):
-            self.get_subscribers(event)[sub] = handler
+        Publisher.addSubscriber(self.events[event], sub, handler)
 
     def unsubscribe(self, event, sub):
-        if event in self.events and sub in self.events[event]:
-            del self.events[event][sub]
+        if event in self.events:
+            self.events[event].pop(Publisher.ref(sub), None)
+
+    def prune(self, event):
+        """
+        Removes the subscribers of event that no longer exist
+        """
+        Publisher.pruneSubscribers(self.events[event])
 
     def dispatch(self, event, payload):
-        if payload:
+        if payload != None:
             payload.update({"event": event})
         else:
             payload = {"event": event}
 
         messages = list()
-        for subscriber, handler in self.get_subscribers(event).items():
-            messages.append((handler, payload))
+        Publisher.collectMessages(self.events[event], payload, messages)
+        Publisher.deliver(event, messages)
 
-        if len(messages)>0:
-            self.mq.process(messages)
+class TopicRouter:
+    """
+    Routes the events of a tree of objects to the subscribers of topics, such as the objects of a game (see ModelObject).
+    A topic is the path of an object in the tree: a tuple of segments, or a string with the segments separated by "/", 
+    such as "Game1/Board3/Set7". A subscription is for a pattern of topics, in which a segment WILDCARD ("*") matches 
+    any segment, and a last segment REST ("**") matches the rest of a topic, if any. For example, "Game1/Board3/**" 
+    matches the board and everything on it, and "Game1/*" matches the children of the game.
+    The patterns are indexed in a trie of their segments, so an event is delivered directly to the subscribers of
+    the patterns that match its topic, whatever the number of other subscriptions.
+    The subscribers are referenced weakly, as with a Publisher.
+    """
+    WILDCARD = "*"
+    REST = "**"
+
+    class Node:
+        __slots__ = ("children", "subscribers")
+
+        def __init__(self):
+            self.children = None    #segment -> Node
+            self.subscribers = None #event -> {reference to subscriber: (reference to) handler}
+
+    def __init__(self):
+        self.root = TopicRouter.Node()
+
+    def split(topic):
+        """
+        Returns: topic (a string or a sequence of segments) as a tuple of segments
+        """
+        return tuple(topic.split("/")) if isinstance(topic, str) else tuple(topic)
+
+    def getNode(self, pattern, create=False):
+        """
+        Returns: the node of pattern, or None if no subscription has pattern and create is False
+        """
+        node = self.root
+        for segment in TopicRouter.split(pattern):
+            if node.children == None:
+                if not create:
+                    return None
+                node.children = {}
+            child = node.children.get(segment)
+            if child == None:
+                if not create:
+                    return None
+                child = node.children[segment] = TopicRouter.Node()
+            node = child
+        return node
+
+    def subscribe(self, sub, pattern, event, handler=None):
+        if handler == None:
+            handler = getattr(sub, 'update')
+        node = self.getNode(pattern, True)
+        if node.subscribers == None:
+            node.subscribers = {}
+        if not event in node.subscribers:
+            node.subscribers[event] = {}
+        Publisher.addSubscriber(node.subscribers[event], sub, handler)
+
+    def unsubscribe(self, pattern, event, sub):
+        """
+        Removes the subscription of sub to event for pattern, and the nodes that are left without subscriptions
+        """
+        path = [self.root]
+        segments = TopicRouter.split(pattern)
+        for segment in segments:
+            child = path[-1].children.get(segment) if path[-1].children else None
+            if child == None:
+                return
+            path.append(child)
+        node = path[-1]
+        if node.subscribers and event in node.subscribers:
+            subscribers = node.subscribers[event]
+            subscribers.pop(Publisher.ref(sub), None)
+            if not subscribers:
+                del node.subscribers[event]
+        for i in range(len(segments), 0, -1):
+            node = path[i]
+            if node.subscribers or node.children:
+                break
+            del path[i-1].children[segments[i-1]]
+
+    def getSubscribers(self, pattern, event):
+        """
+        Returns: a dict with the handler of each live subscriber of event for pattern
+        """
+        node = self.getNode(pattern)
+        if node == None or not node.subscribers or not event in node.subscribers:
+            return {}
+        return Publisher.liveSubscribers(node.subscribers[event])
+
+    def match(self, topic):
+        """
+        Returns: the nodes of the patterns that match topic
+        """
+        matched = []
+        nodes = [self.root]
+        for segment in TopicRouter.split(topic):
+            next = []
+            for node in nodes:
+                children = node.children
+                if children:
+                    rest = children.get(TopicRouter.REST)
+                    if rest != None:
+                        matched.append(rest)
+                    child = children.get(segment)
+                    if child != None:
+                        next.append(child)
+                    child = children.get(TopicRouter.WILDCARD)
+                    if child != None:
+                        next.append(child)
+            nodes = next
+            if not nodes:
+                return matched
+        for node in nodes:
+            matched.append(node)
+            if node.children and TopicRouter.REST in node.children:
+                matched.append(node.children[TopicRouter.REST])
+        return matched
+
+    def publish(self, topic, event, payload):
+        """
+        Dispatches event, with payload, to the subscribers of the patterns that match topic
+        """
+        if payload != None:
+            payload["event"] = event
+        else:
+            payload = {"event": event}
+        messages = list()
+        for node in self.match(topic):
+            if node.subscribers and event in node.subscribers:
+                Publisher.collectMessages(node.subscribers[event], payload, messages)
+        Publisher.deliver(event, messages)
@@ -3,7 +3,7 @@ import wx.lib.scrolledpanel
 from console import AbstractConsole
 import client
 import server
-from lib.pubsub import Subscriber
+from lib.pubsub import Subscriber, MessageQueue, WxDelivery
 
 ID_NEWCHAT=101
 ID_JOINCHAT=102
@@ -158,5 +158,7 @@ class ClientFrame(wx.Frame, Subscriber):
 
 if __name__ == '__main__':
     app = wx.App()
+    # the client receives messages in its own thread, they are handled in the main loop
+    MessageQueue.setDelivery(WxDelivery())
     cf = ClientFrame()
     app.MainLoop()
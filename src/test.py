@@ -1,13 +1,31 @@
 import unittest
+import random
 from base.model import *
-from lib.pubsub import MessageQueue
+from base.gameserver import LocalGameServer
+from base.history import StateHistory
+from base.journal import Journal
+from base import tilecode
+from base import gameformat
+from base import persistentobject
+import gc
+import os
+import weakref
+import tempfile
+import time
+import tracemalloc
+import asyncio
+import threading
+import queue
+import sys
+import types
+import unittest.mock
+from lib.pubsub import MessageQueue, Publisher, SyncDelivery, AsyncioDelivery, ThreadDelivery, WxDelivery, Histogram, Subscriber, TopicRouter
 
 import lib.log
 
 class ModelTestMethods(unittest.TestCase):
 
     def setUp(self):
-        TileFactory.init()
         MessageQueue.getInstance(True)
         self.root = ModelObject()
     
@@ -125,6 +143,19 @@ class ModelTestMethods(unittest.TestCase):
         # attempt to add a blue 5 to the set, it should NOT fail and addTile should return 1)
         self.assertEqual(set.addTile(Tile.create(4, GameConstants.BLUE, 5, set)), 1)
 
+    def test_ResolveJokerInSet(self):
+        set = Set(self.root)
+        joker = Joker.create(1, GameConstants.RED, set)
+        set.addTile(joker)
+        self.assertIsNone(joker.resolve())
+        set.addTile(Tile.create(2, GameConstants.BLUE, 7, set))
+        set.addTile(Tile.create(3, GameConstants.BLUE, 8, set))
+        self.assertEqual(joker.resolve(), (6, GameConstants.BLUE))
+        self.assertEqual(set.addTile(Tile.create(4, GameConstants.BLUE, 5, set)), 1)
+        self.assertEqual(joker.resolve(), (6, GameConstants.BLUE))
+        #the joker itself keeps its own color
+        self.assertEqual(joker.getColor(), GameConstants.RED)
+
     def test_AddGroupToSetWithJoker(self):
         #create an empty set
         set = Set(self.root)
@@ -135,11 +166,673 @@ class ModelTestMethods(unittest.TestCase):
         # attempt to add a red 1 to the set, it should NOT fail (addTile returns a pos>0)
         self.assertNotEqual(set.addTile(Tile.create(3, GameConstants.RED, 1, set)), 0)
 
+    def test_RemoveAndReinsertTile(self):
+        set = Set(self.root)
+        tiles = [Tile.create(v, GameConstants.BLACK, v, set) for v in range(1,5)]
+        for t in tiles:
+            set.addTile(t)
+        self.assertTrue(set.isValid())
+        plate = Plate(self.root)
+        self.assertTrue(tiles[1].move(plate))
+        self.assertFalse(set.isValid())
+        self.assertEqual(set.tileFitPosition(tiles[1]), 0)
+        self.assertEqual(set.tileFitPosition(tiles[1], 2), 2)
+        self.assertTrue(tiles[1].move(set, 2))
+        self.assertTrue(set.isValid())
+        self.assertEqual(set.getSetType(), Set.SETTYPE_RUN)
+
+    def test_PersistencePlan(self):
+        set = Set(self.root)
+        other = Set(self.root)
+        #the persistent attributes are declared once for the class, and resolved to the attributes of the declaring classes
+        self.assertIs(set.__persistent__, other.__persistent__)
+        self.assertEqual(list(set.__persistent__.attributes), ["order", "pos"])
+        self.assertEqual(set.__persistent__.getSlots(set), [("order", "_Set__order"), ("pos", "_Set__pos")])
+        data = set.serialize()
+        data["pos"] = (5, 6)
+        other.deserialize(data)
+        self.assertEqual(other.getPos(), (5, 6))
+        #setting the attributes in their slots does not modify the set
+        version = self.root.getVersion()
+        other.setPersistentAttributes({"pos": (7, 8)})
+        self.assertEqual(other.getPos(), (7, 8))
+        self.assertEqual(self.root.getVersion(), version)
+
+    def test_ContainerTileOrder(self):
+        plate = Plate(self.root)
+        tiles = [Tile.create(tId, GameConstants.RED, 14-tId, plate) for tId in (5, 2, 9, 1)]
+        for t in tiles:
+            plate.addTile(t)
+        self.assertEqual(plate.getTiles(), [5, 2, 9, 1])
+        self.assertEqual(plate.getLastTile(), tiles[-1])
+        self.assertTrue(tiles[1].move(Plate(self.root)))
+        self.assertEqual(plate.getTiles(), [5, 9, 1])
+        self.assertEqual(plate.getPersistentAttributes()["tiles"], [5, 9, 1])
+        self.assertEqual(plate.getTile(2), None)
+
+    def test_RestoreTilePosition(self):
+        plate = Plate(self.root)
+        other = Plate(self.root)
+        tiles = [Tile.create(tId, GameConstants.RED, tId, plate) for tId in (5, 2, 9, 1)]
+        plate.putTiles([5, 2, 9, 1])
+        #a tile from the middle is put back between its neighbours, the last tile is put back at the end
+        for tile in (tiles[1], tiles[3]):
+            position = plate.getTilePosition(tile)
+            tile.move(other)
+            plate.restoreTile(tile, position)
+            self.assertEqual(plate.getTiles(), [5, 2, 9, 1])
+        #the positions follow a new order of the tiles
+        plate.setTileOrder([1, 5])
+        position = plate.getTilePosition(tiles[0])
+        tiles[0].move(other)
+        plate.restoreTile(tiles[0], position)
+        self.assertEqual(plate.getTiles(), [2, 9, 1, 5])
+        self.assertIs(tiles[0].getContainer(), plate)
+        self.assertEqual(other.getTiles(), [])
+
+    def test_WeakSubscribers(self):
+        class Panel:
+            def __init__(self):
+                self.handled = []
+            def onMsgModified(self, payload):
+                self.handled.append(payload)
+        panel = Panel()
+        self.root.subscribe(panel, "msg_object_modified", panel.onMsgModified)
+        self.root.setModified()
+        self.assertEqual(len(panel.handled), 1)
+        self.assertEqual(list(self.root.get_subscribers("msg_object_modified")), [panel])
+        #the subscription does not keep the panel alive, and the dead subscriber is pruned
+        del panel
+        self.assertEqual(self.root.get_subscribers("msg_object_modified"), {})
+        self.root.setModified()
+        self.assertEqual(self.root.getRouter().getNode(self.root.getTopic()).subscribers["msg_object_modified"], {})
+
+    def test_ObjectIds(self):
+        set = Set(Board(self.root))
+        self.assertEqual(set.getId(), "Set" + str(set.__objectId__))
+        self.assertEqual(set.getFullId(), "/".join([self.root.getId(), set.getParent().getId(), set.getId()]))
+        self.assertEqual(set.getFullId(), set.getTopic())
+        #a child is looked up by its id
+        board = set.getParent()
+        self.assertTrue(board.isValidChild(set))
+        self.assertFalse(self.root.isValidChild(set))
+        self.assertFalse(board.isValidChild(Set(self.root)))
+
+    def test_TopicRouter(self):
+        router = TopicRouter()
+        received = {}
+        subscribers = []
+        for pattern in ["a/b", "a/*", "a/b/**", "**", "a/*/c"]:
+            subscriber = Subscriber()
+            subscribers.append(subscriber)
+            received[pattern] = []
+            router.subscribe(subscriber, pattern, "msg_object_modified", received[pattern].append)
+        for topic in ["a", "a/b", "a/b/c", "a/x/c", "b"]:
+            router.publish(topic, "msg_object_modified", {"object": topic})
+        self.assertEqual({pattern: [m["object"] for m in r] for pattern, r in received.items()},
+                         {"a/b": ["a/b"], "a/*": ["a/b"], "a/b/**": ["a/b", "a/b/c"], "**": ["a", "a/b", "a/b/c", "a/x/c", "b"], "a/*/c": ["a/b/c", "a/x/c"]})
+        #unsubscribing removes the nodes that are left without subscriptions
+        router.unsubscribe("a/*/c", "msg_object_modified", subscribers[-1])
+        self.assertIsNone(router.getNode("a/*/c"))
+        self.assertIsNotNone(router.getNode("a/*"))
+
+class GameServerTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        MessageQueue.getInstance(True)
+        self.gs = LocalGameServer()
+        self.gameNr = self.gs.newGame(2)
+        self.gs.addPlayer(self.gameNr, "Joe")
+        self.gs.addPlayer(self.gameNr, "Ann")
+        self.gs.startGame(self.gameNr)
+        self.updates = []
+        self.gs.subscribe(self, "msg_game_updated", self.updates.append)
+
+    def tearDown(self):
+        MessageQueue.reset(True)
+
+    def test_SynchronizeByPatches(self):
+        joe = SynchronizingModel(self.gs, self.gameNr)
+        ann = SynchronizingModel(self.gs, self.gameNr)
+        for i in range(4):
+            model = joe if i % 2 == 0 else ann
+            model.pick()
+            self.assertIn("patch", self.updates[-1])
+            self.assertNotIn("game", self.updates[-1])
+            self.assertEqual(joe.getCurrentGame().serialize(), ann.getCurrentGame().serialize())
+        self.assertEqual(ann.getCurrentGame().getMoves(), 4)
+        #a pick only changes the game, the pile and a plate, and moves a single tile
+        patch = self.updates[-1]["patch"]
+        self.assertEqual([e["data"]["type"] for e in patch["elements"]], ["Game", "Pile", "Plate"])
+        self.assertEqual(len(patch["tiles"]), 1)
+
+    def test_ResyncByClone(self):
+        joe = SynchronizingModel(self.gs, self.gameNr)
+        ann = SynchronizingModel(self.gs, self.gameNr)
+        def assertPatched():
+            #the updates after a resync are applied as patches again
+            resynced = ann.getCurrentGame()
+            self.assertEqual(resynced.getOrigin(), joe.getCurrentGame().getOrigin())
+            for i in range(3):
+                joe.pick()
+                self.assertIn("patch", self.updates[-1])
+                self.assertIs(ann.getCurrentGame(), resynced)
+                self.assertEqual(ann.getCurrentGame().serialize(), joe.getCurrentGame().serialize())
+        #a local change puts ann's game out of sync with the next patch, so ann gets the game from the server
+        game = ann.getCurrentGame()
+        game.pile.getLastTile().move(game.getCurrentPlayer().plate)
+        joe.pick()
+        self.assertIsNot(ann.getCurrentGame(), game)
+        assertPatched()
+        #a complete game is taken from the server as well
+        self.gs.updateGame(Game.fromData(self.gs.getGame(self.gameNr).serialize()))
+        self.assertIn("game", self.updates[-1])
+        assertPatched()
+
+    def test_LazyPayload(self):
+        class Reader:
+            def __init__(self, field):
+                self.field = field
+                self.received = []
+            def onMsg(self, payload):
+                self.received.append(payload[self.field])
+        serializations = []
+        serialize = Game.serialize
+        def countingSerialize(game, *args):
+            serializations.append(game)
+            return serialize(game, *args)
+        Game.serialize = countingSerialize
+        try:
+            #the game is not serialized for subscribers that do not read it
+            listener = Reader("gamenr")
+            self.gs.subscribe(listener, "msg_new_game", listener.onMsg)
+            gameNr = self.gs.newGame(2)
+            self.assertEqual(listener.received, [gameNr])
+            self.assertEqual(serializations, [])
+            #the subscribers that read the game share a single serialization
+            readers = [Reader("game") for i in range(3)]
+            for reader in readers:
+                self.gs.subscribe(reader, "msg_new_game", reader.onMsg)
+            self.gs.newGame(2)
+            self.assertEqual(len(serializations), 1)
+            self.assertTrue(all(reader.received[0] is readers[0].received[0] for reader in readers))
+            #the game of an update that is not a continuation of the previous update, is only serialized when it is read
+            game = Game.fromData(self.gs.getGame(gameNr).serialize())
+            game.addPlayerByName("Joe")
+            serializations.clear()
+            self.gs.updateGame(game)
+            self.assertIn("game", self.updates[-1])
+            self.assertNotIn("game", self.updates[-1].keys())
+            self.assertEqual(serializations, [])
+            data = self.updates[-1].get("game")
+            self.assertEqual(serializations, [game])
+            self.assertEqual(data, game.serialize())
+        finally:
+            Game.serialize = serialize
+
+    def test_PayloadVersion(self):
+        #with a synchronous delivery, "game" is the game of the dispatch, or None once the game has changed
+        game = Game.fromData(self.gs.getGame(self.gameNr).serialize())
+        self.gs.updateGame(game)
+        payload = self.updates[-1]
+        game.pick()
+        self.assertIsNone(payload.get("game"))
+        #with a delivery that handles the message later, the game is serialized when it is dispatched
+        async def update():
+            MessageQueue.setDelivery(AsyncioDelivery(asyncio.get_running_loop()))
+            game = Game.fromData(self.gs.getGame(self.gameNr).serialize())
+            self.gs.updateGame(game)
+            dispatched = (game.serialize(), game.getMoves())
+            game.pick()
+            await asyncio.sleep(0)
+            return dispatched
+        self.addCleanup(MessageQueue.setDelivery, SyncDelivery())
+        dispatched = asyncio.run(update())
+        self.assertEqual((self.updates[-1]["game"], self.updates[-1]["moves"]), dispatched)
+
+    def test_DeferredPayload(self):
+        serializations = []
+        serialize = Game.serialize
+        def countingSerialize(game, *args):
+            serializations.append(game)
+            return serialize(game, *args)
+        received = {}
+        def receive(field):
+            return lambda payload: received.setdefault(field, []).append(payload.get(field))
+        async def newGame():
+            MessageQueue.setDelivery(AsyncioDelivery(asyncio.get_running_loop()))
+            #the game list of the GUI does not read the game, so it is not serialized
+            self.gs.subscribe(self, "msg_new_game", receive("gamenr"))
+            gameNr = self.gs.newGame(2)
+            self.gs.addPlayer(gameNr, "Joe")
+            self.gs.addPlayer(gameNr, "Ann")
+            self.gs.startGame(gameNr)
+            await asyncio.sleep(0)
+            self.assertEqual(serializations, [])
+            #a subscriber that reads the game gets it as it was dispatched, the server serializes it before it starts the game
+            self.gs.subscribe(self, "msg_game_loaded", receive("game"))
+            with tempfile.TemporaryDirectory() as d:
+                path = os.path.join(d, "game.yummy")
+                self.gs.saveGame(gameNr, path)
+                loaded = self.gs.loadGame(path)
+            dispatched = self.gs.getGame(loaded).serialize()
+            serializations.clear()
+            self.gs.startGame(loaded)
+            self.assertEqual(len(serializations), 1)
+            await asyncio.sleep(0)
+            return gameNr, dispatched
+        Game.serialize = countingSerialize
+        self.addCleanup(setattr, Game, "serialize", serialize)
+        self.addCleanup(MessageQueue.setDelivery, SyncDelivery())
+        gameNr, dispatched = asyncio.run(newGame())
+        self.assertEqual(received["gamenr"], [gameNr])
+        self.assertEqual(received["game"], [dispatched])
+        self.assertEqual(len(serializations), 1)
+
+    def test_SaveAndLoadGame(self):
+        game = self.gs.getGame(self.gameNr)
+        with tempfile.TemporaryDirectory() as d:
+            for binary in (True, False):
+                path = os.path.join(d, "game.yummy")
+                self.gs.saveGame(self.gameNr, path, binary)
+                with open(path, "rb") as f:
+                    self.assertEqual(gameformat.isBinary(f.read()), binary)
+                loaded = self.gs.getGame(self.gs.loadGame(path))
+                self.assertNotEqual(loaded.getGameNr(), game.getGameNr())
+                loaded.setGameNr(game.getGameNr())
+                self.assertEqual(loaded.serialize(), game.serialize())
+
+    def test_JournalReplay(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "games.journal")
+            gs = LocalGameServer(path)
+            gameNr = gs.newGame(2)
+            gs.addPlayer(gameNr, "Joe")
+            gs.addPlayer(gameNr, "Ann")
+            gs.startGame(gameNr)
+            joe = SynchronizingModel(gs, gameNr)
+            for i in range(6):
+                joe.pick()
+            #a set on the board, which is reverted because it is invalid, so that the next update is a snapshot:
+            #the valid state is not related to the current game (no origin and version), so the game is rebuilt from it
+            joe.getHistory().push(joe.getCurrentGame().serialize())
+            game = joe.getCurrentGame()
+            game.getCurrentPlayer().plate.getLastTile().move(game.board)
+            joe.commitMoves()
+            self.assertIsNot(joe.getCurrentGame(), game)
+            self.assertEqual(joe.getCurrentGame().board.getSets(), [])
+            joe.pick()
+            gs.close()
+            self.assertEqual([r["op"] for r in Journal(path).read()[-3:]], ["patch", "snapshot", "patch"])
+            restarted = LocalGameServer(path)
+            self.assertEqual(restarted.getGame(gameNr).serialize(), gs.getGame(gameNr).serialize())
+            self.assertEqual(restarted.newGame(2), gameNr+1)
+            #the restored game continues to synchronize by patches
+            restarted.subscribe(self, "msg_game_updated", self.updates.append)
+            model = SynchronizingModel(restarted, gameNr)
+            model.pick()
+            self.assertIn("patch", self.updates[-1])
+            restarted.close()
+            #the restart compacted the journal to a snapshot of each game
+            self.assertEqual(LocalGameServer(path).getGame(gameNr).serialize(), restarted.getGame(gameNr).serialize())
+
+    def test_JournalReplayStart(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "games.journal")
+            gs = LocalGameServer(path)
+            gameNr = gs.newGame(2)
+            gs.addPlayer(gameNr, "Joe")
+            gs.addPlayer(gameNr, "Ann")
+            gs.startGame(gameNr)
+            gs.close()
+            #a restart right after the start restores the started game
+            restarted = LocalGameServer(path)
+            self.assertEqual(restarted.getGame(gameNr).serialize(), gs.getGame(gameNr).serialize())
+            self.assertEqual(restarted.getGame(gameNr).getCurrentPlayer().getName(), "Joe")
+            self.assertEqual(restarted.getGameData(), [(gameNr, 2, 0, "Joe")])
+            restarted.close()
+
+    def test_JournalSync(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "games.journal")
+            journal = Journal(path, 4, 0.01)
+            for i in range(6):
+                journal.append({"op": "patch", "gamenr": 1, "patch": i})
+            #the records can be read back before the journal is synced or closed
+            self.assertEqual([r["patch"] for r in Journal(path).read()], list(range(6)))
+            self.assertEqual(journal.syncs, 1)
+            #the rest of the burst is synced when the interval has passed
+            deadline = time.monotonic() + 5
+            while journal.syncs < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(journal.syncs, 2)
+            journal.close()
+            self.assertEqual(journal.syncs, 2)
+            #the same for the journal of a server
+            gs = LocalGameServer(path)
+            gameNr = gs.newGame(2)
+            gs.addPlayer(gameNr, "Joe")
+            self.assertEqual([r["op"] for r in Journal(path).read()], ["snapshot", "patch"])
+            gs.close()
+
+    def test_JournalReplayInPlace(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "games.journal")
+            gs = LocalGameServer(path)
+            gameNr = gs.newGame(2)
+            gs.addPlayer(gameNr, "Joe")
+            gs.addPlayer(gameNr, "Ann")
+            gs.startGame(gameNr)
+            joe = SynchronizingModel(gs, gameNr)
+            for i in range(6):
+                joe.pick()
+            #a set on the board, which is reverted in place because it is invalid, so that the next update is a patch
+            joe.rememberState()
+            game = joe.getCurrentGame()
+            game.getCurrentPlayer().plate.getLastTile().move(game.board)
+            joe.commitMoves()
+            self.assertIs(joe.getCurrentGame(), game)
+            self.assertEqual(game.board.getSets(), [])
+            joe.pick()
+            gs.close()
+            self.assertEqual([r["op"] for r in Journal(path).read()[-2:]], ["patch", "patch"])
+            self.assertEqual(LocalGameServer(path).getGame(gameNr).serialize(), gs.getGame(gameNr).serialize())
+
+class MessageQueueTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        MessageQueue.reset(True)
+        self.mq = MessageQueue.getInstance()
+        self.handled = []
+
+    def tearDown(self):
+        MessageQueue.instrument(False)
+        MessageQueue.setDelivery(SyncDelivery())
+        MessageQueue.configure(MessageQueue.MAXQUEUESIZE, MessageQueue.BLOCK)
+        MessageQueue.reset(True)
+
+    def push(self, objects):
+        for obj in objects:
+            self.mq.pushMsg((self.handled.append, {"event": "msg_object_modified", "object": obj}))
+
+    def drain(self):
+        MessageQueue.handleMessages()
+        return [payload["object"] for payload in self.handled]
+
+    def test_Block(self):
+        MessageQueue.configure(3, MessageQueue.BLOCK)
+        self.push(range(5))
+        #the publisher handled the oldest messages itself, nothing is lost
+        self.assertEqual(len(self.handled), 2)
+        self.assertEqual(self.drain(), [0, 1, 2, 3, 4])
+        self.assertEqual(MessageQueue.getStats(), {"depth": 0, "highWaterMark": 3, "dropped": 0, "coalesced": 0, "blocked": 2})
+
+    def test_DropOldest(self):
+        MessageQueue.configure(3, MessageQueue.DROPOLDEST)
+        self.push(range(5))
+        self.assertEqual(MessageQueue.getStats()["depth"], 3)
+        self.assertEqual(self.drain(), [2, 3, 4])
+        self.assertEqual(MessageQueue.getStats()["dropped"], 2)
+
+    def test_Coalesce(self):
+        MessageQueue.configure(3, MessageQueue.COALESCE)
+        self.push([0, 1, 2, 1, 2, 3, 1])
+        #the repeated modifications of 1 and 2 are coalesced, 3 does not have an equal message queued, so 0 is dropped
+        self.assertEqual(self.drain(), [1, 2, 3])
+        stats = MessageQueue.getStats()
+        self.assertEqual((stats["coalesced"], stats["dropped"], stats["highWaterMark"]), (3, 1, 3))
+
+    def test_CoalesceIdentity(self):
+        MessageQueue.configure(3, MessageQueue.COALESCE)
+        def push(event, version, **identity):
+            self.mq.pushMsg((self.handled.append, dict(identity, event=event, version=version)))
+        push("msg_object_modified", 1, object=1)
+        push("msg_object_modified", 2)
+        push("msg_game_updated", 3, gamenr=1)
+        #the newer message about object 1 replaces the payload of the queued one
+        push("msg_object_modified", 4, object=1)
+        #a message without the identifying field, or of an event that is not idempotent, is not coalesced
+        push("msg_object_modified", 5)
+        push("msg_game_updated", 6, gamenr=1)
+        self.addCleanup(MessageQueue.setIdempotent, "msg_game_updated", None)
+        MessageQueue.setIdempotent("msg_game_updated", ["gamenr"])
+        push("msg_game_updated", 7, gamenr=1)
+        push("msg_game_updated", 8, gamenr=2)
+        MessageQueue.handleMessages()
+        self.assertEqual([payload["version"] for payload in self.handled], [5, 7, 8])
+        stats = MessageQueue.getStats()
+        self.assertEqual((stats["coalesced"], stats["dropped"]), (2, 3))
+
+    def test_AsyncioDelivery(self):
+        publisher = Publisher(["msg_object_modified"])
+        publisher.subscribe(self, "msg_object_modified", self.handled.append)
+        delivery = AsyncioDelivery()
+        MessageQueue.setDelivery(delivery)
+        async def dispatch():
+            for i in range(10):
+                publisher.dispatch("msg_object_modified", {"object": i})
+            self.assertEqual(self.handled, [])
+            await asyncio.sleep(0)
+        asyncio.run(dispatch())
+        #a single wakeup handled all messages
+        self.assertEqual([payload["object"] for payload in self.handled], list(range(10)))
+        self.assertEqual(delivery.drains, 1)
+
+    def test_AsyncioDeliveryThread(self):
+        publisher = Publisher(["msg_object_modified"])
+        threads = set()
+        def handle(payload):
+            threads.add(threading.current_thread())
+            self.handled.append(payload)
+        publisher.subscribe(self, "msg_object_modified", handle)
+        #a publisher in another thread waits for the loop when the queue is full, instead of handling messages itself
+        MessageQueue.configure(3, MessageQueue.BLOCK)
+        async def dispatchFromThread():
+            MessageQueue.setDelivery(AsyncioDelivery(asyncio.get_running_loop()))
+            thread = threading.Thread(target=lambda: [publisher.dispatch("msg_object_modified", {"object": i}) for i in range(100)])
+            thread.start()
+            while thread.is_alive() or MessageQueue.getInstance().hasMessages():
+                await asyncio.sleep(0.001)
+        asyncio.run(dispatchFromThread())
+        self.assertEqual([payload["object"] for payload in self.handled], list(range(100)))
+        self.assertEqual(threads, {threading.current_thread()})
+        self.assertGreater(MessageQueue.getStats()["blocked"], 0)
+
+    def test_BlockOutsideLock(self):
+        #a publisher in the thread of the loop makes room itself, its handlers run without the lock of the queue
+        locked = []
+        def handle(payload):
+            thread = threading.Thread(target=lambda: locked.append(self.mq.lock.acquire(timeout=1) and self.mq.lock.release()))
+            thread.start()
+            thread.join()
+            self.handled.append(payload)
+        MessageQueue.configure(3, MessageQueue.BLOCK)
+        async def dispatch():
+            MessageQueue.setDelivery(AsyncioDelivery(asyncio.get_running_loop()))
+            for i in range(5):
+                self.mq.pushMsg((handle, {"event": "msg_object_modified", "object": i}))
+            self.assertEqual(len(self.handled), 2)
+            await asyncio.sleep(0)
+            MessageQueue.handleMessages()
+        asyncio.run(dispatch())
+        self.assertEqual(self.drain(), [0, 1, 2, 3, 4])
+        self.assertEqual(locked, [None] * 5)
+        self.assertEqual(MessageQueue.getStats()["blocked"], 2)
+
+    def test_WxDeliveryThread(self):
+        #wx is replaced by a main loop in a thread, which is all that WxDelivery uses of it
+        calls = queue.Queue()
+        mainLoop = threading.Thread(target=lambda: [call() for call in iter(calls.get, None)], daemon=True)
+        wx = types.SimpleNamespace(CallAfter=calls.put, IsMainThread=lambda: threading.current_thread() is mainLoop)
+        with unittest.mock.patch.dict(sys.modules, {"wx": wx}):
+            delivery = WxDelivery()
+        publisher = Publisher(["msg_object_modified"])
+        threads = set()
+        def handle(payload):
+            threads.add(threading.current_thread())
+            self.handled.append(payload)
+        publisher.subscribe(self, "msg_object_modified", handle)
+        MessageQueue.setDelivery(delivery)
+        MessageQueue.configure(3, MessageQueue.BLOCK)
+        mainLoop.start()
+        for i in range(100):
+            publisher.dispatch("msg_object_modified", {"object": i})
+        handled = threading.Event()
+        calls.put(handled.set)
+        self.assertTrue(handled.wait(5))
+        calls.put(None)
+        self.assertEqual([payload["object"] for payload in self.handled], list(range(100)))
+        self.assertEqual(threads, {mainLoop})
+        self.assertGreater(MessageQueue.getStats()["blocked"], 0)
+
+    def test_ThreadDelivery(self):
+        publisher = Publisher(["msg_object_modified"])
+        threads = set()
+        def handle(payload):
+            threads.add(threading.current_thread())
+            self.handled.append(payload)
+        publisher.subscribe(self, "msg_object_modified", handle)
+        delivery = ThreadDelivery()
+        MessageQueue.setDelivery(delivery)
+        #the queue is full most of the time, the publisher waits for the dispatcher thread instead of handling messages itself
+        MessageQueue.configure(3, MessageQueue.BLOCK)
+        for i in range(100):
+            publisher.dispatch("msg_object_modified", {"object": i})
+        self.assertTrue(delivery.flush(5))
+        self.assertEqual([payload["object"] for payload in self.handled], list(range(100)))
+        self.assertEqual(threads, {delivery.thread})
+        MessageQueue.setDelivery(SyncDelivery())
+        self.assertFalse(delivery.thread.is_alive())
+
+    def test_Instrumentation(self):
+        publisher = Publisher(["msg_object_modified", "msg_new_child"])
+        other = []
+        publisher.subscribe(self, "msg_object_modified", self.handled.append)
+        subscriber = Subscriber()
+        publisher.subscribe(subscriber, "msg_object_modified", other.append)
+        instrumentation = MessageQueue.instrument()
+        for i in range(5):
+            publisher.dispatch("msg_object_modified", {"object": i})
+        publisher.dispatch("msg_new_child", {})
+        stats = instrumentation.snapshot()
+        self.assertEqual(stats["msg_object_modified"]["dispatches"], 5)
+        self.assertEqual(stats["msg_object_modified"]["fanout"]["mean"], 2)
+        self.assertEqual(stats["msg_object_modified"]["wait"]["count"], 10)
+        self.assertEqual(list(stats["msg_object_modified"]["handlers"]), ["list.append"])
+        self.assertEqual(stats["msg_object_modified"]["handlers"]["list.append"]["count"], 10)
+        #a dispatch without subscribers
+        self.assertEqual((stats["msg_new_child"]["dispatches"], stats["msg_new_child"]["fanout"]["max"]), (1, 0))
+        self.assertIn("msg_object_modified", instrumentation.report())
+        #nothing is measured when the instrumentation is off
+        MessageQueue.instrument(False)
+        publisher.dispatch("msg_object_modified", {"object": 5})
+        self.assertEqual(instrumentation.snapshot()["msg_object_modified"]["dispatches"], 5)
+        self.assertEqual(len(self.handled), 6)
+
+    def test_Histogram(self):
+        h = Histogram(1e-6)
+        for us in (0.5, 1, 3, 3, 100):
+            h.add(us * 1e-6)
+        self.assertEqual(h.buckets, [1, 1, 2, 0, 0, 0, 0, 1])
+        #the upper bound of the bucket, or the largest value
+        self.assertEqual((h.percentile(50), h.percentile(99)), (4e-6, h.max))
+
+class TileCodeTestMethods(unittest.TestCase):
+
+    def referenceSetType(self, codes):
+        #straightforward (slow) classification: try every possible run and group
+        tiles = [c for c in codes if not tilecode.isJoker(c)]
+        if len(set(tiles)) < len(tiles) or len(codes) > 13:
+            return Set.SETTYPE_INVALID
+        run = any(
+            all(tilecode.isJoker(c) or c == tilecode.encode(color, start+i) for i,c in enumerate(codes))
+            for color in GameConstants.TILECOLORS for start in range(1, 15-len(codes)))
+        group = len(codes) <= 4 and len(set(tilecode.valueOf(c) for c in tiles)) <= 1
+        if run and group: return Set.SETTYPE_UNDECIDED
+        if run: return Set.SETTYPE_RUN
+        if group: return Set.SETTYPE_GROUP
+        return Set.SETTYPE_INVALID
+
+    def test_Encode(self):
+        for color in GameConstants.TILECOLORS:
+            for value in GameConstants.TILEVALUES:
+                code = tilecode.encode(color, value)
+                self.assertFalse(tilecode.isJoker(code))
+                self.assertEqual(tilecode.colorOf(code), color)
+                self.assertEqual(tilecode.valueOf(code), value)
+        self.assertTrue(tilecode.isJoker(tilecode.JOKER))
+
+    def test_Classify(self):
+        e, J = tilecode.encode, tilecode.JOKER
+        B, R = GameConstants.BLACK, GameConstants.RED
+        self.assertEqual(tilecode.classify([e(B,3), e(B,4), e(B,5)]), Set.SETTYPE_RUN)
+        self.assertEqual(tilecode.classify([e(B,3), e(R,3), J]), Set.SETTYPE_GROUP)
+        self.assertEqual(tilecode.classify([J, e(B,3), J]), Set.SETTYPE_UNDECIDED)
+        self.assertEqual(tilecode.classify([e(B,5), J, J, e(B,8)]), Set.SETTYPE_RUN)
+        self.assertEqual(tilecode.classify([e(B,3), e(B,3)]), Set.SETTYPE_INVALID)
+        self.assertEqual(tilecode.classify([e(B,12), e(B,13), J]), Set.SETTYPE_INVALID)
+        self.assertEqual(tilecode.classify([e(B,3), e(B,5)]), Set.SETTYPE_INVALID)
+
+    def test_ClassifyRandomSets(self):
+        rnd = random.Random(1)
+        codes = [tilecode.encode(c, v) for c in GameConstants.TILECOLORS for v in GameConstants.TILEVALUES]
+        for i in range(5000):
+            color, start, n = rnd.choice(GameConstants.TILECOLORS), rnd.randint(1, 13), rnd.randint(1, 6)
+            if rnd.random() < 0.5:
+                #start from something that looks like a run or group, and mess it up a little
+                tiles = [tilecode.encode(color, min(start+i, 13)) for i in range(n)] if rnd.random() < 0.5 \
+                    else [tilecode.encode(c, start) for c in GameConstants.TILECOLORS[:min(n,4)]]
+                for j in range(rnd.randint(0, 2)):
+                    tiles[rnd.randrange(len(tiles))] = rnd.choice(codes + [tilecode.JOKER]*4)
+            else:
+                tiles = [rnd.choice(codes + [tilecode.JOKER]*4) for j in range(n)]
+            self.assertEqual(tilecode.classify(tiles), self.referenceSetType(tiles), tiles)
+
+    def test_SetStateIncremental(self):
+        rnd = random.Random(3)
+        codes = [tilecode.encode(c, v) for c in GameConstants.TILECOLORS for v in GameConstants.TILEVALUES]
+        for i in range(300):
+            state = tilecode.SetState()
+            color, value = rnd.choice(GameConstants.TILECOLORS), rnd.randint(1, 13)
+            candidates = [tilecode.encode(color, v) for v in range(max(1,value-3), min(13,value+3)+1)] + \
+                [tilecode.encode(c, value) for c in GameConstants.TILECOLORS] + [tilecode.JOKER, rnd.choice(codes)]
+            for j in range(10):
+                current = list(state.getCodes())
+                if current and rnd.random() < 0.2:
+                    index = rnd.randrange(len(current))
+                    state.remove(index)
+                    current.pop(index)
+                else:
+                    code, index = rnd.choice(candidates), rnd.randint(0, len(current))
+                    expected = current[:index] + [code] + current[index:]
+                    self.assertEqual(state.fit(code, index), tilecode.classify(expected), (current, code, index))
+                    state.insert(code, index)
+                    current = expected
+                self.assertEqual(state.getCodes(), current)
+                self.assertEqual(state.getType(), tilecode.classify(current), current)
+                self.assertEqual(state.getType(), tilecode.SetState(current).getType())
+
+    def test_SetStateRunRange(self):
+        e, J = tilecode.encode, tilecode.JOKER
+        state = tilecode.SetState([J, e(GameConstants.BLUE, 5), e(GameConstants.BLUE, 6)])
+        self.assertEqual(state.getRunRange(), (4, 6))
+        self.assertEqual(state.getJokerSlots(), [0])
+        self.assertEqual(state.getColors(), [GameConstants.BLUE])
+
+    def test_Resolve(self):
+        e, J = tilecode.encode, tilecode.JOKER
+        B, R, O = GameConstants.BLACK, GameConstants.RED, GameConstants.ORANGE
+        self.assertEqual(tilecode.resolve([J, e(B,5), J, J, e(B,8)]), [(4,B), (5,B), (6,B), (7,B), (8,B)])
+        self.assertEqual(tilecode.resolve([e(B,5), J, e(R,5)]), [(5,B), (5,GameConstants.BLUE), (5,R)])
+        self.assertEqual(tilecode.resolve([J, e(O,1)]), [(1,GameConstants.BLACK), (1,O)])
+        self.assertEqual(tilecode.resolve([J, J]), [None, None])
+
 class GameTestMethods(unittest.TestCase):
 
     def setUp(self):
         MessageQueue.getInstance(True)
-        self.game = Game(2)
+        #a seeded game, so that the tiles that the tests look for in the pile are not dealt
+        self.game = Game(2, 1)
         self.game.addPlayerByName("Joe")
         self.joe = self.game.getPlayerByName("Joe")
         self.assertIsNotNone(self.joe)
@@ -169,6 +862,26 @@ class GameTestMethods(unittest.TestCase):
         plateSizeAfter = self.joe.plate.getSize()
         self.assertEqual(plateSizeAfter-plateSizeBefore, 1)
 
+    def test_SeededDeal(self):
+        games = []
+        for i in range(2):
+            game = Game(2, seed=42)
+            game.addPlayerByName("Joe")
+            game.start()
+            games.append(game)
+        self.assertEqual(games[0].getSeed(), 42)
+        self.assertEqual(games[0].getPlayerByName("Joe").plate.getTiles(), games[1].getPlayerByName("Joe").plate.getTiles())
+        self.assertEqual(games[0].pile.getTiles(), games[1].pile.getTiles())
+        self.assertEqual(self.joe.plate.getSize(), Game.TILESPERPLAYER)
+
+    def test_PickFromTopOfDeck(self):
+        clone = self.game.clone()
+        self.assertEqual(clone.getSeed(), self.game.getSeed())
+        self.assertEqual(clone.pile.getTiles(), self.game.pile.getTiles())
+        top = self.game.pile.getTiles()[-1]
+        self.assertEqual(self.joe.pickTile().id(), top)
+        self.assertEqual(clone.getPlayerByName("Joe").pickTile().id(), top)
+
     def test_BoardCleanUp(self):
         for tId in self.joe.plate.getTiles():
             t = self.joe.plate.getTile(tId)
@@ -222,6 +935,358 @@ class GameTestMethods(unittest.TestCase):
         #a recursive check on the modification state of the entire model should return False at this point
         #self.assertFalse(self.game.isModified(True))
 
+    def test_ModifiedSets(self):
+        board = self.game.board
+        tiles = [self.game.pile.findTile(v, GameConstants.ORANGE) for v in range(1,4)]
+        for t in tiles:
+            t.move(self.joe.plate)
+        tiles[0].move(board)
+        set = tiles[0].getContainer()
+        for t in tiles[1:]:
+            t.move(set)
+        self.assertEqual(board.getModifiedSets(), [set])
+        self.game.commit()
+        self.assertEqual(board.getModifiedSets(), [])
+        self.assertEqual(board.validateSets(), 0)
+
+        #moving a tile out of a committed set marks that set as modified
+        tiles[2].move(self.joe.plate)
+        self.assertEqual(board.getModifiedSets(), [set])
+        self.assertEqual(board.validateSets(), 1)
+        tiles[2].move(set)
+        self.assertEqual(board.validateSets(), 0)
+
+        #a set that became empty is removed by cleanUp
+        tile = self.joe.plate.getTile(self.joe.plate.getTiles()[0])
+        tile.move(board)
+        newSet = tile.getContainer()
+        tile.move(self.joe.plate)
+        self.assertEqual(board.getModifiedSets(), [set, newSet])
+        board.cleanUp(True)
+        self.assertEqual(board.getSets(), [set])
+        self.assertEqual(board.getModifiedSets(), [])
+
+    def test_IndependentGames(self):
+        other = Game(2)
+        other.addPlayerByName("Ann")
+        other.start()
+        self.assertIsNot(other.getTileRegistry(), self.game.getTileRegistry())
+        tile = self.game.pile.getLastTile()
+        otherTile = other.getTileRegistry().getById(tile.id())
+        self.assertIsNot(tile, otherTile)
+        otherContainer = otherTile.getContainer()
+        tile.move(self.game.board)
+        self.assertIs(otherTile.getContainer(), otherContainer)
+        self.assertEqual(len(other.board.getSets()), 0)
+        #creating or cloning a game does not affect the tiles of other games
+        clone = self.game.clone()
+        self.assertIs(self.game.getTileRegistry().getById(tile.id()), tile)
+        self.assertEqual(len(clone.board.getSets()), 1)
+
+    def test_CloneGame(self):
+        set = self.game.board.addSet()
+        for v in range(1, 4):
+            self.game.pile.findTile(v, GameConstants.BLUE).move(set)
+        tile = self.joe.plate.getLastTile()
+        tile.move(self.game.board)
+        clone = self.game.clone()
+        self.assertEqual(clone.serialize(), self.game.serialize())
+        self.assertEqual([s.getSetType() for s in clone.board.getSets()], [s.getSetType() for s in self.game.board.getSets()])
+        clonedTile = clone.getTileRegistry().getById(tile.id())
+        self.assertIs(clonedTile.plate, clone.getPlayerByName("Joe").plate)
+        #the clone is independent of the original game
+        clonedTile.move(clonedTile.plate)
+        self.assertTrue(self.joe.plate.getTile(tile.id()) == None)
+        self.assertEqual(len(clone.board.getSets()[-1].getTiles()), 0)
+        self.assertEqual(len(self.game.board.getSets()[-1].getTiles()), 1)
+
+    def test_GameFromData(self):
+        set = self.game.board.addSet()
+        for v in range(1, 4):
+            self.game.pile.findTile(v, GameConstants.BLUE).move(set)
+        self.game.commit()
+        data = self.game.serialize()
+        game = Game.fromData(data)
+        deserialized = Game()
+        deserialized.deserialize(data)
+        self.assertEqual(game.serialize(), data)
+        self.assertEqual(game.serialize(), deserialized.serialize())
+        self.assertTrue(game.board.getSets()[0].isValid())
+        #the pile keeps the order of the deck
+        self.assertEqual(game.pile.getLastTile().id(), self.game.pile.getLastTile().id())
+
+    def test_StateHistory(self):
+        history = StateHistory(4)
+        data = self.game.serialize()
+        history.push(data)
+        size = history.getMemoryUsage()
+        #an unchanged state is shared completely
+        history.push(self.game.serialize())
+        self.assertIs(history.getLast()[0], history.get(1)[0])
+        self.assertEqual(history.getMemoryUsage(), size)
+        #a pick changes the game, the pile and the player with its plate, the board is shared
+        self.joe.pickTile()
+        history.push(self.game.serialize(), self.game.getOrigin(), self.game.getVersion())
+        last, previous = history.getLast()[0], history.get(1)[0]
+        self.assertEqual(last, self.game.serialize())
+        self.assertEqual([e is p for e, p in zip(last["elements"], previous["elements"])], [True, False, False])
+        self.assertLess(history.getMemoryUsage(), 2*size)
+        for i in range(4):
+            history.push(self.game.serialize())
+        self.assertEqual(history.getSize(), 4)
+        self.assertEqual(history.undo(10), history.get(0))
+        self.assertEqual(history.getSize(), 1)
+        #the memory cap drops the oldest states, but keeps the last
+        capped = StateHistory(16, size)
+        for i in range(3):
+            self.joe.pickTile()
+            capped.push(self.game.serialize())
+        self.assertEqual(capped.getSize(), 1)
+        self.assertEqual(capped.getLast()[0], self.game.serialize())
+
+    def test_RevertInPlace(self):
+        model = Model(self.game)
+        set = self.game.board.addSet()
+        for v in range(1, 4):
+            self.game.pile.findTile(v, GameConstants.BLUE).move(set)
+        model.commitMoves()
+        saved = model.getLastValidState()
+        #an invalid turn of the current player: two tiles to the board, and one tile from the pile to a plate
+        player = self.game.getCurrentPlayer()
+        player.plate.getLastTile().move(self.game.board)
+        player.plate.getLastTile().move(self.game.board)
+        self.game.pile.getLastTile().move(self.joe.plate)
+        #without the recorded moves, the game is restored from the changes since the state
+        self.game.getUndoStack().clear()
+        model.commitMoves()
+        self.assertIs(model.getCurrentGame(), self.game)
+        self.assertEqual(self.game.serialize(), saved)
+        #the sets that were created in the turn are removed
+        self.assertEqual(self.game.board.getSets(), [set])
+        self.assertEqual(list(self.game.board.getChildren()), [set])
+        self.assertTrue(set.isValid())
+
+    def test_UndoMoves(self):
+        model = Model(self.game)
+        set = self.game.board.addSet()
+        for v in range(1, 4):
+            self.game.pile.findTile(v, GameConstants.BLUE).move(set)
+        model.commitMoves()
+        saved = model.getLastValidState()
+        reverted = []
+        model.subscribe(self, "msg_game_reverted", reverted.append)
+        #a tile to a new set, a tile into the run, and the run moved
+        plate = self.game.getCurrentPlayer().plate
+        plateTiles = plate.getTiles()
+        plate.getLastTile().move(self.game.board)
+        tile = self.game.pile.findTile(4, GameConstants.BLUE)
+        tile.move(plate)
+        tile.move(set)
+        set.setPos((10, 20))
+        self.assertEqual(set.getOrder()[-1], tile.id())
+        self.assertEqual(self.game.getUndoStack().getSize(), 4)
+        #undo a single move
+        self.assertTrue(model.undoMove())
+        self.assertEqual(set.getPos(), None)
+        self.assertTrue(model.undoMove())
+        self.assertEqual(len(set.getOrder()), 3)
+        self.assertIs(tile.getContainer(), plate)
+        self.assertIs(tile.plate, None)
+        #revert the turn, by undoing the remaining moves
+        model.commitMoves()
+        self.assertIs(model.getCurrentGame(), self.game)
+        self.assertEqual(self.game.serialize(), saved)
+        self.assertEqual(plate.getTiles(), plateTiles)
+        self.assertEqual(list(self.game.board.getChildren()), [set])
+        self.assertEqual(self.game.getUndoStack().getSize(), 0)
+        self.assertFalse(model.undoMove())
+        self.assertTrue(reverted[-1]["inplace"])
+
+    def test_PickKeepsModifiedSets(self):
+        set = self.game.board.addSet()
+        for v in range(1, 4):
+            self.game.pile.findTile(v, GameConstants.BLUE).move(set)
+        self.game.commit()
+        #a tile of the set moved to a new set on the board: no tile returns to a plate when the player picks
+        other = self.game.board.addSet()
+        set.getLastTile().move(other)
+        self.game.pick()
+        self.assertCountEqual(self.game.board.getModifiedSets(), [set, other])
+        self.assertFalse(self.game.validate())
+
+    def test_NoLeak(self):
+        class Panel:
+            #like a panel of the gui: it references the game that it shows, and subscribes to it
+            def __init__(self, game):
+                self.game = game
+                game.subscribe(self, "msg_object_modified", self.onMsgGameModified)
+            def onMsgGameModified(self, payload):
+                pass
+        #a panel that only the game references is freed, while the game is still alive
+        panel = weakref.ref(Panel(self.game))
+        self.assertIsNone(panel())
+        self.assertEqual(self.game.get_subscribers("msg_object_modified"), {})
+        self.game.setModified()
+        model = Model(self.game)
+        model.rememberState()
+        data = model.getLastValidState()
+        def cycle():
+            game = model.getCurrentGame()
+            game.getCurrentPlayer().plate.getLastTile().move(game.board)
+            model.revertGame()
+            model.loadGame(data)
+            #a panel for the new game, the panel of the previous game does not unsubscribe
+            return Panel(model.getCurrentGame())
+        panel = None
+        for i in range(100):
+            panel = cycle()
+        gc.collect()
+        before = len(gc.get_objects())
+        previous = (weakref.ref(model.getCurrentGame()), weakref.ref(panel))
+        for i in range(1000):
+            panel = cycle()
+        gc.collect()
+        #the reverted and reloaded games and their panels are freed
+        self.assertEqual([ref() for ref in previous], [None, None])
+        self.assertLess(len(gc.get_objects()) - before, 100)
+
+    def test_Batch(self):
+        messages = []
+        for obj in (self.game, self.game.board, self.joe, self.joe.plate):
+            obj.subscribe(self, "msg_object_modified", messages.append)
+        with self.game.batch():
+            for i in range(3):
+                self.joe.plate.getLastTile().move(self.game.board)
+            self.assertEqual(messages, [])
+        #a single message per object, with the modified children
+        self.assertEqual(len(messages), 4)
+        byObject = {m["object"]: m for m in messages}
+        plate, board, game, joe = [byObject[obj] for obj in (self.joe.plate, self.game.board, self.game, self.joe)]
+        self.assertEqual(plate["children"], [])
+        self.assertEqual(len(board["children"]), 3)
+        self.assertEqual(game["children"], [self.game.board, self.joe])
+        self.assertEqual((plate.get("modified"), joe.get("modified"), game.get("modified")), (None, True, True))
+        #outside a batch, every modified object publishes its own message, the ancestors do not pass it on
+        messages.clear()
+        self.joe.plate.getLastTile().move(self.game.board)
+        self.assertEqual({m["object"] for m in messages}, {self.joe.plate, self.game.board})
+
+    def test_SubscribeInBatch(self):
+        messages = []
+        game = Game(2, 1)
+        game.addPlayerByName("Joe")
+        joe = game.getPlayerByName("Joe")
+        game.start()
+        #nothing is subscribed when the batch starts, the subscriber gets the modifications from before it subscribed
+        with game.batch():
+            game.board.setModified()
+            game.subscribeTree(self, "msg_object_modified", messages.append)
+            game.pile.getLastTile().move(joe.plate)
+        self.assertEqual({m["object"] for m in messages}, {game, game.board, game.pile, joe, joe.plate})
+        self.assertEqual(len(messages), 5)
+
+    def test_SubscribeTree(self):
+        messages = []
+        self.joe.subscribeTree(self, "msg_object_modified", messages.append)
+        self.joe.plate.getLastTile().move(self.game.board)
+        #a single message for the modified plate, directly from the plate
+        self.assertEqual([m["object"] for m in messages], [self.joe.plate])
+        self.assertEqual(self.joe.plate.getTopic(), self.game.getId() + "/" + self.joe.getId() + "/" + self.joe.plate.getId())
+        #a wildcard subscription to the sets on the board
+        sets = []
+        self.game.getRouter().subscribe(self, self.game.board.getTopic() + "/*", "msg_object_modified", sets.append)
+        self.joe.plate.getLastTile().move(self.game.board)
+        self.assertEqual([m["object"] for m in sets], [self.game.board.getSets()[-1]])
+        self.joe.unsubscribeTree("msg_object_modified", self)
+        count = len(messages)
+        self.joe.plate.getLastTile().move(self.game.board)
+        self.assertEqual(len(messages), count)
+
+    def test_GamePatch(self):
+        receiver = self.game.clone()
+        self.assertEqual(receiver.getVersion(), self.game.getVersion())
+        #put a run on the board and commit it, pick a tile, and put an invalid set on the board
+        set = self.game.board.addSet()
+        for v in range(1, 4):
+            self.game.pile.findTile(v, GameConstants.RED).move(set)
+        self.game.commit()
+        self.joe.pickTile()
+        self.joe.plate.getLastTile().move(self.game.board)
+        patch = self.game.getPatch(receiver.getVersion())
+        #the picked tile is the one that was moved to the board, it is listed once, in its last position
+        self.assertEqual(len(patch["tiles"]), 4)
+        self.assertTrue(receiver.applyPatch(patch))
+        self.assertEqual(receiver.serialize(), self.game.serialize())
+        self.assertEqual(receiver.getVersion(), self.game.getVersion())
+        #a patch only applies to the version it is based on
+        self.assertFalse(receiver.applyPatch(patch))
+        #undo the invalid set, which removes it from the board
+        self.game.board.cleanUp()
+        self.assertTrue(receiver.applyPatch(self.game.getPatch(patch["version"])))
+        self.assertEqual(len(receiver.board.getSets()), 1)
+        self.assertEqual(receiver.serialize(), self.game.serialize())
+
+    def test_PatchStart(self):
+        game = Game(2, 1)
+        game.addPlayerByName("Joe")
+        game.addPlayerByName("Ann")
+        receiver = game.clone()
+        game.start()
+        self.assertTrue(receiver.applyPatch(game.getPatch(receiver.getVersion())))
+        self.assertEqual(receiver.getCurrentPlayer().getName(), "Joe")
+        self.assertEqual(receiver.serialize(), game.serialize())
+
+    def test_BinaryFormat(self):
+        set = self.game.board.addSet()
+        for v in range(4, 7):
+            self.game.pile.findTile(v, GameConstants.ORANGE).move(set)
+        set.setPos((120, -8))
+        self.joe.plate.getLastTile().move(self.game.board)
+        self.joe.pickTile()
+        data = gameformat.encode(self.game)
+        self.assertTrue(gameformat.isBinary(data))
+        self.assertEqual(gameformat.decode(data).serialize(), self.game.serialize())
+        #the pile is no longer in the order of the deck, so its tiles are stored
+        self.game.pile.setTileOrder(sorted(self.game.pile.getTiles()))
+        self.assertGreater(len(gameformat.encode(self.game)), len(data))
+        self.assertEqual(gameformat.decode(gameformat.encode(self.game)).serialize(), self.game.serialize())
+        #numbers that take several bytes, or that are None or negative
+        game = Game(2, 2**40+3)
+        game.addPlayerByName("Ann")
+        game.start()
+        game.setGameNr(300)
+        set = game.board.addSet()
+        set.setPos((-70000, 2**20))
+        self.assertEqual(gameformat.decode(gameformat.encode(game)).serialize(), game.serialize())
+
+    def test_SerializeBorrowed(self):
+        for color in GameConstants.TILECOLORS:
+            set = self.game.board.addSet()
+            for v in range(10, 13):
+                self.game.pile.findTile(v, color).move(set)
+        data = self.game.serialize()
+        borrowed = self.game.serialize(True)
+        self.assertEqual(borrowed, data)
+        #borrowed data refers to the attributes of the sets, instead of copies
+        setData = [e for e in borrowed["elements"] if e["type"] == "Board"][0]["elements"]
+        self.assertIs(setData[0]["order"], self.game.board.getSets()[0].getOrder())
+        def allocated(borrowed):
+            #the number of blocks that persistentobject allocated for the result of serialize
+            self.game.serialize(borrowed)
+            tracemalloc.start()
+            data = self.game.serialize(borrowed)
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, persistentobject.__file__)])
+            tracemalloc.stop()
+            return sum(stat.count for stat in snapshot.statistics("filename"))
+        self.assertLess(allocated(True), allocated(False))
+
+    def test_SharedTileFaces(self):
+        other = Game(2)
+        registry, otherRegistry = self.game.getTileRegistry(), other.getTileRegistry()
+        for tile in registry.getTiles():
+            self.assertIs(registry.faces[tile.id()], otherRegistry.faces[tile.id()])
+            self.assertFalse(hasattr(tile, "__dict__"))
+
     def test_CommitInvalidMove(self):
         # add black tiles 1 through 5 to test player Joe's plate
         for i in range(1,6):
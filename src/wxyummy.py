@@ -5,6 +5,7 @@ from wxasync import WxAsyncApp
 from wx.lib.inspection import InspectionTool
 
 from lib import log
+from lib.pubsub import MessageQueue, AsyncioDelivery
 
 from gui import styles, draggable
 from gui.gamepanels import GamePanel
@@ -337,6 +338,8 @@ def start():
     #log.setLoggerLevel("gui.gamepanels", logging.ERROR)
     app = WxAsyncApp()
     loop = asyncio.get_event_loop()
+    # the messages of the model are handled in the loop, also those dispatched before it runs
+    MessageQueue.setDelivery(AsyncioDelivery(loop))
     w = MainWindow()
     try:
         loop.run_until_complete(app.MainLoop())